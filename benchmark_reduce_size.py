@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+"""
+Benchmark reduce_size.v1.py on a synthetic RICOPILI tree.
+
+A tree with the layouts the actions look for (errandout, tmp_report_*, pcaer_*, dasuqc1_*, cobg_dir_genome_wide,
+resdaner, danscore_*, report_*, dameta_*, daner_*) is generated once from a seed. Every action option is then run on a
+fresh copy of it, under cProfile, and the time spent in each phase (traversal, accounting, compression, validation,
+deletion) is written to a JSON file together with the tree parameters, so runs can be compared across script versions
+(--script old.py --script new.py) and tree sizes. Versions that log their own ##Phase_ lines are not run under cProfile;
+their phases, with CPU time, bytes and files, are read from the summary log.
+"""
+import argparse
+import os
+import sys
+import subprocess
+import datetime
+import time
+import gzip
+import shutil
+import json
+import random
+import pstats
+import platform
+import re
+import tempfile
+
+parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+parser.add_argument('--script', default=[], action='append', type=str, help="reduce_size script to benchmark; can be repeated to compare versions (default: reduce_size.v1.py next to this file).\n")
+parser.add_argument('--work', default=None, type=str, help="Directory for the generated tree and its copies (default: a temporary directory, removed afterwards).\n")
+parser.add_argument('--out', default=None, type=str, help="JSON results file (default: benchmark_reduce_size_<time>.json).\n")
+parser.add_argument('--options', default="gen_clean,qc1_clean,pca_clean,imp_clean,post_clean,all_actions", type=str,
+        help="Comma separated action options, each run on its own copy of the tree (default: every option and --all_actions).\n")
+parser.add_argument('--runs', default=1, type=int, help="Runs of every script and option (default: 1).\n")
+parser.add_argument('--script_args', default="", type=str, help="Extra arguments for every run, e.g. \"--codec zstd --jobs 4\".\n")
+parser.add_argument('--no_phases', action='store_true', help="Do not run versions without built-in phase timing under cProfile; only their wall time is measured.\n")
+#
+parser.add_argument('--seed', default=1, type=int, help="Seed of the generated tree (default: 1).\n")
+parser.add_argument('--units', default=2, type=int, help="Directories of every kind (tmp_report_*, pcaer_*, dasuqc1_*, danscore_*, ...) (default: 2).\n")
+parser.add_argument('--files', default=20, type=int, help="Files per directory (default: 20).\n")
+parser.add_argument('--file_size', default="256K", type=str, help="Average file size (default: 256K); sizes vary between half and one and a half times this.\n")
+parser.add_argument('--errandout_files', default=2000, type=int, help="Small log files in every errandout directory (default: 2000).\n")
+parser.add_argument('--empty_files', default=100, type=int, help="Empty files spread over the tree (default: 100).\n")
+parser.add_argument('--compressibility', default=0.7, type=float, help="Fraction of every file that is repetitive text, the rest is random bytes (default: 0.7).\n")
+
+## phases of a run and the functions of reduce_size.v1.py whose time they add up. A function called from another
+## function of the same phase is not counted twice. Names missing from an older version count 0, but every phase
+## needs at least one function the version defines (see check_phases): the baseline's get_size/count_files walks
+## are its accounting
+PHASES={
+    "traversal":   ["_scan", "find_files_or_dirs", "find_empty_files", "index_glob", "plan_units"],
+    "accounting":  ["get_stats", "get_size", "count_files", "unit_after_stats", "write_summary"],
+    "compression": ["compress_files", "write_tar_archive"],
+    "validation":  ["validate_compress_files"],
+    "deletion":    ["delete_files", "delete_paths", "delete_tree"],
+}
+
+def parse_size(text):
+    ## "500", "20M", "1.5G" -> bytes
+    text=text.strip().upper().rstrip("B")
+    scale=" KMGT".index(text[-1]) if text and text[-1] in "KMGT" else 0
+    return int(float(text[:-1] if scale else text)*1024**scale)
+
+
+class TreeGenerator(object):
+    ## reproducible synthetic RICOPILI tree: same seed and parameters, same files and bytes
+    def __init__(self, root, seed=1, units=2, files=20, file_size=256<<10, errandout_files=2000, empty_files=100, compressibility=0.7):
+        self.root=root; self.rng=random.Random(seed)
+        self.units=units; self.files=files; self.file_size=file_size
+        self.errandout_files=errandout_files; self.empty_files=empty_files
+        self.compressibility=min(1.0, max(0.0, compressibility))
+        self.noise=self.rng.randbytes(4<<20)
+        lines=[]; size=0
+        while size<4<<20:
+            lines.append(f"rs{self.rng.randrange(10**7)}\t{self.rng.randrange(1, 23)}\t{self.rng.randrange(10**8)}\t"
+                         f"{self.rng.choice('ACGT')}\t{self.rng.choice('ACGT')}\t{self.rng.random():.4f}\t{self.rng.random():.3e}\n".encode())
+            size+=len(lines[-1])
+        self.text=b"".join(lines)
+        self.nfiles=0; self.nbytes=0
+
+    def content(self, size):
+        text=int(size*self.compressibility)
+        parts=[]
+        for pool, length in ((self.text, text), (self.noise, size-text)):
+            while length>0:
+                start=self.rng.randrange(len(pool)//2)
+                piece=pool[start:start+min(length, len(pool)//2)]
+                parts.append(piece); length-=len(piece)
+        return b"".join(parts)
+
+    def write(self, path, size=None, gz=False):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if size is None:
+            size=self.rng.randint(self.file_size//2, self.file_size*3//2)
+        data=self.content(size) if size else b""
+        if gz:
+            data=gzip.compress(data, 1)
+        with open(path, "wb") as fh:
+            fh.write(data)
+        self.nfiles+=1; self.nbytes+=len(data)
+
+    def fill(self, directory, names):
+        ## names: file name patterns with {i}; the directory gets self.files files spread over them
+        for i in range(self.files):
+            name=names[i%len(names)].format(i=i)
+            self.write(os.path.join(directory, name), gz=name.endswith(".gz"))
+
+    def generate(self):
+        for u in range(self.units):
+            study=os.path.join(self.root, f"study{u}")
+            errandout=os.path.join(study, "qc", "errandout")
+            for i in range(self.errandout_files):
+                self.write(os.path.join(errandout, f"job{i}.{'out' if i%2 else 'err'}"), self.rng.randint(100, 4000))
+            self.fill(os.path.join(study, "qc", f"tmp_report_qc{u}"), ["qc{i}.bim", "qc{i}.bed", "qc{i}.fam", "qc{i}.txt", "qc{i}.log"])
+            pcaer=os.path.join(study, "pca", f"pcaer_pc{u}")
+            self.fill(os.path.join(pcaer, "run"), ["pc{i}.menv.assomds.1.qassoc", "pc{i}.menv.mds.asso.pdf", "pc{i}.menv.mds.asso-nup.pdf.gz", "pc{i}.mds", "pc{i}.log"])
+            dasuqc1=os.path.join(study, "imp", f"dasuqc1_chr{u}")
+            for sub in ("bg", "bgs", "bgn", "info"):
+                self.fill(os.path.join(dasuqc1, sub), [sub+"{i}.gz", sub+"{i}.info"])
+            self.fill(os.path.join(dasuqc1, "qc1f"), ["chunk{i}.ngt", "chunk{i}.bim", "chunk{i}.log"])
+            self.fill(os.path.join(study, "imp", "cobg_dir_genome_wide"), ["c{i}.bg.fam", "c{i}.bg.bed", "c{i}.bg.bim", "c{i}.bgs.fam", "c{i}.bgs.bed", "c{i}.bgs.bim"])
+            post=os.path.join(study, "post")
+            self.fill(os.path.join(post, "resdaner"), ["daner_res{i}.gz", "daner_res{i}.txt"])
+            self.fill(os.path.join(post, f"danscore_sc{u}"), ["score{i}.profile", "score{i}.log"])
+            self.fill(os.path.join(post, f"report_rep{u}"), ["daner_r{i}.meta.gz", "daner_r{i}.het.gz", "report{i}.txt"])
+            self.fill(os.path.join(post, f"dameta_m{u}"), ["m{i}.metadaner.gz", "m{i}.txt"])
+            self.fill(os.path.join(post, f"daner_d{u}", "dan"), ["dan_{i}.assoc.dosage.ngt.gz", "dan_{i}.assoc", "dan_{i}.log"])
+        dirs=sorted(root for root, _, _ in os.walk(self.root))
+        for i in range(self.empty_files):
+            self.write(os.path.join(self.rng.choice(dirs), f"empty{i}.txt"), 0)
+        return {"total_files": self.nfiles, "total_bytes": self.nbytes}
+
+
+def tree_stats(path):
+    files=0; size=0; alloc=0
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            st=os.lstat(os.path.join(root, name))
+            files+=1; size+=st.st_size; alloc+=st.st_blocks*512
+    return {"files": files, "size": size, "alloc": alloc}
+
+def check_phases(source, script):
+    ## a phase none of whose functions the script defines would silently report 0 s for it
+    for phase, names in PHASES.items():
+        if not any(re.search(rf"^\s*def {name}\(", source, re.M) for name in names):
+            raise SystemExit(f"Exiting: no function of the {phase} phase ({', '.join(names)}) is defined in {script}; update PHASES.")
+
+def phase_times(profile_file, script):
+    ## cumulative seconds per phase, counting only calls made from outside the phase's own functions
+    stats=pstats.Stats(profile_file).stats
+    times={}
+    for phase, names in PHASES.items():
+        keys={key for key in stats if key[2] in names and os.path.abspath(key[0])==script}
+        times[phase]=round(sum(ct for key in keys for caller, (cc, nc, tt, ct) in stats[key][4].items() if caller not in keys), 4)
+    return times
+
+def logged_phases(summary_file):
+    ## the ##Phase_ lines a version with built-in instrumentation writes to its summary log
+    times={}; details={}
+    with open(summary_file) as fh:
+        for line in fh:
+            if line.startswith("##Phase_"):
+                phase, wall, cpu, read, written, files, rate=line.rstrip("\n").split("\t")
+                phase=phase[len("##Phase_"):]
+                times[phase]=float(wall.rstrip("s"))
+                details[phase]={"cpu": float(cpu.rstrip("s")), "read": parse_size(read), "written": parse_size(written), "files": int(files), "throughput": rate}
+    return times, details
+
+def run_once(script, option, template, work, extra, phases):
+    ## phases: take the time per phase from the script's own summary log when it writes one, otherwise from cProfile
+    tree=os.path.join(work, "run")
+    if os.path.exists(tree):
+        shutil.rmtree(tree)
+    shutil.copytree(template, tree, symlinks=True)
+    before=tree_stats(tree)
+    with open(script) as fh:
+        source=fh.read()
+    instrumented="##Phase_" in source
+    profile=phases and not instrumented
+    if profile:
+        check_phases(source, script)
+    profile_file=os.path.join(work, "run.prof")
+    command=[sys.executable]+(["-m", "cProfile", "-o", profile_file] if profile else [])+[script, "--dir", tree, f"--{option}"]+extra
+    start=time.perf_counter()
+    process=subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    wall=time.perf_counter()-start
+    result={"script": script, "option": option, "returncode": process.returncode, "wall": round(wall, 4), "profiled": profile}
+    for name in os.listdir(tree):
+        ## the run's own logs and journal are not part of the tree
+        if name.startswith("reduce_size"):
+            if instrumented and name.endswith(".summary.logs"):
+                result["phases"], result["phase_details"]=logged_phases(os.path.join(tree, name))
+            os.remove(os.path.join(tree, name))
+    result["before"]=before; result["after"]=tree_stats(tree)
+    if profile and process.returncode==0:
+        result["phases"]=phase_times(profile_file, script)
+    if process.returncode!=0:
+        result["output"]=process.stdout[-2000:]
+    return result
+
+if __name__ == '__main__':
+    args=parser.parse_args()
+    scripts=args.script or [os.path.join(os.path.dirname(os.path.abspath(__file__)), "reduce_size.v1.py")]
+    options=[option.strip().lstrip("-") for option in args.options.split(",") if option.strip()]
+    out_file=args.out or f"benchmark_reduce_size_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"
+    work=args.work or tempfile.mkdtemp(prefix="reduce_size_bench_")
+    try:
+        template=os.path.join(work, "template")
+        if os.path.exists(template):
+            shutil.rmtree(template)
+        tree_params={"seed": args.seed, "units": args.units, "files": args.files, "file_size": parse_size(args.file_size),
+                     "errandout_files": args.errandout_files, "empty_files": args.empty_files, "compressibility": args.compressibility}
+        start=time.perf_counter()
+        generated=TreeGenerator(template, **tree_params).generate()
+        print(f"Generated {generated['total_files']} files, {generated['total_bytes']} bytes in {time.perf_counter()-start:.1f}s")
+        results=[]
+        for run in range(args.runs):
+            for script in scripts:
+                for option in options:
+                    result=run_once(os.path.abspath(script), option, template, work, args.script_args.split(), not args.no_phases)
+                    result["run"]=run
+                    results.append(result)
+                    phases="\t".join(f"{phase} {seconds:.2f}s" for phase, seconds in result.get("phases", {}).items())
+                    print(f"{os.path.basename(script)}\t--{option}\trun {run}\t{'ok' if result['returncode']==0 else 'FAILED'}\t{result['wall']:.2f}s\t{phases}")
+        with open(out_file, "w") as out_fh:
+            json.dump({"created": datetime.datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+                       "platform": platform.platform(), "cpus": os.cpu_count(),
+                       "script_args": args.script_args, "tree": dict(tree_params, **generated), "results": results}, out_fh, indent=1)
+        print(f"Results written to {out_file}")
+    finally:
+        if args.work is None:
+            shutil.rmtree(work, ignore_errors=True)
@@ -6,8 +6,8 @@ Please see & read this document for details: https://docs.google.com/document/d/
 **********************************************************************************************************************************
 """
 import argparse
-import glob
 import os
+import sys
 import subprocess
 import datetime
 import time
@@ -15,16 +15,45 @@ import gzip
 import tarfile
 import shutil
 import contextlib
+import atexit
+import signal
+import threading
+import json
+import zlib
+import hashlib
+import collections
 import re
+import stat
+import errno
 import math
+import sqlite3
+import random
+import bisect
+import itertools
+import inspect
+import heapq
+import cProfile
+import pstats
+import lzma
+import fnmatch
+import struct
+import select
+import ctypes
+import multiprocessing
+import concurrent.futures
 from pathlib import Path
+try:
+    import zstandard
+except ImportError:
+    zstandard=None
 
 __version__ = "2024v.1.1"
 
 parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
 parser.add_argument("--version", "-v", action="version", version=f"Version: {__version__}")
 #
-parser.add_argument('--dir',         default=None, type=str, help="Full path of the directory from where you want to start this script recursively\n", required=True)
+parser.add_argument('--dir',         default=None, type=str, help="Full path of the directory from where you want to start this script recursively\n\
+        \t(required unless --ls or --extract is used)\n")
 #
 parser.add_argument('--gen_clean',  action='store_true', help="Recursively deletes \
         \n\t1) all the files with size 0, \
@@ -56,35 +85,442 @@ parser.add_argument('--post_clean',  action='store_true', help=\
         \n5) Find all \"danscore_*\" and compress-validate-delete.")
 #
 parser.add_argument('--all_actions', action='store_true', help="This option will perform ALL the above actions.\nThis means it will override all obove options")
+#
+parser.add_argument('--threads', default=None, type=int, help="Compression threads per archive (default: number of CPUs / --jobs).\n\
+        \tgzip uses pigz when it is on PATH, otherwise a built-in multi-threaded gzip writer; both write standard .gz/.tar.gz.\n\
+        \tzstd and xz use their commands' own threads.\n")
+#
+parser.add_argument('--codec', default=None, type=str, help="Archive format, optionally with a level (default: gzip:6):\n\
+        \tgzip[:1-9]   .tar.gz / .gz\n\
+        \tzstd[:1-19]  .tar.zst / .zst, much faster than gzip at a similar ratio (zstd command or zstandard module)\n\
+        \txz[:0-9]     .tar.xz / .xz, smallest and slowest\n\
+        \tstore        uncompressed .tar; single files are left as they are\n")
+#
+parser.add_argument('--action_codec', default=[], action='append', type=str, metavar="ACTION=CODEC",
+        help="Codec of one action's archives, overriding --codec; can be repeated. ACTION is an action name\n\
+        \t(size-zero, errandout, tmp-report, cobg-dir, dasuqc1, pcaer-sub, resdaner, danscore, report-sub, dameta, daner-sub)\n\
+        \tor dasuqc1/info and dasuqc1/qc1f, e.g. --action_codec danscore=store --action_codec report-sub=zstd.\n")
+#
+parser.add_argument('--recompress', action='store_true', help="Compress members that are already compressed (*.gz, *.zst, ... or incompressible content) again.\n\
+        \tBy default they are stored inside the archive as uncompressed frames of the same format, which saves the CPU time.\n")
+#
+parser.add_argument('--no_dedup', action='store_true', help="Do not look for byte-identical files inside an archive's directory. By default files of the same size are\n\
+        \tcompared by a hash of their first 64 KiB and then of their whole content, and every copy after the first is\n\
+        \tarchived as a hard link to it (tar extracts them as hard links), so it is neither compressed nor stored again.\n")
+#
+parser.add_argument('--time_budget', default=None, type=float, metavar="SECONDS", help="Choose the codec and level of every archive instead of using --codec: a sample of its content is compressed\n\
+        \twith gzip, zstd and xz at a few levels, and the one that saves the most bytes in the archive's share of SECONDS\n\
+        \t(the compression time the whole run may take, shared by bytes) is used; a cheaper level that saves almost as much\n\
+        \tis preferred, and content that does not compress is stored. --action_codec still fixes the codec of an action.\n\
+        \tThe choice, predicted and achieved ratio of every archive go to the summary log (##Codec_ lines).\n")
+#
+parser.add_argument('--validate', default="manifest", choices=["manifest", "full"], help="How an archive is validated before its source is deleted (default: manifest).\n\
+        \tmanifest: member list, sizes and CRC32s are recorded while the archive is written; the archive length, trailer\n\
+        \t          and member index are then checked without reading the archive back.\n\
+        \tfull:     additionally re-read the archive once and re-check the stream and every member CRC32.\n")
+#
+parser.add_argument('--log_json', action='store_true', help="Also write the logs as JSON Lines (reduce_size_*.all.jsonl and reduce_size_*.summary.jsonl).\n")
+#
+parser.add_argument('--profile', nargs='?', const="cprofile", default=None, choices=["cprofile", "sample"], help="Profile the run to find its hot paths; the report goes to reduce_size_*.profile.txt.\n\
+        \tcprofile (default): every function call, with some overhead. sample: the stack is sampled every 10 ms, which\n\
+        \tcosts almost nothing on long runs. --jobs worker processes are profiled too and merged into the report.\n")
+#
+parser.add_argument('--plan', action='store_true', help="Dry run: plan every delete/compress of the selected actions without touching anything.\n\
+        \tArchive sizes are estimated by compressing a bounded random sample of their bytes. The projected summary is printed\n\
+        \tand written to reduce_size_*.plan.summary.logs, every planned step to reduce_size_*.plan.all.logs, and the units\n\
+        \tto reduce_size_*.plan.json, which can be executed later with --from_plan.\n")
+#
+parser.add_argument('--from_plan', default=None, type=str, help="Execute the units of a reduce_size_*.plan.json written by --plan instead of searching --dir again.\n")
+#
+parser.add_argument('--resume', action='store_true', help="Resume an interrupted run from its journal: finished units are skipped without walking or validating them again,\n\
+        \tpartially written archives are removed and redone.\n")
+#
+parser.add_argument('--journal', default=None, type=str, help="Journal file of the run (default: --dir/reduce_size.journal.sqlite).\n")
+#
+parser.add_argument('--full_scan', action='store_true', help="Scan all of --dir instead of starting from the snapshot of the last run (--dir/reduce_size.snapshot.gz),\n\
+        \twhich only lists directories whose mtime or ctime changed since and skips unchanged ones the last run left nothing in.\n\
+        \tUse it after files were rewritten in place: their directories do not change, so their new sizes are only seen by a full scan.\n")
+#
+parser.add_argument('--low_memory', action='store_true', help="Scan, plan and run the top-level directories of --dir one at a time and drop each from the index once its units\n\
+        \tfinished, so the index only ever holds the largest of them. Ignores the snapshot and writes none (the next run scans all of --dir).\n")
+#
+parser.add_argument('--headroom', action='store_true', help="For nearly full disks: estimate the archive size of every unit, run the smallest first so they free space\n\
+        \tfor the big ones, give --jobs workers only units that fit in the free space (statvfs), and archive a directory\n\
+        \tthat might not fit in parts (see --chunk_size) whose sources are deleted part by part.\n")
+#
+parser.add_argument('--chunk_size', default=None, type=str, help="Archive directories larger than this (e.g. 50G) in validated parts of about this size:\n\
+        \tDIR.part001.tar.gz, DIR.part002.tar.gz, ... The sources of a part are deleted once it is validated, so at most one\n\
+        \tpart is extra on disk. Extracting every part restores the directory.\n")
+#
+parser.add_argument('--bundle_under', default=None, type=str, metavar="SIZE", help="Archive the units smaller than this (e.g. 100M) of one action in one directory together, in\n\
+        \tDIR/ACTION.bundle001.tar.gz, with one write, one validation and one deletion pass: for inode quotas, since\n\
+        \tthousands of small tmp_report_*, pcaer_*, report_* or danscore_* directories otherwise leave thousands of archives.\n\
+        \tEach unit in it can be listed and extracted by name with --ls/--extract and --member.\n")
+#
+parser.add_argument('--min_free', default="0", type=str, help="Free space (e.g. 10G) that --headroom leaves untouched (default: 0).\n")
+#
+parser.add_argument('--delete_threads', default=16, type=int, help="Threads issuing unlink/rmdir calls when many files are deleted (default: 16).\n\
+        \tOn a parallel filesystem a delete waits on a metadata server, so many calls in flight are much faster than one.\n")
+#
+parser.add_argument('--read_limit', default=None, type=str, metavar="RATE", help="Cap on the bytes per second read from source files and archives, e.g. 200M (default: none).\n\
+        \tWith --jobs each worker process gets an equal part of it; so do --write_limit and --ops_limit.\n")
+#
+parser.add_argument('--write_limit', default=None, type=str, metavar="RATE", help="Cap on the bytes per second written to archives, e.g. 100M (default: none).\n")
+#
+parser.add_argument('--ops_limit', default=None, type=int, help="Cap on the metadata operations per second: unlink, rmdir, and the entries scanned (default: none).\n")
+#
+parser.add_argument('--fair_share', action='store_true', help="For running on a shared filesystem next to other users' jobs: reads, writes and metadata operations\n\
+        \tback off when their latency rises well above the lowest seen (the filesystem is busy) and speed up again, up to\n\
+        \tthe limits above or without limit, once it is back to normal.\n")
+#
+parser.add_argument('--watch', nargs='?', const="auto", default=None, choices=["auto", "inotify", "poll"], help="Keep running and reduce the units that have not changed for --quiet_period, e.g. the output of running analyses\n\
+        \tonce they are finished. inotify: changes are reported by the kernel (Linux). poll: every directory is stat'ed each\n\
+        \t--watch_interval, which also sees what compute nodes write on GPFS/Lustre/NFS. auto (default): poll on those\n\
+        \tshared filesystems, inotify elsewhere. Stop it with Ctrl-C or SIGTERM: the totals and the snapshot are then written.\n")
+#
+parser.add_argument('--quiet_period', default=3600, type=float, help="With --watch: seconds a unit must stay unchanged before it is reduced (default: 3600).\n")
+#
+parser.add_argument('--watch_interval', default=60, type=float, help="With --watch: seconds between two looks for changes (default: 60).\n")
+#
+parser.add_argument('--log_deleted', action='store_true', help="Also log every deleted file (default: one DeletedFiles line per directory with its number of files and size).\n")
+#
+parser.add_argument('--ls', default=None, type=str, metavar="ARCHIVE", help="List the members of an archive written by this script from its manifest, without reading the archive.\n")
+#
+parser.add_argument('--extract', default=None, type=str, metavar="ARCHIVE", help="Extract members of an archive written by this script into --out (default: current directory).\n\
+        \tOnly the frames that hold the members are read and decompressed, found through the index in ARCHIVE.validated.\n")
+#
+parser.add_argument('--member', default=[], action='append', type=str, help="Member name or shell pattern to --extract (or --ls), e.g. \"resdaner/*chr21*\"; can be repeated (default: all).\n\
+        \tIn a --bundle_under archive the name of a unit, e.g. \"tmp_report_qc0\", selects the whole unit.\n")
+#
+parser.add_argument('--out', default=".", type=str, help="Directory --extract writes into (default: current directory).\n")
+#
+parser.add_argument('--shards', default=1, type=int, help="Split the units of a --from_plan plan into this many shards of about equal bytes, for cluster job arrays.\n\
+        \tOverlapping units stay in one shard. Each task runs one shard (--shard_index) with its own logs and journal\n\
+        \t(reduce_size_<plan time>.shard<I>of<N>.*); --merge_shards combines them afterwards.\n")
+#
+parser.add_argument('--shard_index', default=None, type=int, help="Shard this task runs, 0 to --shards - 1 (default: $SLURM_ARRAY_TASK_ID minus $SLURM_ARRAY_TASK_MIN).\n")
+#
+parser.add_argument('--merge_shards', action='store_true', help="After every shard of --from_plan has finished: delete the empty files (the size-zero unit covers\n\
+        \tthe whole tree, so no shard runs it) and write the usual summary log with the totals of all shards.\n")
+#
+parser.add_argument('--jobs', '-j', default=1, type=int, help="Number of directories to compress-validate-delete in parallel worker processes (default: 1).\n\
+        \tA directory and its sub-directories (e.g. \"daner_*\" and a \"dasuqc1_*/qc1f\" inside it) are never processed at the same time.\n")
 
 filestamp=datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+tree_index=None
+compress_threads=1
+dry_run=False
+journal=None
+validate_mode="manifest"
+log_capture=None  # set inside worker processes: log lines are sent back to the main process instead of written
+log_json=False
+log_tag=""  # ".plan" for --plan runs, so a plan never mixes with the logs of a real run
+default_codec=None
+action_codecs={}  # --action_codec: action name (or action/sub-directory) -> codec
+recompress=False
+dedup=True  # --no_dedup turns it off
+bundle_limit=None  # --bundle_under in bytes
+bundling=None  # inside reduce_bundle: the units whose archive is left to it
+time_budget=None  # --time_budget in seconds
+time_per_byte=None  # compression seconds the budget allows per source byte, set once the units are known
+headroom=False
+chunk_size=None
+min_free=0
+delete_threads=16
+log_deleted=False
+profile_mode=None  # --profile: "cprofile" or "sample"
+profiler=None  # this process's cProfile.Profile or StackSampler
 class Logger(object):
-    def __init__(self, fh):
+    ## one persistent, buffered handle per log file; the buffer is written out once it holds flush_bytes or is
+    ## older than flush_seconds, and by flush_logs() at exit, on SIGTERM and before forking worker processes
+    def __init__(self, fh, flush_bytes=1<<16, flush_seconds=2.0):
         self.log_fh = open(fh, 'a')
-    def log(self, line, summary=None):
+        self.lock=threading.Lock()
+        self.buffer=[]; self.buffered=0
+        self.flush_bytes=flush_bytes; self.flush_seconds=flush_seconds
+        self.last_flush=time.monotonic()
+    @staticmethod
+    def format(line, summary=None):
         TODAY_YMD = '_'.join(datetime.datetime.today().strftime("%c").split())
         if summary=="_":
-            self.log_fh.write(f"{line}\n")
+            return f"{line}\n"
         elif summary=="0":
-            self.log_fh.write(f"##{line}_{TODAY_YMD}\n##Version: {__version__}\n")
+            return f"##{line}_{TODAY_YMD}\n##Version: {__version__}\n"
         elif summary=="1":
-            self.log_fh.write(f"##Version: {__version__}\n##{line}\n")
+            return f"##Version: {__version__}\n##{line}\n"
         else:
-            self.log_fh.write(f"{TODAY_YMD}\t{line}\n")
-
-def write_logs(line, summary=None):
-    if summary=="_":
-        logger_object = Logger(f'{global_path}/reduce_size_{filestamp}.summary.logs')
-        logger_object.log(f"{line}","_")
-    elif summary=="0":
-        logger_object = Logger(f'{global_path}/reduce_size_{filestamp}.all.logs')
-        logger_object.log(f"{line}","0")
-    elif summary=="1":
-        logger_object = Logger(f'{global_path}/reduce_size_{filestamp}.all.logs')
-        logger_object.log(f"{line}","1")
+            return f"{TODAY_YMD}\t{line}\n"
+    def log(self, line, summary=None):
+        self.write(self.format(line, summary))
+    def write(self, text):
+        with self.lock:
+            self.buffer.append(text); self.buffered+=len(text)
+            if self.buffered>=self.flush_bytes or time.monotonic()-self.last_flush>=self.flush_seconds:
+                self._flush()
+    def _flush(self):
+        if self.buffer:
+            self.log_fh.write(''.join(self.buffer))
+            self.log_fh.flush()
+            self.buffer=[]; self.buffered=0
+        self.last_flush=time.monotonic()
+    def flush(self):
+        with self.lock:
+            self._flush()
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.log_fh.close()
+
+loggers={}
+loggers_lock=threading.Lock()
+def get_logger(logfile):
+    with loggers_lock:
+        logger_object=loggers.get(logfile)
+        if logger_object is None:
+            logger_object=loggers[logfile]=Logger(logfile)
+        return logger_object
+
+def flush_logs():
+    for logger_object in list(loggers.values()):
+        logger_object.flush()
+
+def close_logs():
+    for logger_object in list(loggers.values()):
+        logger_object.close()
+    loggers.clear()
+
+def _forget_logs_in_child():
+    ## a forked worker must never write the parent's buffered lines a second time
+    global loggers, loggers_lock
+    loggers={}; loggers_lock=threading.Lock()
+
+def flush_logs_periodically(interval=2.0):
+    while True:
+        time.sleep(interval)
+        flush_logs()
+
+atexit.register(close_logs)
+os.register_at_fork(before=flush_logs, after_in_child=_forget_logs_in_child)
+
+def log_record(line, summary=None, fields=None):
+    ## JSON Lines twin of a log line for loading run results into dashboards
+    record={"time": datetime.datetime.now().isoformat(timespec="seconds"), "log": "summary" if summary=="_" else "all"}
+    if fields is not None:
+        record.update(fields)
     else:
-        logger_object = Logger(f'{global_path}/reduce_size_{filestamp}.all.logs')
-        logger_object.log(f"{line}")
+        values=line.lstrip('#').split('\t')
+        record["event"]=values[0]
+        if len(values)>1:
+            record["detail"]=values[1:]
+    return json.dumps(record)+"\n"
+
+def log_path(kind):
+    return f'{global_path}/reduce_size_{filestamp}{log_tag}.{kind}.logs'
+
+def write_logs(line, summary=None, fields=None):
+    logfile=log_path("summary" if summary=="_" else "all")
+    entries=[(logfile, Logger.format(f"{line}", summary))]
+    if log_json:
+        entries.append((logfile[:-len(".logs")]+".jsonl", log_record(f"{line}", summary, fields)))
+    for logfile, text in entries:
+        if log_capture is not None:
+            log_capture.append((logfile, text))
+        else:
+            get_logger(logfile).write(text)
+
+def write_summary(label, before, after, path):
+    ## one TSV row of the summary log; before/after are (size, files, allocated bytes)
+    size, count, alloc=before; rsize, rcount, ralloc=after
+    fields={"action": label, "size_before": size, "files_before": count, "size_after": rsize, "files_after": rcount,
+            "path": str(path), "alloc_before": alloc, "alloc_after": ralloc}
+    write_logs(f"{label}\t{convert_bytes(size)}\t{count}\t{convert_bytes(rsize)}\t{rcount}\t{path}\t{convert_bytes(alloc)}\t{convert_bytes(ralloc)}", "_", fields)
+
+def cpu_seconds():
+    ## user+system time of this process and its finished children (pigz, zstd, xz, tar)
+    return sum(os.times()[:4])
+
+class Phases(object):
+    ## [wall seconds, CPU seconds, bytes read, bytes written, files touched] per phase, for the whole run and for
+    ## the unit running now. A phase entered inside another one (a rescan during a deletion) counts to the outer one.
+    NAMES=("traversal", "accounting", "compression", "validation", "deletion")
+    def __init__(self):
+        self.total={name: [0.0, 0.0, 0, 0, 0] for name in self.NAMES}
+        self.unit={name: [0.0, 0.0, 0, 0, 0] for name in self.NAMES}
+        self.active=None
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        if self.active is not None:
+            yield
+            return
+        self.active=name
+        wall=time.perf_counter(); cpu=cpu_seconds()
+        try:
+            yield
+        finally:
+            self.active=None
+            self.add(name, [time.perf_counter()-wall, cpu_seconds()-cpu, 0, 0, 0])
+
+    @contextlib.contextmanager
+    def step(self, name):
+        ## one step of a generator consumed inside another phase (a walk that feeds a deletion): its time moves
+        ## from that phase to this one
+        if self.active is None or self.active==name:
+            with self(name):
+                yield
+            return
+        wall=time.perf_counter(); cpu=cpu_seconds()
+        try:
+            yield
+        finally:
+            spent=[time.perf_counter()-wall, cpu_seconds()-cpu, 0, 0, 0]
+            self.add(name, spent); self.add(self.active, [-value for value in spent])
+
+    def add(self, name, values):
+        for spent in (self.total[name], self.unit[name]):
+            for i, value in enumerate(values):
+                spent[i]+=value
+
+    def count(self, name, read=0, written=0, files=0):
+        self.add(name, [0, 0, read, written, files])
+
+    def take_unit(self):
+        spent={name: values for name, values in self.unit.items() if any(values)}
+        self.unit={name: [0.0, 0.0, 0, 0, 0] for name in self.NAMES}
+        return spent
+
+    def timed(self, name):
+        ## decorator: the function's calls count to the phase; for a generator, every step until it yields
+        def decorate(function):
+            def timed_function(*args, **kwargs):
+                with self(name):
+                    return function(*args, **kwargs)
+            def timed_generator(*args, **kwargs):
+                generator=function(*args, **kwargs)
+                while True:
+                    with self.step(name):
+                        try:
+                            value=next(generator)
+                        except StopIteration:
+                            return
+                    yield value
+            if inspect.isgeneratorfunction(function):
+                timed_function=timed_generator
+            timed_function.__name__=function.__name__
+            return timed_function
+        return decorate
+
+    def merge(self, spent):
+        ## a unit that ran in a worker process
+        for name, values in spent.items():
+            for i, value in enumerate(values):
+                self.total[name][i]+=value
+
+phases=Phases()
+
+def throughput(wall, read, files):
+    ## MB/s for phases that read data, metadata operations/s for the others
+    if wall<=0:
+        return "NA"
+    if read:
+        return f"{read/wall/(1<<20):.1f}MB/s"
+    return f"{files/wall:.0f}ops/s" if files else "NA"
+
+def write_unit_phases(name, path, spent):
+    ## one all.logs line per unit with the phases it spent time in
+    text="\t".join(f"{phase} {wall:.2f}s cpu {cpu:.2f}s read {convert_bytes(read)} written {convert_bytes(written)} files {files}"
+                   for phase, (wall, cpu, read, written, files) in spent.items())
+    write_logs(f"Phases_{name}\t{path}\t{text}", fields={"event": f"Phases_{name}", "path": str(path),
+               "phases": {phase: dict(zip(("wall", "cpu", "read", "written", "files"), values)) for phase, values in spent.items()}})
+
+def write_phase_summary():
+    write_logs("##PHASE\tWALL\tCPU\tREAD\tWRITTEN\tFILES\tTHROUGHPUT", "_", {"event": "phases_header"})
+    for phase, (wall, cpu, read, written, files) in phases.total.items():
+        write_logs(f"##Phase_{phase}\t{wall:.2f}s\t{cpu:.2f}s\t{convert_bytes(read)}\t{convert_bytes(written)}\t{files}\t{throughput(wall, read, files)}", "_",
+                   {"phase": phase, "wall": wall, "cpu": cpu, "read": read, "written": written, "files": files})
+
+class StackSampler(object):
+    ## statistical profiler: the main thread's stack is sampled every interval; samples with a function innermost
+    ## are its own time, samples with it anywhere on the stack its cumulative time. Like cProfile it only records
+    ## between enable() and disable(), and a stack ends at the function that called enable(): a --jobs worker
+    ## records its units from run_unit down, not the parent's frames it inherited at the fork nor its idle time
+    def __init__(self, interval=0.01):
+        self.interval=interval
+        self.thread_id=threading.current_thread().ident
+        self.own=collections.Counter(); self.cumulative=collections.Counter(); self.samples=0
+        self.lock=threading.Lock()
+        self.top=None; self.enabled=False
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def enable(self):
+        self.top=sys._getframe(1).f_code; self.enabled=True
+
+    def disable(self):
+        self.enabled=False
+
+    @staticmethod
+    def _name(code):
+        return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frame=sys._current_frames().get(self.thread_id) if self.enabled else None
+            if frame is None:
+                continue
+            names=[]
+            while frame is not None:
+                names.append(self._name(frame.f_code))
+                frame=None if frame.f_code is self.top else frame.f_back
+            with self.lock:
+                self.samples+=1
+                self.own[names[0]]+=1
+                self.cumulative.update(set(names))
+
+    def dump_stats(self, path):
+        with self.lock:
+            data={"interval": self.interval, "samples": self.samples, "own": dict(self.own), "cumulative": dict(self.cumulative)}
+        with open(path, "w") as fh:
+            json.dump(data, fh)
+
+def profile_path():
+    return f'{global_path}/reduce_size_{filestamp}{log_tag}.profile'
+
+def start_profiler():
+    ## a forked worker gets its own profiler; the one copied from the main process is switched off
+    if profiler is not None:
+        profiler.disable()
+    new_profiler=cProfile.Profile() if profile_mode=="cprofile" else StackSampler()
+    new_profiler.pid=os.getpid()
+    return new_profiler
+
+def write_profile_report(top=40):
+    ## merge the main process's profile with those the --jobs workers dumped into one text report
+    base=profile_path()
+    profiler.disable()
+    profiler.dump_stats(base)
+    worker=re.compile(re.escape(os.path.basename(base))+r"\.\d+$")
+    dumps=[base]+sorted(os.path.join(os.path.dirname(base), name) for name in os.listdir(os.path.dirname(base)) if worker.match(name))
+    with open(f"{base}.txt", "w") as report:
+        if profile_mode=="cprofile":
+            stats=pstats.Stats(*dumps, stream=report)
+            stats.sort_stats("cumulative").print_stats(top)
+            stats.sort_stats("tottime").print_stats(top)
+        else:
+            own=collections.Counter(); cumulative=collections.Counter(); samples=0
+            for dump in dumps:
+                with open(dump) as fh:
+                    data=json.load(fh)
+                own.update(data["own"]); cumulative.update(data["cumulative"]); samples+=data["samples"]
+                interval=data["interval"]
+            for title, counter in (("cumulative", cumulative), ("own", own)):
+                report.write(f"{samples} samples every {interval}s in {len(dumps)} processes, by {title} time\n{'seconds':>10}  {'share':>6}  function\n")
+                for name, count in counter.most_common(top):
+                    report.write(f"{count*interval:10.2f}  {count/max(samples, 1):6.1%}  {name}\n")
+                report.write("\n")
+    for dump in dumps[1:]:
+        os.remove(dump)
+    write_logs(f"Profile\t{base}.txt")
 
 
 def convert_bytes(size_bytes):
@@ -96,107 +532,1407 @@ def convert_bytes(size_bytes):
     s = round(size_bytes / p, 2)
     return "%s%s" % (s, size_name[i])
 
+@phases.timed("accounting")
+def get_stats(path):
+    ## (apparent size, number of files, allocated bytes) of a file or a whole directory tree, answered from the
+    ## bottom-up totals kept in the index instead of re-walking the directory
+    entry=tree_index.get(path) if path else None
+    if entry is None:
+        return 0, 0, 0
+    return entry.tsize, entry.tfiles, entry.tblocks
+
 def count_files(path):
-    if os.path.islink(path):
-        return 0
-    elif os.path.isdir(path):
-        count = 0
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                file=os.path.join(root, file)
-                if os.path.isfile(file):
-                    count += 1
-        return count
-    elif os.path.isfile(path):
-        return 1
-    else:
-        return 0
+    return get_stats(path)[1]
 
 def get_size(path):
-    try:
-        if os.path.isfile(path):
-            size=os.path.getsize(path)
-            return size
+    return get_stats(path)[0]
 
-        elif os.path.isdir(path):
-            total_size = 0
-            for root, dirnames, filenames in os.walk(path):
-                for filename in filenames:
-                    file_path = os.path.join(root, filename)
-                    try:
-                        total_size += os.path.getsize(file_path)
-                    except FileNotFoundError:
-                        pass
-            return total_size
-    except ValueError:
-        write_logs(f"NotValid\t{path}")
-        return 0
 
+class IndexEntry(object):
+    ## tsize/tfiles/tblocks are the totals of the entry itself plus everything below it;
+    ## stamp: (mtime_ns, ctime_ns) of a directory, which change whenever an entry is added, removed or renamed in it
+    __slots__=("name", "parent", "is_dir", "is_link", "is_file", "size", "mtime", "children", "tsize", "tfiles", "tblocks", "blocks", "stamp")
+    def __init__(self, name, parent, is_dir, is_link, is_file, size, mtime, blocks, stamp=None):
+        self.name=name; self.parent=parent
+        self.is_dir=is_dir; self.is_link=is_link; self.is_file=is_file
+        self.size=size; self.mtime=mtime; self.blocks=blocks; self.stamp=stamp
+        self.children={} if (is_dir and not is_link) else None
+        self.tsize=size; self.tfiles=1 if is_file else 0; self.tblocks=blocks
+
+class TreeIndex(object):
+    ## One os.scandir pass over --dir; every matcher runs against this in-memory copy of the tree and
+    ## deletions/compressions update it, so later actions never walk the disk again.
+    def __init__(self, root, subtrees=None):
+        ## subtrees: only scan these paths below root (a --resume run skips everything already finished)
+        self.root=os.path.normpath(str(root))
+        self.entries={}
+        self.changes=None  # list of ("add"|"remove", path) while running inside a worker process
+        self.skip=set()  # from a snapshot: unchanged directories in which the last run's matchers left nothing to do
+        self.snapshot_actions=set()
+        self.loaded_from_snapshot=False
+        self.touched=set()  # directories this run added entries to or removed entries from
+        if subtrees is None:
+            self.add(self.root)
+        else:
+            st=os.stat(self.root)
+            self.entries[self.root]=IndexEntry(os.path.basename(self.root), os.path.dirname(self.root), True, False, False, 0, st.st_mtime, st.st_blocks*512)
+            for subtree in subtrees:
+                self.add(subtree)
+
+    def _entry_from_dirent(self, dirent, parent):
+        try:
+            is_link=dirent.is_symlink()
+            is_dir=dirent.is_dir()
+            is_file=dirent.is_file()
+            st=dirent.stat() if (is_file or is_dir) else dirent.stat(follow_symlinks=False)
+            blocks=dirent.stat(follow_symlinks=False).st_blocks*512 if is_link else st.st_blocks*512
+            stamp=(st.st_mtime_ns, st.st_ctime_ns) if is_dir and not is_link else None
+            return IndexEntry(dirent.name, parent, is_dir, is_link, is_file, st.st_size if is_file else 0, st.st_mtime, blocks, stamp)
+        except OSError:
+            return IndexEntry(dirent.name, parent, False, True, False, 0, 0, 0)
+
+    def _scan(self, top):
+        with phases("traversal"):
+            scanned=self._scan_tree(top)
+        phases.count("traversal", files=scanned)
+
+    def _scan_tree(self, top):
+        ## returns the number of entries scanned
+        stack=[top]; dirs=[]; scanned=0
+        while stack:
+            dirpath=stack.pop()
+            dirs.append(dirpath)
+            children=self.entries[dirpath].children
+            start=time.perf_counter(); listed=scanned
+            try:
+                with os.scandir(dirpath) as it:
+                    for dirent in it:
+                        entry=self._entry_from_dirent(dirent, dirpath)
+                        scanned+=1
+                        child=os.path.join(dirpath, dirent.name)
+                        self.entries[child]=entry
+                        children[dirent.name]=None
+                        if entry.children is not None:
+                            stack.append(child)
+            except OSError:
+                pass
+            ## the listing and a stat per entry
+            ops_throttle.charge(1+scanned-listed, time.perf_counter()-start, "scandir")
+        ## children are always scanned after their parent, so the reversed scan order aggregates bottom-up
+        for dirpath in reversed(dirs):
+            entry=self.entries[dirpath]
+            for name in entry.children:
+                child=self.entries[os.path.join(dirpath, name)]
+                entry.tsize+=child.tsize; entry.tfiles+=child.tfiles; entry.tblocks+=child.tblocks
+        return scanned
+
+    def _propagate(self, entry, sign):
+        parent_path=entry.parent
+        while parent_path in self.entries:
+            parent=self.entries[parent_path]
+            parent.tsize+=sign*entry.tsize; parent.tfiles+=sign*entry.tfiles; parent.tblocks+=sign*entry.tblocks
+            if parent_path==self.root:
+                break
+            parent_path=parent.parent
+
+    def add(self, path):
+        path=os.path.normpath(str(path))
+        if path in self.entries:
+            self.remove(path)
+        try:
+            st=os.stat(path)
+            is_link=os.path.islink(path)
+        except OSError:
+            return None
+        is_dir=stat.S_ISDIR(st.st_mode); is_file=stat.S_ISREG(st.st_mode)
+        if self.changes is not None:
+            self.changes.append(("add", path))
+        parent=os.path.dirname(path)
+        entry=IndexEntry(os.path.basename(path), parent, is_dir, is_link, is_file, st.st_size if is_file else 0, st.st_mtime, st.st_blocks*512,
+                         (st.st_mtime_ns, st.st_ctime_ns) if is_dir and not is_link else None)
+        self.entries[path]=entry
+        if entry.children is not None:
+            self._scan(path)
+        if parent in self.entries and path!=self.root:
+            self.entries[parent].children[entry.name]=None
+            self._propagate(entry, 1)
+            self.touched.add(parent)
+        return entry
+
+    def remove(self, path):
+        path=os.path.normpath(str(path))
+        entry=self.entries.pop(path, None)
+        if entry is None:
+            return
+        if self.changes is not None:
+            self.changes.append(("remove", path))
+        self._propagate(entry, -1)
+        parent=self.entries.get(entry.parent)
+        if parent is not None and parent.children is not None:
+            parent.children.pop(entry.name, None)
+            self.touched.add(entry.parent)
+        stack=[path] if entry.children else []
+        children={path: entry.children}
+        while stack:
+            dirpath=stack.pop()
+            for name in children.pop(dirpath):
+                child=os.path.join(dirpath, name)
+                sub=self.entries.pop(child, None)
+                if sub is not None and sub.children:
+                    children[child]=sub.children
+                    stack.append(child)
+
+    def top_level(self):
+        ## for a streamed run (an index made with subtrees=[]): index the entries right in root, without anything below
+        ## its directories, and return those directories, which add() then scans one at a time
+        root=self.entries[self.root]; dirs=[]
+        with os.scandir(self.root) as it:
+            for dirent in it:
+                entry=self._entry_from_dirent(dirent, self.root)
+                if entry.children is not None:
+                    dirs.append(os.path.join(self.root, dirent.name))
+                    continue
+                self.entries[os.path.join(self.root, dirent.name)]=entry
+                root.children[dirent.name]=None
+                self._propagate(entry, 1)
+        return sorted(dirs)
+
+    def collapse(self, path):
+        ## --low_memory: forget everything below a finished directory; its entry keeps the totals, so get_stats of it
+        ## and of --dir stay right
+        path=os.path.normpath(str(path))
+        entry=self.entries[path]
+        stack=[path]
+        while stack:
+            dirpath=stack.pop()
+            children=self.entries[dirpath].children if dirpath==path else self.entries.pop(dirpath).children
+            for name in children or ():
+                child=os.path.join(dirpath, name)
+                if self.entries[child].children is not None:
+                    stack.append(child)
+                else:
+                    del self.entries[child]
+        entry.children={}
+        self.touched={p for p in self.touched if not p.startswith(os.path.join(path, ""))}
+
+    def add_virtual(self, path, size):
+        ## an entry that only exists in the index (a projected archive in --plan mode)
+        path=os.path.normpath(str(path))
+        self.remove(path)
+        parent=os.path.dirname(path)
+        entry=IndexEntry(os.path.basename(path), parent, False, False, True, size, time.time(), -(-size//4096)*4096)
+        self.entries[path]=entry
+        if parent in self.entries:
+            self.entries[parent].children[entry.name]=None
+            self._propagate(entry, 1)
+        return entry
 
-def find_files_or_dirs(path, pattern):
-    matching_paths = []
-    for root, dirs, files in os.walk(path):
+    def apply(self, changes):
+        for change, path in changes:
+            if change=="remove":
+                self.remove(path)
+            else:
+                self.add(path)
+
+    def get(self, path):
+        return self.entries.get(os.path.normpath(str(path)))
+
+    def exists(self, path):
+        return self.get(path) is not None
+
+    def isdir(self, path):
+        entry=self.get(path)
+        return entry is not None and entry.is_dir
+
+    def listdir(self, path):
+        path=os.path.normpath(str(path))
+        entry=self.entries.get(path)
+        if entry is None or entry.children is None:
+            return []
+        return [os.path.join(path, name) for name in entry.children]
+
+    def walk(self, path, prune=False):
+        ## same top-down order as os.walk(path): (root, dirs, files) without following symlinked dirs;
+        ## prune: do not descend into the settled directories of a snapshot (self.skip)
+        path=os.path.normpath(str(path))
+        entry=self.entries.get(path)
+        if entry is None or entry.children is None:
+            return
+        ## the consumer may delete what was yielded before the walk goes on (a streamed deletion)
+        stack=[path]
+        while stack:
+            root=stack.pop()
+            entry=self.entries.get(root)
+            if entry is None:
+                continue
+            dirs=[]; files=[]
+            for name in entry.children:
+                (dirs if self.entries[os.path.join(root, name)].is_dir else files).append(name)
+            yield root, dirs, files
+            stack.extend(os.path.join(root, name) for name in reversed(dirs) if getattr(self.entries.get(os.path.join(root, name)), "children", None) is not None
+                         and not (prune and os.path.join(root, name) in self.skip))
+
+    @classmethod
+    def from_snapshot(cls, root, snapshot_file):
+        ## the index of the last run brought up to date: every directory is stat'ed once, but only directories whose
+        ## mtime or ctime changed (and new ones) are listed again, so the cost follows what changed, not the tree size.
+        ## A file rewritten in place does not change its directory; its size is the one of the last run.
+        ## None when there is no usable snapshot.
+        root=os.path.normpath(str(root))
+        index=cls.__new__(cls)
+        index.root=root; index.entries={}; index.changes=None; index.touched=set()
+        settled=set()
+        try:
+            with gzip.open(snapshot_file, "rt") as fh:
+                header=json.loads(fh.readline())
+                if header.get("root")!=root or header.get("format")!=1:
+                    return None
+                with phases("traversal"):
+                    for line in fh:
+                        values=json.loads(line)
+                        path=root if values[0]=="." else os.path.join(root, values[0])
+                        flags=values[1]
+                        entry=IndexEntry(os.path.basename(path), os.path.dirname(path), bool(flags&1), bool(flags&2), bool(flags&4),
+                                         values[2], values[3], values[4], tuple(values[5:7]) if len(values)>5 else None)
+                        index.entries[path]=entry
+                        if path!=root:
+                            index.entries[entry.parent].children[entry.name]=None
+                        if len(values)>7 and values[7]:
+                            settled.add(path)
+        except (OSError, ValueError, KeyError, IndexError, EOFError):
+            return None
+        if root not in index.entries:
+            return None
+        changed=index._refresh()
+        if root not in index.entries:
+            return None
+        ## a directory is only skipped by the matchers when nothing changed anywhere below it
+        dirty=set()
+        for path in changed:
+            while path not in dirty:
+                dirty.add(path)
+                if path==root:
+                    break
+                path=os.path.dirname(path)
+        index.skip={path for path in settled if path not in dirty and path in index.entries}
+        index.snapshot_actions=set(header.get("actions", []))
+        index.loaded_from_snapshot=True
+        index._total(root)
+        write_logs(f"Snapshot\t{snapshot_file}\t{len(changed)} changed directories\t{len(index.skip)} settled directories")
+        return index
+
+    def _refresh(self, dirs=None, below=None):
+        ## stat every directory of the snapshot; list again the ones that changed. dirs: list these again (the
+        ## directories inotify reported) and look no further down. below: stat only these directories and what is
+        ## under them (the ones --watch polls). Returns the changed directories
+        changed=[]; stack=list(dirs if dirs is not None else below if below is not None else [self.root]); checked=0
+        forced=set() if dirs is None else set(stack)
+        with phases("traversal"):
+            while stack:
+                dirpath=stack.pop()
+                entry=self.entries.get(dirpath)
+                if entry is None:
+                    continue
+                checked+=1
+                try:
+                    st=os.lstat(dirpath)
+                except OSError:
+                    self.remove(dirpath); changed.append(os.path.dirname(dirpath))
+                    continue
+                if not stat.S_ISDIR(st.st_mode):
+                    self.add(dirpath); changed.append(os.path.dirname(dirpath))
+                    continue
+                if (st.st_mtime_ns, st.st_ctime_ns)==entry.stamp and dirpath not in forced:
+                    stack.extend(child for child in (os.path.join(dirpath, name) for name in entry.children) if self.entries[child].children is not None)
+                    continue
+                changed.append(dirpath)
+                self._propagate(entry, -1)
+                entry.tblocks+=st.st_blocks*512-entry.blocks
+                entry.stamp=(st.st_mtime_ns, st.st_ctime_ns); entry.mtime=st.st_mtime; entry.blocks=st.st_blocks*512
+                self._propagate(entry, 1)
+                seen=set()
+                try:
+                    with os.scandir(dirpath) as it:
+                        for dirent in it:
+                            checked+=1
+                            seen.add(dirent.name)
+                            child=os.path.join(dirpath, dirent.name)
+                            new=self._entry_from_dirent(dirent, dirpath)
+                            old=self.entries.get(child)
+                            if old is not None and (old.is_dir, old.is_link, old.is_file)==(new.is_dir, new.is_link, new.is_file):
+                                if old.children is not None:
+                                    if dirs is None:
+                                        stack.append(child)
+                                elif (old.size, old.blocks)!=(new.size, new.blocks):
+                                    self._propagate(old, -1)
+                                    old.tsize=old.size=new.size; old.tblocks=old.blocks=new.blocks
+                                    self._propagate(old, 1)
+                                old.mtime=new.mtime
+                                continue
+                            if new.children is not None:
+                                self.add(child); changed.append(child)
+                            else:
+                                self.remove(child)
+                                self.entries[child]=new; entry.children[dirent.name]=None
+                                self._propagate(new, 1)
+                except OSError:
+                    pass
+                for name in [name for name in entry.children if name not in seen]:
+                    self.remove(os.path.join(dirpath, name))
+        phases.count("traversal", files=checked)
+        return changed
+
+    def _total(self, top):
+        ## recompute tsize/tfiles/tblocks of top and everything below it, bottom-up
+        dirs=[]; stack=[top]
+        while stack:
+            dirpath=stack.pop()
+            dirs.append(dirpath)
+            for name in self.entries[dirpath].children:
+                child=self.entries[os.path.join(dirpath, name)]
+                child.tsize=child.size; child.tfiles=1 if child.is_file else 0; child.tblocks=child.blocks
+                if child.children is not None:
+                    stack.append(os.path.join(dirpath, name))
+        entry=self.entries[top]
+        entry.tsize=entry.size; entry.tfiles=1 if entry.is_file else 0; entry.tblocks=entry.blocks
+        for dirpath in reversed(dirs):
+            entry=self.entries[dirpath]
+            for name in entry.children:
+                child=self.entries[os.path.join(dirpath, name)]
+                entry.tsize+=child.tsize; entry.tfiles+=child.tfiles; entry.tblocks+=child.tblocks
+
+    def write_snapshot(self, snapshot_file, actions, units):
+        ## path, type, size, mtime and blocks of every entry, top-down; directories also get their stamp and whether
+        ## they are settled: no unit of this run is left in, at or above them (a unit that failed or, like
+        ## cobg_dir_genome_wide, stays in place is matched again next time)
+        left=[os.path.normpath(str(p)) for name, p in units if ACTION_BY_NAME[name].report!="count" and self.exists(p)]
+        unsettled=set()
+        for path in left:
+            unsettled.update(root for root, dirs, files in self.walk(path))
+            while True:
+                unsettled.add(path)
+                if path==self.root or os.path.dirname(path)==path:
+                    break
+                path=os.path.dirname(path)
+        ## the directories this run changed, and --dir with its new log files, are listed again so the snapshot holds
+        ## their stamps as they are now, not from the start of the run. The snapshot is created first and then
+        ## rewritten in place, which leaves the stamp of --dir alone (an interrupted write is an unusable snapshot,
+        ## so the next run scans everything)
+        if not os.path.exists(snapshot_file):
+            open(snapshot_file, "ab").close()
+        self._refresh(sorted(self.touched|{self.root}))
+        self.touched=set()
+        with gzip.open(snapshot_file, "wt", compresslevel=1) as fh:
+            fh.write(json.dumps({"format": 1, "version": __version__, "root": self.root, "created": filestamp, "actions": sorted(actions)})+"\n")
+            def line(path):
+                entry=self.entries[path]
+                flags=(1 if entry.is_dir else 0)|(2 if entry.is_link else 0)|(4 if entry.is_file else 0)
+                values=[os.path.relpath(path, self.root), flags, entry.size, entry.mtime, entry.blocks]
+                if entry.children is not None:
+                    values+=[*(entry.stamp or (0, 0)), int(path not in unsettled)]
+                return json.dumps(values)+"\n"
+            fh.write(line(self.root))
+            for root, dirs, files in self.walk(self.root):
+                for name in dirs+files:
+                    fh.write(line(os.path.join(root, name)))
+
+@phases.timed("traversal")
+def find_files_or_dirs(path, pattern, prune=False):
+    ## yields the matches as the walk finds them, so a deletion can start on the first one;
+    ## prune: skip the settled directories of a snapshot, for the matchers that plan the units
+    regex=re.compile(pattern)
+    for root, dirs, files in tree_index.walk(path, prune):
         for filename in files + dirs:
-            if re.search(pattern, filename):
-                matching_paths.append(os.path.join(root, filename))
-    return matching_paths
+            if regex.search(filename):
+                yield os.path.join(root, filename)
+
+class BlockGzipWriter(object):
+    ## in-process multi-threaded gzip: the stream is cut into blocks that a thread pool compresses as independent
+    ## gzip members (zlib releases the GIL); concatenated members are a standard .gz that gunzip/tar read as one file
+    def __init__(self, out_fh, threads=1, level=6, block_size=1<<20):
+        self.out_fh=out_fh; self.level=level; self.block_size=block_size
+        self.buffer=bytearray(); self.offset=0
+        self.pool=concurrent.futures.ThreadPoolExecutor(max_workers=threads) if threads>1 else None
+        self.pending=collections.deque(); self.max_pending=2*threads
+        self.points=[]  # (stream offset, archive offset) of every member, when the output can tell its position
+        self.written=0
+
+    def _compress(self, block):
+        return gzip.compress(block, compresslevel=self.level, mtime=0)
+
+    def _output(self, member):
+        if hasattr(self.out_fh, "tell"):
+            self.points.append([self.written, self.out_fh.tell()])
+        self.out_fh.write(member[1])
+        self.written+=member[0]
+
+    def _submit(self, block):
+        if self.pool is None:
+            self._output((len(block), self._compress(block)))
+            return
+        self.pending.append((len(block), self.pool.submit(self._compress, block)))
+        while len(self.pending)>=self.max_pending:
+            size, future=self.pending.popleft()
+            self._output((size, future.result()))
+
+    def write(self, data):
+        self.buffer+=data; self.offset+=len(data)
+        while len(self.buffer)>=self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        if self.buffer or self.offset==0:
+            self._submit(bytes(self.buffer))
+            self.buffer=bytearray()
+        while self.pending:
+            size, future=self.pending.popleft()
+            self._output((size, future.result()))
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.out_fh.close()
+
+class CommandWriter(object):
+    ## streams into an external compressor (pigz, zstd, xz); its output is copied to the archive by a thread so it
+    ## can be checksummed
+    def __init__(self, out_fh, command):
+        self.out_fh=out_fh; self.offset=0; self.command=command
+        self.proc=subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.copier=threading.Thread(target=shutil.copyfileobj, args=(self.proc.stdout, out_fh, 1<<20), daemon=True)
+        self.copier.start()
+
+    def write(self, data):
+        self.proc.stdin.write(data); self.offset+=len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        self.proc.stdin.close()
+        returncode=self.proc.wait()
+        self.copier.join()
+        self.out_fh.close()
+        if returncode!=0:
+            raise OSError(f"{self.command[0]} exited with {returncode}")
+
+class StreamWriter(object):
+    ## compressor object running in this process (lzma, zstandard); without one the bytes are stored as they are
+    def __init__(self, out_fh, compressor=None):
+        self.out_fh=out_fh; self.compressor=compressor; self.offset=0
+
+    def write(self, data):
+        self.out_fh.write(self.compressor.compress(data) if self.compressor is not None else data)
+        self.offset+=len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        if self.compressor is not None:
+            self.out_fh.write(self.compressor.flush())
+        self.out_fh.close()
+
+class ArchiveSink(object):
+    ## the archive file as it is written: byte count, CRC32 and trailing bytes of the compressed stream,
+    ## so the archive can later be checked without decompressing it
+    def __init__(self, path):
+        self.fh=open(path, "wb")
+        self.size=0; self.crc=0; self.tail=b""
+
+    def write(self, data):
+        write_throttle.call(self.fh.write, data)
+        self.size+=len(data); self.crc=zlib.crc32(data, self.crc)
+        self.tail=(self.tail+bytes(data[-8:]))[-8:]
+        return len(data)
+
+    def close(self):
+        self.fh.close()
+
+class Throttle(object):
+    ## a rate cap shared by the threads of this process, in bytes (what a call returns or is given) or operations per
+    ## second. adaptive (--fair_share): every second the median latency per byte or operation of each kind of call
+    ## (read, write, unlink, rmdir, a scandir entry) is compared with the lowest median seen for that kind, i.e. the
+    ## filesystem when it is idle. At over 3x that, while the throughput of that kind over the time it was busy did
+    ## not rise (our own extra load raises both), the rate is halved; once every kind is below 1.5x it grows by half
+    ## until it is back at limit (or unlimited when there is none). Idle time between calls counts for nothing.
+    def __init__(self, name, limit=None, adaptive=False, unit=None, floor=1, burst=0.1):
+        self.name=name; self.limit=limit; self.rate=limit; self.adaptive=adaptive; self.unit=unit
+        self.floor=floor; self.burst=burst
+        self.active=limit is not None or adaptive
+        self.lock=threading.Lock()
+        self.next=0.0
+        self.kinds={}  # kind -> latencies, amount, busy seconds, window start, calls in flight, busy since, baseline, last throughput
+        self.waited=0.0; self.backoffs=0
+
+    def _kind(self, kind):
+        state=self.kinds.get(kind)
+        if state is None:
+            state=self.kinds[kind]={"latencies": [], "amount": 0, "busy": 0.0, "start": time.monotonic(), "inflight": 0, "since": 0.0,
+                                    "baseline": None, "through": None, "slow": False}
+        return state
+
+    def call(self, function, *args):
+        ## function(*args), charged with len() of what it returns (bytes read), of its argument (bytes written)
+        ## or, for an operation, one; the time with at least one call of its kind in flight is its busy time
+        if not self.active:
+            return function(*args)
+        kind=getattr(function, "__name__", "call")
+        start=time.perf_counter()
+        with self.lock:
+            state=self._kind(kind)
+            if not state["inflight"]:
+                state["since"]=start
+            state["inflight"]+=1
+        try:
+            result=function(*args)
+        finally:
+            end=time.perf_counter()
+            with self.lock:
+                ## since: the start of this busy period or the last call that ended in it
+                state["inflight"]-=1
+                busy=end-state["since"]; state["since"]=end
+        if self.unit is None:
+            self.charge(1, end-start, kind, busy)
+        else:
+            self.charge(len(result) if isinstance(result, (bytes, bytearray)) else len(args[0]), end-start, kind, busy)
+        return result
+
+    def charge(self, amount, latency=None, kind="call", busy=None):
+        ## busy: seconds of busy time this charge adds (default: its latency, for a caller that works alone)
+        if not self.active or amount<=0:
+            return
+        with self.lock:
+            now=time.monotonic()
+            if self.adaptive and latency is not None:
+                self._adapt(now, kind, amount, latency, latency if busy is None else busy)
+            if self.rate is None:
+                return
+            self.next=max(self.next, now-self.burst)+amount/self.rate
+            delay=self.next-now
+            if delay>0:
+                self.waited+=delay
+        if delay>0:
+            time.sleep(delay)
+
+    def _adapt(self, now, kind, amount, latency, busy):
+        state=self._kind(kind)
+        state["latencies"].append(latency/amount); state["amount"]+=amount; state["busy"]+=busy
+        if now-state["start"]<1.0 or len(state["latencies"])<8:
+            return
+        median=sorted(state["latencies"])[len(state["latencies"])//2]
+        through=state["amount"]/state["busy"] if state["busy"]>0 else None
+        ## the idle latency may drift up over a long run, so the lowest median is forgotten slowly (by a factor of 3
+        ## after about ten minutes of slow calls)
+        baseline=state["baseline"]=median if state["baseline"] is None else min(state["baseline"]*1.002, median)
+        slower=median>3*baseline and through is not None and (state["through"] is None or through<=1.1*state["through"])
+        state["slow"]=median>=1.5*baseline
+        if slower:
+            self.rate=max((through if self.rate is None else self.rate)/2, self.floor); self.backoffs+=1
+        elif self.rate is not None and not any(other["slow"] for other in self.kinds.values()):
+            ## only once every kind of call is back to normal
+            self.rate*=1.5
+            if self.limit is not None and self.rate>=self.limit:
+                self.rate=self.limit
+            elif self.limit is None and through is not None and self.rate>=2*through:
+                self.rate=None  # the cap no longer holds anything back
+        state["through"]=through
+        state["latencies"]=[]; state["amount"]=0; state["busy"]=0.0; state["start"]=now
+
+    def take_stats(self):
+        ## seconds waited and back-offs since the last call
+        with self.lock:
+            stats=(self.waited, self.backoffs)
+            self.waited=0.0; self.backoffs=0
+        return stats
+
+## no limits until main sets them from the command line: every call goes straight through
+read_throttle=Throttle("read", unit="B"); write_throttle=Throttle("write", unit="B"); ops_throttle=Throttle("ops")
+
+def write_throttle_stats(name, path):
+    ## one Throttled_ line per unit that had to wait or back off
+    parts=[]; fields={"event": f"Throttled_{name}", "path": str(path)}
+    for throttle in (read_throttle, write_throttle, ops_throttle):
+        if not throttle.active:
+            continue
+        waited, backoffs=throttle.take_stats()
+        if waited or backoffs:
+            rate="unlimited" if throttle.rate is None else (f"{convert_bytes(throttle.rate)}/s" if throttle.unit else f"{throttle.rate:.0f}ops/s")
+            parts.append(f"{throttle.name} waited {waited:.2f}s (summed over threads), {backoffs} back-offs, now {rate}")
+            fields[throttle.name]={"waited": waited, "backoffs": backoffs, "rate": throttle.rate}
+    if parts:
+        write_logs(f"Throttled_{name}\t{path}\t"+"\t".join(parts), fields=fields)
+
+class ChecksumReader(object):
+    ## CRC32 of a member's content while tarfile/copyfileobj reads it; throttle: reads of a file on disk
+    def __init__(self, fh, throttle=None):
+        self.fh=fh; self.crc=0; self.size=0; self.throttle=throttle
+
+    def read(self, n=-1):
+        if self.throttle is not None:
+            data=self.throttle.call(self.fh.read, n)
+        else:
+            data=self.fh.read(n)
+        self.crc=zlib.crc32(data, self.crc); self.size+=len(data)
+        return data
+
+class CommandReader(object):
+    ## decompresses through an external tool (--validate full without the Python module); a thread feeds it the
+    ## compressed bytes read from fh
+    def __init__(self, fh, command):
+        self.command=command
+        self.proc=subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.feeder=threading.Thread(target=self._feed, args=(fh,), daemon=True)
+        self.feeder.start()
+
+    def _feed(self, fh):
+        ## the tool may stop reading early (corrupt input); its exit status reports that
+        with contextlib.suppress(OSError):
+            shutil.copyfileobj(fh, self.proc.stdin, 1<<20)
+        with contextlib.suppress(OSError):
+            self.proc.stdin.close()
+
+    def read(self, n=-1):
+        return self.proc.stdout.read(n)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        while self.proc.stdout.read(1<<20):
+            pass
+        returncode=self.proc.wait()
+        self.feeder.join()
+        if returncode!=0 and exc[0] is None:
+            raise OSError(f"{self.command[0]} exited with {returncode}")
+
+class Journal(object):
+    ## transactional state of a run, kept in SQLite under --dir: units go planned -> running -> done and archives
+    ## compressing -> compressed -> validated -> deleted, so an interrupted run can be resumed with --resume.
+    ## Every process (main and --jobs workers) opens its own connection.
+    def __init__(self, path):
+        self.path=path
+        self._conn=None; self._pid=None
+
+    @property
+    def conn(self):
+        if self._pid!=os.getpid():
+            self._conn=sqlite3.connect(self.path, timeout=300, isolation_level=None)
+            self._pid=os.getpid()
+            self._conn.executescript(
+                "CREATE TABLE IF NOT EXISTS run (key TEXT PRIMARY KEY, value TEXT);"
+                "CREATE TABLE IF NOT EXISTS units (seq INTEGER PRIMARY KEY, action TEXT, path TEXT, state TEXT,"
+                " before TEXT, after TEXT, result TEXT, updated TEXT);"
+                "CREATE TABLE IF NOT EXISTS archives (path TEXT PRIMARY KEY, source TEXT, state TEXT, updated TEXT);")
+        return self._conn
+
+    def reset(self):
+        with self.conn:
+            self.conn.executescript("DELETE FROM run; DELETE FROM units; DELETE FROM archives;")
+
+    def set(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO run VALUES (?, ?)", (key, json.dumps(value)))
+
+    def get(self, key, default=None):
+        row=self.conn.execute("SELECT value FROM run WHERE key=?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def plan(self, units, first=0):
+        ## first: seq of the first unit, when a streamed run adds the units of one more directory
+        now=datetime.datetime.now().isoformat(timespec="seconds")
+        with self.conn:
+            self.conn.executemany("INSERT INTO units (seq, action, path, state, updated) VALUES (?, ?, ?, 'planned', ?)",
+                                  [(i, name, str(p), now) for i, (name, p) in enumerate(units, first)])
+
+    def unit_state(self, seq, state, before=None, after=None, result=None):
+        now=datetime.datetime.now().isoformat(timespec="seconds")
+        self.conn.execute("UPDATE units SET state=?, before=COALESCE(?, before), after=?, result=?, updated=? WHERE seq=?",
+                          (state, json.dumps(before) if before is not None else None, json.dumps(after), json.dumps(result), now, seq))
+
+    def units(self):
+        return [(seq, action, p, state, json.loads(before) if before else None, json.loads(after) if after else None, json.loads(result) if result else None)
+                for seq, action, p, state, before, after, result in
+                self.conn.execute("SELECT seq, action, path, state, before, after, result FROM units ORDER BY seq")]
+
+    def archive_state(self, archive, source, state):
+        now=datetime.datetime.now().isoformat(timespec="seconds")
+        self.conn.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?)", (str(archive), str(source), state, now))
+
+    def archives_of(self, source):
+        return [row[0] for row in self.conn.execute("SELECT path FROM archives WHERE source=? AND state IN ('validated', 'deleted') ORDER BY path", (str(source),))]
+
+    def partial_archives(self):
+        ## archives whose write (or the validation that follows it) never finished
+        return [row[0] for row in self.conn.execute("SELECT path FROM archives WHERE state IN ('compressing', 'compressed')")]
+
+def journal_state(archive, source, state):
+    if journal is not None:
+        journal.archive_state(archive, source, state)
+
+class Codec(object):
+    ## an archive format: the suffix of its files (after ".tar" for directories), a writer using N threads,
+    ## a reader for --validate full, the command that tests an archive, and the compressed size of --plan samples
+    name=None; suffix=""; default_level=0; max_level=0
+    def __init__(self, level=None):
+        self.level=self.default_level if level is None else level
+
+    @property
+    def spec(self):
+        return f"{self.name}:{self.level}"
+
+    def available(self):
+        return True
+
+    def sample_size(self, blocks):
+        return sum(len(block) for block in blocks)
+
+    def block_size(self):
+        ## the input one compressor thread works on at a time
+        return 1<<20
+
+class GzipCodec(Codec):
+    name="gzip"; suffix=".gz"; default_level=6; max_level=9
+    def writer(self, out_fh, threads):
+        ## pigz when it is on PATH, otherwise the built-in block writer; both write standard .gz
+        if shutil.which("pigz"):
+            return CommandWriter(out_fh, ["pigz", f"-{self.level}", "-p", str(threads), "-c"])
+        return BlockGzipWriter(out_fh, threads, self.level)
+
+    def reader(self, fh):
+        return gzip.GzipFile(fileobj=fh)
+
+    def test_command(self, is_tar):
+        return ["tar", "tzf"] if is_tar else ["gunzip", "-t"]
+
+    def sample_size(self, blocks):
+        return sum(len(zlib.compress(block, self.level)) for block in blocks)
+
+    def stored_frame(self, data):
+        return gzip.compress(data, compresslevel=0, mtime=0)
+
+class ZstdCodec(Codec):
+    name="zstd"; suffix=".zst"; default_level=3; max_level=19
+    def available(self):
+        return bool(shutil.which("zstd")) or zstandard is not None
+
+    def writer(self, out_fh, threads):
+        if shutil.which("zstd"):
+            return CommandWriter(out_fh, ["zstd", f"-{self.level}", f"-T{threads}", "-q", "-c"])
+        return StreamWriter(out_fh, zstandard.ZstdCompressor(level=self.level, threads=threads).compressobj())
+
+    def reader(self, fh):
+        if zstandard is not None:
+            return zstandard.ZstdDecompressor().stream_reader(fh, closefd=False)
+        return CommandReader(fh, ["zstd", "-d", "-q", "-c"])
+
+    def test_command(self, is_tar):
+        return ["tar", "tf"] if is_tar else ["zstd", "-t", "-q"]
+
+    def sample_size(self, blocks):
+        if zstandard is not None:
+            compressor=zstandard.ZstdCompressor(level=self.level)
+            return sum(len(compressor.compress(block)) for block in blocks)
+        ## one zstd call for the whole sample
+        return len(subprocess.run(["zstd", f"-{self.level}", "-q", "-c"], input=b"".join(blocks), stdout=subprocess.PIPE, check=True).stdout)
+
+    def block_size(self):
+        ## zstd -T gives each thread a job of 4 windows: 2 MiB windows up to level 9, 8 MiB above
+        return (8 if self.level<=9 else 32)<<20
+
+    def stored_frame(self, data):
+        ## a frame of raw blocks: no content size or checksum, 128 KiB window
+        frame=bytearray(b"\x28\xb5\x2f\xfd\x00\x38")
+        for i in range(0, max(len(data), 1), 1<<17):
+            chunk=data[i:i+(1<<17)]
+            frame+=(len(chunk)<<3 | (i+(1<<17)>=len(data))).to_bytes(3, "little")+chunk
+        return bytes(frame)
+
+class XzCodec(Codec):
+    name="xz"; suffix=".xz"; default_level=6; max_level=9
+    def writer(self, out_fh, threads):
+        ## the xz command is multi-threaded, the lzma module is not
+        if shutil.which("xz"):
+            return CommandWriter(out_fh, ["xz", f"-{self.level}", f"-T{threads}", "-c"])
+        return StreamWriter(out_fh, lzma.LZMACompressor(preset=self.level))
+
+    def reader(self, fh):
+        return lzma.LZMAFile(fh)
+
+    def test_command(self, is_tar):
+        return ["tar", "tf"] if is_tar else ["xz", "-t"]
+
+    def sample_size(self, blocks):
+        return sum(len(lzma.compress(block, preset=self.level)) for block in blocks)
+
+    def block_size(self):
+        ## xz -T splits its input into blocks of 3 dictionaries
+        return 3*(256<<10, 1<<20, 2<<20, 4<<20, 4<<20, 8<<20, 8<<20, 16<<20, 32<<20, 64<<20)[self.level]
+
+    def stored_frame(self, data):
+        ## a one-block stream of uncompressed LZMA2 chunks with a CRC32 check; even xz -0 runs its match finder
+        ## over incompressible data at a few MB/s
+        flags=b"\x00\x01"
+        header=b"\xfd7zXZ\x00"+flags+struct.pack("<I", zlib.crc32(flags))
+        block_header=b"\x02\x00\x21\x01\x00\x00\x00\x00"  # 12 bytes with its CRC32: one filter, LZMA2, 4 KiB dictionary
+        block_header+=struct.pack("<I", zlib.crc32(block_header))
+        chunks=bytearray()
+        for i in range(0, len(data), 1<<16):
+            chunk=data[i:i+(1<<16)]
+            chunks+=(b"\x01" if i==0 else b"\x02")+struct.pack(">H", len(chunk)-1)+chunk
+        chunks+=b"\x00"
+        unpadded=len(block_header)+len(chunks)+4
+        block=block_header+bytes(chunks)+b"\x00"*(-len(chunks)%4)+struct.pack("<I", zlib.crc32(data))
+        index=b"\x00"+xz_varint(1)+xz_varint(unpadded)+xz_varint(len(data))
+        index+=b"\x00"*(-len(index)%4)
+        index+=struct.pack("<I", zlib.crc32(index))
+        backward=struct.pack("<I", len(index)//4-1)+flags
+        return header+block+index+struct.pack("<I", zlib.crc32(backward))+backward+b"YZ"
+
+def xz_varint(value):
+    out=bytearray()
+    while value>=0x80:
+        out.append(value&0x7f | 0x80); value>>=7
+    out.append(value)
+    return bytes(out)
+
+class StoreCodec(Codec):
+    ## uncompressed tar, for directories whose files are already compressed; single files are left as they are
+    name="store"
+    def writer(self, out_fh, threads):
+        return StreamWriter(out_fh)
+
+    def reader(self, fh):
+        return contextlib.nullcontext(fh)
+
+    def test_command(self, is_tar):
+        return ["tar", "tf"]
+
+CODECS={codec.name: codec for codec in (GzipCodec, ZstdCodec, XzCodec, StoreCodec)}
+## what reading back a damaged archive raises
+ARCHIVE_ERRORS=(OSError, EOFError, tarfile.TarError, zlib.error, lzma.LZMAError)+((zstandard.ZstdError,) if zstandard is not None else ())
+
+def parse_codec(spec):
+    ## "zstd" or "zstd:19"
+    name, _, level=spec.partition(":")
+    if name not in CODECS:
+        raise argparse.ArgumentTypeError(f"unknown codec {name} (choose from {', '.join(CODECS)})")
+    codec=CODECS[name](int(level) if level.isdigit() else None)
+    if level and (not level.isdigit() or codec.level>codec.max_level):
+        raise argparse.ArgumentTypeError(f"{name} levels are 0-{codec.max_level}")
+    return codec
+
+def parse_action_codec(spec):
+    ## "danscore=store", "dasuqc1/qc1f=store", "report-sub=zstd:9"
+    action, _, codec=spec.partition("=")
+    if action.split("/")[0] not in ACTION_BY_NAME or not codec:
+        raise argparse.ArgumentTypeError(f"expected ACTION=CODEC with ACTION one of {', '.join(ACTION_BY_NAME)}")
+    return action, parse_codec(codec)
+
+def codec_settings():
+    ## --codec/--action_codec (and --time_budget, --bundle_under) as recorded in the journal and in plan files
+    return {"codec": default_codec.spec, "action_codec": [f"{action}={codec.spec}" for action, codec in action_codecs.items()], "time_budget": time_budget,
+            "bundle_under": bundle_limit}
+
+def codec_for(outlog):
+    ## outlog is the action name, or action/sub-directory for the dasuqc1 info and qc1f archives
+    return action_codecs.get(outlog) or action_codecs.get(outlog.split("/")[0]) or default_codec
+
+## --time_budget candidates, roughly from the fastest to the slowest
+ADAPTIVE_LEVELS=(("zstd", 1), ("gzip", 1), ("zstd", 3), ("gzip", 6), ("zstd", 9), ("gzip", 9), ("xz", 1), ("zstd", 19), ("xz", 6))
+
+def choose_codec(path, outlog, sample_bytes=256<<10):
+    ## --time_budget: compress a sample of path with the candidates, predict each one's ratio and time for all of it
+    ## (CPU seconds of the sample scaled to the total, over compress_threads), and take the one saving the most bytes
+    ## within path's share of the budget; of candidates within 1% of the best ratio the cheapest wins, so store wins
+    ## for content that does not compress. Sampling stops once a candidate fits and it has used a tenth of the share.
+    ## Returns (codec, (predicted ratio, predicted seconds, budget seconds)), without a prediction when the codec is fixed
+    if time_per_byte is None or outlog in action_codecs or outlog.split("/")[0] in action_codecs:
+        return codec_for(outlog), None
+    total, members, blocks=sample_content(path, sample_bytes)
+    raw=sum(len(data) for data in blocks)
+    if not raw:
+        return codec_for(outlog), None
+    budget=total*time_per_byte
+    candidates=[(StoreCodec(), 1.0, 0.0)]
+    too_slow=set()
+    begin=cpu_seconds()
+    for name, level in ADAPTIVE_LEVELS:
+        codec=CODECS[name](level)
+        if name in too_slow or not codec.available():
+            continue
+        if len(candidates)>1 and cpu_seconds()-begin>budget/10:
+            break
+        start=cpu_seconds()
+        ratio=codec.sample_size(blocks)/raw
+        seconds=(cpu_seconds()-start)*total/raw/compress_threads
+        if seconds>budget:
+            ## its higher levels are slower still
+            too_slow.add(name)
+            continue
+        candidates.append((codec, ratio, seconds))
+    best=min(ratio for codec, ratio, seconds in candidates)
+    codec, ratio, seconds=min((c for c in candidates if c[1]<=best+0.01), key=lambda c: c[2])
+    return codec, (ratio, seconds, budget)
 
+def write_codec_choice(outlog, archive, codec, prediction, manifest, seconds):
+    ## one ##Codec_ line of the summary log per archive of a --time_budget run
+    if time_per_byte is None:
+        return
+    source=sum(size for name, kind, size, crc in manifest["members"])
+    ratio=manifest["size"]/source if source else 1.0
+    predicted, expected, budget=prediction or (None, None, None)
+    write_logs(f"##Codec_{outlog}\t{archive}\t{codec.spec}\t{'NA' if predicted is None else f'{predicted:.3f}'}\t{ratio:.3f}\t"
+               f"{'NA' if expected is None else f'{expected:.2f}s'}\t{seconds:.2f}s\t{'NA' if budget is None else f'{budget:.2f}s'}", "_",
+               fields={"event": f"Codec_{outlog}", "archive": archive, "codec": codec.spec, "predicted_ratio": predicted, "ratio": ratio,
+                       "predicted_seconds": expected, "seconds": seconds, "budget_seconds": budget})
+
+def codec_of(archive):
+    ## codec of an existing archive, from its name
+    for codec in CODECS.values():
+        if codec.suffix and archive.endswith(codec.suffix):
+            return codec()
+    return StoreCodec() if archive.endswith(".tar") else None
+
+def is_tar_archive(archive):
+    codec=codec_of(archive)
+    return codec is not None and archive[:len(archive)-len(codec.suffix)].endswith(".tar")
+
+def archive_path(path, is_dir, codec):
+    ## None when the codec leaves a single file as it is (store)
+    if is_dir:
+        return f"{path}.tar{codec.suffix}"
+    return f"{path}{codec.suffix}" if codec.suffix else None
+
+def validated_archive(path, is_dir, codec, exists=os.path.exists):
+    ## an archive of path that an earlier run validated, in this codec or in the one that run used
+    for other in [codec]+[c() for c in CODECS.values() if c.name!=codec.name]:
+        archive=archive_path(path, is_dir, other)
+        if archive and exists(f"{archive}.validated"):
+            return archive
+    return None
+
+class SegmentSink(object):
+    ## the archive as seen by one compressed segment: finishing the segment leaves the archive open
+    def __init__(self, sink):
+        self.sink=sink
+
+    def write(self, data):
+        return self.sink.write(data)
+
+    def tell(self):
+        return self.sink.size
+
+    def close(self):
+        pass
+
+class SegmentedWriter(object):
+    ## the tar stream of a directory archive as a series of independent frames: the codec's stream is restarted
+    ## every segment_size bytes, and members that are already compressed go out as stored frames (gzip level 0,
+    ## raw zstd blocks, uncompressed LZMA2 chunks). gzip, zstd and xz decode concatenated frames as one stream,
+    ## so the archive stays a single standard .tar.gz/.tar.zst/.tar.xz, while the (tar offset, archive offset)
+    ## of every frame start lets --extract decompress only the frames that hold a member
+    def __init__(self, out_fh, codec, threads, skip_compressed=True, segment_size=None, frame_size=1<<20):
+        ## segment_size: every segment starts a new compressor (a pigz/zstd/xz process), so a segment is at least
+        ## 64 MiB and long enough to give each of the threads a block of its own
+        self.out_fh=out_fh; self.codec=codec; self.threads=threads
+        segment_size=segment_size or max(64<<20, threads*codec.block_size())
+        self.framed=hasattr(codec, "stored_frame")  # False for store: a plain .tar is seekable as it is
+        self.skip_compressed=skip_compressed and self.framed
+        self.segment_size=segment_size; self.frame_size=frame_size
+        self.segment=None; self.segment_start=0; self.stored=False; self.pending=bytearray(); self.offset=0
+        self.points=[]; self.data=[]  # frame starts and the tar offset of every regular member's content
+        self.skipped_members=0; self.skipped_bytes=0
+
+    def _close_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.points.extend([self.segment_start+u, c] for u, c in getattr(self.segment, "points", []) if u>0)
+            self.segment=None
+
+    def set_stored(self, stored):
+        if stored:
+            self._close_segment()
+        else:
+            self._flush_stored()
+        self.stored=stored
+
+    def _flush_stored(self):
+        if self.pending:
+            self.points.append([self.offset-len(self.pending), self.out_fh.size])
+            self.out_fh.write(self.codec.stored_frame(bytes(self.pending)))
+            self.pending=bytearray()
+
+    def write(self, data):
+        if self.stored:
+            self.pending+=data; self.offset+=len(data)
+            if len(self.pending)>=self.frame_size:
+                self._flush_stored()
+        else:
+            if self.segment is not None and self.framed and self.offset-self.segment_start>=self.segment_size:
+                self._close_segment()
+            if self.segment is None:
+                self.segment_start=self.offset
+                if self.framed:
+                    self.points.append([self.offset, self.out_fh.size])
+                self.segment=self.codec.writer(SegmentSink(self.out_fh), self.threads)
+            self.segment.write(data); self.offset+=len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        self._flush_stored()
+        if self.segment is None and self.offset==0:
+            self.segment=self.codec.writer(SegmentSink(self.out_fh), self.threads)
+        self._close_segment()
+        self.out_fh.close()
+
+COMPRESSED_SUFFIXES=(".gz", ".bgz", ".tgz", ".zst", ".xz", ".bz2", ".lz4", ".zip", ".7z", ".png", ".jpg", ".jpeg", ".bam", ".cram")
+COMPRESSED_MAGIC=(b"\x1f\x8b", b"\x28\xb5\x2f\xfd", b"\xfd7zXZ\x00", b"BZh", b"PK\x03\x04", b"7z\xbc\xaf\x27\x1c", b"\x89PNG", b"\xff\xd8\xff", b"\x04\x22\x4d\x18")
+
+def is_precompressed(path, size, min_size=256<<10, probe=64<<10):
+    ## a member not worth compressing again: a compressed suffix or magic number, otherwise a zlib level-1 probe
+    ## of its middle that saves less than 5%; small members are not worth a new segment
+    if size<min_size:
+        return False
+    if path.lower().endswith(COMPRESSED_SUFFIXES):
+        return True
+    try:
+        with open(path, "rb") as fh:
+            if fh.read(8).startswith(COMPRESSED_MAGIC):
+                return True
+            fh.seek(size//2-probe//2)
+            sample=fh.read(probe)
+    except OSError:
+        return False
+    return len(zlib.compress(sample, 1))>0.95*len(sample)
+
+@contextlib.contextmanager
+def open_archive_writer(out_path, codec, threads=None, segmented=False, skip_compressed=False):
+    ## segmented: directory archives, written as indexed frames (see SegmentedWriter)
+    threads=threads or compress_threads
+    out_fh=ArchiveSink(out_path)
+    if segmented:
+        writer=SegmentedWriter(out_fh, codec, threads, skip_compressed)
+    else:
+        writer=codec.writer(out_fh, threads)
+    writer.sink=out_fh
+    try:
+        try:
+            yield writer
+        finally:
+            writer.close()
+    except BaseException:
+        ## e.g. ENOSPC partway through: a partial archive must not keep holding the space
+        with contextlib.suppress(OSError):
+            out_fh.close()
+        with contextlib.suppress(OSError):
+            os.remove(out_path)
+        raise
+
+def content_hash(path, limit=None):
+    digest=hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fh:
+        left=limit if limit is not None else -1
+        while left:
+            block=read_throttle.call(fh.read, 1<<20 if left<0 else min(left, 1<<20))
+            if not block:
+                break
+            digest.update(block); left-=len(block)
+    return digest.digest()
+
+class Deduplicator(object):
+    ## byte-identical regular files under the sources of one archive: files of the same size (from the index) are
+    ## compared by a hash of their first block, those that still match by a hash of all of their content.
+    ## Every copy after the first goes into the tar as a hard link to the first one
+    def __init__(self, sources, min_size=1024, head=64<<10):
+        self.digests={}  # path -> content hash, only for files with an identical copy
+        self.first={}  # content hash -> arcname of the member that holds the content
+        self.links={}  # arcname of a hard link member -> arcname it links to
+        self.members=0; self.bytes=0; self.read=0
+        by_size=collections.defaultdict(list)
+        for source in sources:
+            entry=tree_index.get(source)
+            if entry is not None and entry.is_file and not entry.is_link and entry.size>=min_size:
+                by_size[entry.size].append(os.path.normpath(str(source)))
+            for root, dirs, files in tree_index.walk(source):
+                for name in files:
+                    child=tree_index.get(os.path.join(root, name))
+                    if child.is_file and not child.is_link and child.size>=min_size:
+                        by_size[child.size].append(os.path.join(root, name))
+        for size, paths in by_size.items():
+            if len(paths)<2:
+                continue
+            for head_digest, group in self._same(paths, head).items():
+                if len(group)<2:
+                    continue
+                ## a file no longer than the head was hashed whole already
+                for digest, same in (self._same(group, None) if size>head else {head_digest: group}).items():
+                    if len(same)>1:
+                        self.digests.update((p, digest) for p in same)
+            self.read+=sum(min(size, head) for p in paths)
+
+    def _same(self, paths, limit):
+        groups=collections.defaultdict(list)
+        for p in paths:
+            try:
+                groups[content_hash(p, limit)].append(p)
+            except OSError:
+                continue
+            if limit is None:
+                self.read+=tree_index.get(p).size
+        return groups
+
+    def link(self, path, arcname, size):
+        ## the arcname of an identical member already in the tar, otherwise None (arcname now holds the content)
+        digest=self.digests.get(os.path.normpath(str(path)))
+        if digest is None:
+            return None
+        target=self.first.setdefault(digest, arcname)
+        if target==arcname:
+            return None
+        self.links[arcname]=target
+        self.members+=1; self.bytes+=size
+        return target
+
+def add_to_tar(tar, path, arcname, members, out=None, dedup=None):
+    ## same walk as tar.add(), but each member's size and CRC32 are recorded for the manifest; with a
+    ## SegmentedWriter as out, the tar offset of each member's content is recorded for --extract and already
+    ## compressed members are stored instead of compressed again; with a Deduplicator, copies of a file
+    ## already in the tar become hard links to it
+    tarinfo=tar.gettarinfo(path, arcname)
+    if tarinfo is None:
+        members.append([arcname, "-", 0, 0])
+        return
+    target=dedup.link(path, arcname, tarinfo.size) if dedup is not None and tarinfo.isreg() else None
+    if target is not None:
+        tarinfo.type=tarfile.LNKTYPE; tarinfo.linkname=target; tarinfo.size=0
+    if tarinfo.isreg():
+        stored=isinstance(out, SegmentedWriter) and out.skip_compressed and is_precompressed(path, tarinfo.size)
+        if stored:
+            out.set_stored(True)
+            out.skipped_members+=1; out.skipped_bytes+=tarinfo.size
+        with open(path, "rb") as fh:
+            reader=ChecksumReader(fh, read_throttle)
+            tar.addfile(tarinfo, reader)
+        if stored:
+            out.set_stored(False)
+        if isinstance(out, SegmentedWriter):
+            out.data.append([arcname, tar.offset-tarinfo.size-(-tarinfo.size % tarfile.BLOCKSIZE)])
+        members.append([arcname, "f", tarinfo.size, reader.crc])
+    else:
+        tar.addfile(tarinfo)
+        members.append([arcname, tarinfo.type.decode(), 0, 0])
+        if tarinfo.islnk() and dedup is not None:
+            dedup.links[arcname]=tarinfo.linkname
+        if tarinfo.isdir():
+            for name in sorted(os.listdir(path)):
+                add_to_tar(tar, os.path.join(path, name), os.path.join(arcname, name), members, out, dedup)
+
+def new_manifest(compressed_path, members, sink, isize):
+    return {"archive": os.path.basename(compressed_path), "size": sink.size, "crc32": sink.crc, "trailer": sink.tail.hex(),
+            "isize": isize, "members": members}
+
+def read_validated(validation_file):
+    ## the .validated file is a JSON manifest; older runs wrote a bare timestamp
+    with open(validation_file, 'r') as valfile:
+        text=valfile.read()
+    try:
+        return json.loads(text)
+    except ValueError:
+        return {"validated": text}
+
+@phases.timed("compression")
+def write_tar_archive(compressed_path, source_path, codec, outlog, children=None, with_root=True):
+    ## the tar archive of source_path, or with children only those entries of it (and with_root: the directory
+    ## entry itself, without its content); returns the manifest recorded during the write
+    name=os.path.basename(os.path.normpath(str(source_path)))
+    members=[]
+    journal_state(compressed_path, source_path, "compressing")
+    duplicates=Deduplicator(([source_path] if children is None else children) if dedup else [])
+    with open_archive_writer(compressed_path, codec, segmented=True, skip_compressed=not recompress) as out:
+        with tarfile.open(fileobj=out, mode="w|") as tar:
+            if children is None:
+                add_to_tar(tar, source_path, name, members, out, duplicates)
+            else:
+                if with_root:
+                    tar.addfile(tar.gettarinfo(source_path, name))
+                    members.append([name, tarfile.DIRTYPE.decode(), 0, 0])
+                for child in children:
+                    add_to_tar(tar, child, os.path.join(name, os.path.basename(child)), members, out, duplicates)
+    manifest=new_manifest(compressed_path, members, out.sink, out.tell())
+    phases.count("compression", read=sum(size for name, kind, size, crc in members)+duplicates.read, written=out.sink.size, files=len(members))
+    manifest["index"]={"points": out.points, "data": out.data}
+    if duplicates.links:
+        ## hard link members, for --extract
+        manifest["links"]=duplicates.links
+    if duplicates.members:
+        manifest["deduplicated_members"]=duplicates.members; manifest["deduplicated_bytes"]=duplicates.bytes
+        write_logs(f"##Deduplicated_{outlog}\t{compressed_path}\t{duplicates.members}\t{convert_bytes(duplicates.bytes)}", "_",
+                   fields={"event": f"Deduplicated_{outlog}", "archive": compressed_path,
+                           "members": duplicates.members, "bytes": duplicates.bytes})
+    journal_state(compressed_path, source_path, "compressed")
+    tree_index.add(compressed_path)
+    write_logs(f"Compressed_{outlog}\t{compressed_path}")
+    if out.skipped_members:
+        manifest["stored_members"]=out.skipped_members; manifest["stored_bytes"]=out.skipped_bytes
+        write_logs(f"StoredCompressedMembers_{outlog}\t{compressed_path}\t{out.skipped_members}\t{convert_bytes(out.skipped_bytes)}",
+                   fields={"event": f"StoredCompressedMembers_{outlog}", "archive": compressed_path,
+                           "members": out.skipped_members, "bytes": out.skipped_bytes})
+    return manifest
+
+@phases.timed("compression")
 def compress_files(file_path, outlog):
+    ## returns (compressed path, manifest recorded during the write); the manifest is None when an earlier run
+    ## already validated the archive
     if os.path.islink(file_path):
         write_logs(f"NotCompressed_SymLink_{outlog}\t{file_path}")
 
     elif os.path.isdir(file_path):
-        validation_file=f"{file_path}.tar.gz.validated"
-        if os.path.exists(validation_file):
-            with open(validation_file, 'r') as valfile:
-                 time= valfile.read()
-            write_logs(f"Validated_{outlog}\t{file_path}.tar.gz on\t{time}")
-            return f"{file_path}.tar.gz"
+        validated=validated_archive(file_path, True, codec_for(outlog))
+        if validated:
+            when=read_validated(f"{validated}.validated").get("validated")
+            write_logs(f"Validated_{outlog}\t{validated} on\t{when}")
+            return validated, None
         else:
-            with tarfile.open(f"{file_path}.tar.gz", "w:gz") as tar:
-                tar.add(file_path, arcname=os.path.basename(file_path))
-            write_logs(f"Compressed_{outlog}\t{file_path}.tar.gz")
-            return f"{file_path}.tar.gz"
+            codec, prediction=choose_codec(file_path, outlog)
+            compressed_path=archive_path(file_path, True, codec)
+            start=time.monotonic()
+            manifest=write_tar_archive(compressed_path, file_path, codec, outlog)
+            write_codec_choice(outlog, compressed_path, codec, prediction, manifest, time.monotonic()-start)
+            return compressed_path, manifest
 
     elif os.path.isfile(file_path):
-        validation_file=f"{file_path}.gz.validated"
-        if os.path.exists(validation_file):
-            with open(validation_file, 'r') as valfile:
-                time= valfile.read()
-            write_logs(f"Validated_{outlog}\t{file_path}.tar.gz on\t{time}")
-            return f"{file_path}.gz"
+        validated=validated_archive(file_path, False, codec_for(outlog))
+        if validated:
+            when=read_validated(f"{validated}.validated").get("validated")
+            write_logs(f"Validated_{outlog}\t{validated} on\t{when}")
+            return validated, None
+        codec, prediction=choose_codec(file_path, outlog)
+        compressed_path=archive_path(file_path, False, codec)
+        if compressed_path is None:
+            write_logs(f"NotCompressed_{codec.name}_{outlog}\t{file_path}")
         else:
-            subprocess.run(["gzip", "-f", "-c", file_path], stdout=open(f"{file_path}.gz", "wb"))
-            write_logs(f"Compressed_{outlog}\t{file_path}.gz")
-            return f"{file_path}.gz"
+            journal_state(compressed_path, file_path, "compressing")
+            start=time.monotonic()
+            with open_archive_writer(compressed_path, codec) as out, open(file_path, "rb") as source:
+                reader=ChecksumReader(source, read_throttle)
+                shutil.copyfileobj(reader, out, 1<<20)
+            manifest=new_manifest(compressed_path, [[os.path.basename(file_path), "f", reader.size, reader.crc]], out.sink, out.tell())
+            phases.count("compression", read=reader.size, written=out.sink.size, files=1)
+            write_codec_choice(outlog, compressed_path, codec, prediction, manifest, time.monotonic()-start)
+            journal_state(compressed_path, file_path, "compressed")
+            tree_index.add(compressed_path)
+            write_logs(f"Compressed_{outlog}\t{compressed_path}")
+            return compressed_path, manifest
     else:
         write_logs(f"NotCompressed_NotFound_{outlog}\t{file_path}")
+    return None, None
 
-def validate_compress_files(compressed_path, outlog):
+def count_source_members(source_path):
+    ## number of tar members the source should produce (itself plus everything below it), from the index
+    count=1
+    for root, dirs, files in tree_index.walk(source_path):
+        count+=len(dirs)+len(files)
+    return count
+
+def verify_manifest(compressed_path, manifest, full=False):
+    ## cheap check: the archive on disk has the length and trailer that were written, and its last frame decodes:
+    ## the codec checks its own trailer (gzip CRC32/ISIZE, the zstd checksum, the xz check and index) and the frame
+    ## must end the tar stream at the recorded isize. A single-frame file archive is decoded whole, so its content
+    ## CRC is checked too. full=True also re-reads it once, checking the stream CRC and every member CRC
+    if os.path.getsize(compressed_path)!=manifest["size"]:
+        return False
+    with open(compressed_path, "rb") as fh:
+        fh.seek(max(0, manifest["size"]-8))
+        if fh.read(8).hex()!=manifest["trailer"]:
+            return False
+    start, offset=((manifest.get("index") or {}).get("points") or [[0, 0]])[-1]
+    try:
+        with open(compressed_path, "rb") as raw:
+            raw.seek(offset)
+            with codec_of(compressed_path).reader(ChecksumReader(raw, read_throttle)) as stream:
+                content=ChecksumReader(stream)
+                while content.read(1<<20):
+                    pass
+    except Exception:
+        ## zlib, lzma, zstandard or the zstd/xz command rejected the stream
+        return False
+    if manifest.get("isize") is not None and start+content.size!=manifest["isize"]:
+        return False
+    if offset==0 and not is_tar_archive(compressed_path) and content.crc!=manifest["members"][0][3]:
+        return False
+    if not full:
+        return True
+    with open(compressed_path, "rb") as raw:
+        reader=ChecksumReader(raw, read_throttle)
+        with codec_of(compressed_path).reader(reader) as stream:
+            if is_tar_archive(compressed_path):
+                expected={name: crc for name, kind, size, crc in manifest["members"] if kind=="f"}
+                with tarfile.open(fileobj=stream, mode="r|") as tar:
+                    for member in tar:
+                        if member.isreg():
+                            content=ChecksumReader(tar.extractfile(member))
+                            while content.read(1<<20):
+                                pass
+                            if expected.pop(member.name, None)!=content.crc:
+                                return False
+                if expected:
+                    return False
+            else:
+                content=ChecksumReader(stream)
+                while content.read(1<<20):
+                    pass
+                if content.crc!=manifest["members"][0][3]:
+                    return False
+        while reader.read(1<<20):
+            pass
+    return reader.crc==manifest["crc32"]
+
+@phases.timed("validation")
+def validate_compress_files(compressed_path, outlog, manifest=None, source_path=None, expected=None):
+    ## expected: number of members the archive must hold (default: counted from source_path)
     text = '_'.join(datetime.datetime.today().strftime("%c").split())
     if os.path.exists(f"{compressed_path}.validated"):
         return True
-    if compressed_path.endswith('.tar.gz'):
-        # Validate .tar.gz file
+    if manifest is not None:
+        # Validate against the manifest recorded while the archive was written
+        phases.count("validation", read=manifest["size"] if validate_mode=="full" else 0, files=len(manifest["members"]))
         try:
-            subprocess.check_call(['tar', 'tzf', compressed_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            valid=verify_manifest(compressed_path, manifest, validate_mode=="full")
+            if expected is None and source_path is not None:
+                expected=count_source_members(source_path)
+            if valid and expected is not None and len(manifest["members"])!=expected:
+                valid=False
+        except ARCHIVE_ERRORS as e:
+            valid=False
+        if valid:
             write_logs(f"Validated_{outlog}\t{compressed_path}")
+            manifest["validated"]=text
             with open(f"{compressed_path}.validated", 'w') as file:
-                file.write(text)
+                json.dump(manifest, file)
+            tree_index.add(f"{compressed_path}.validated")
             return True
-        except subprocess.CalledProcessError:
-            write_logs(f"ValidationFailed_{outlog}\t{compressed_path}")
-            return False
-    
-    elif compressed_path.endswith('.gz'):
-         # Validate .gz file
+        write_logs(f"ValidationFailed_{outlog}\t{compressed_path}")
+        return False
+    codec=codec_of(compressed_path)
+    if codec is not None:
+        # Validate .tar.gz/.tar.zst/.tar.xz/.tar with tar, single .gz/.zst/.xz files with the codec's own test
+        phases.count("validation", read=os.path.getsize(compressed_path), files=1)
         try:
-            subprocess.check_call(['gunzip', '-t', compressed_path])
+            subprocess.check_call(codec.test_command(is_tar_archive(compressed_path))+[compressed_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
             write_logs(f"Validated_{outlog}\t{compressed_path}")
             with open(f"{compressed_path}.validated", 'w') as file:
-                file.write(text)
+                json.dump({"validated": text}, file)
+            tree_index.add(f"{compressed_path}.validated")
             return True
-        except subprocess.CalledProcessError:
+        except (subprocess.CalledProcessError, OSError):
             write_logs(f"ValidationFailed_{outlog}\t{compressed_path}")
             return False
     
@@ -205,47 +1941,427 @@ def validate_compress_files(compressed_path, outlog):
         write_logs(f"ValidationFailed_{outlog}\t{compressed_path}")
         return False
 
+class RangeReader(object):
+    ## at most length bytes of fh from its current position: the frames between two index points
+    def __init__(self, fh, length):
+        self.fh=fh; self.left=length
+
+    def read(self, n=-1):
+        n=self.left if n is None or n<0 else min(n, self.left)
+        data=self.fh.read(n)
+        self.left-=len(data)
+        return data
+
+def read_exactly(stream, size, out=None):
+    ## copy (or with out=None skip) size bytes of a decompressed stream
+    while size>0:
+        data=stream.read(min(size, 1<<20))
+        if not data:
+            raise EOFError("archive ended early")
+        if out is not None:
+            out.write(data)
+        size-=len(data)
+
+def archive_manifest(archive):
+    validation_file=f"{archive}.validated"
+    return read_validated(validation_file) if os.path.exists(validation_file) else {}
+
+def member_patterns(manifest, patterns):
+    ## in a --bundle_under archive the name of a unit stands for its directory and everything in it
+    units=manifest.get("units", {})
+    return [q for p in patterns for q in ([units[p][0], f"{units[p][0]}/*"] if p in units else [p])]
+
+def list_archive(archive, patterns=()):
+    ## --ls: members come from the manifest; archives without one are read through. A bundle first lists its units
+    ## (members, bytes, name); patterns (--member) list only the matching members
+    manifest=archive_manifest(archive)
+    patterns=member_patterns(manifest, patterns)
+    wanted=lambda name: not patterns or any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+    if "members" in manifest:
+        for name, (arcname, members, size) in manifest.get("units", {}).items() if not patterns else ():
+            print(f"unit\t{members}\t{size}\t{name}")
+        for name, kind, size, crc in manifest["members"]:
+            if wanted(name):
+                print(f"{kind}\t{size}\t{name}")
+        return
+    with open(archive, "rb") as fh, codec_of(archive).reader(fh) as stream, tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            if wanted(member.name):
+                print(f"{member.type.decode()}\t{member.size}\t{member.name}")
+
+def extract_members(archive, patterns, out_dir):
+    ## --extract: for each wanted member, decompress from the last index point before its tar header up to the
+    ## first point after its content; archives written without an index are read through
+    manifest=archive_manifest(archive)
+    patterns=member_patterns(manifest, patterns)
+    codec=codec_of(archive)
+    ## a hard link member is extracted as a copy of the member it links to
+    links=manifest.get("links", {})
+    content={name: (size, crc) for name, kind, size, crc in manifest.get("members", []) if kind=="f"}
+    wanted=[(name, links.get(name, name))+content[links.get(name, name)] for name, kind, size, crc in manifest.get("members", [])
+            if (kind=="f" or links.get(name) in content) and (not patterns or any(fnmatch.fnmatch(name, pattern) for pattern in patterns))]
+    if "index" not in manifest:
+        with open(archive, "rb") as fh, codec.reader(fh) as stream, tarfile.open(fileobj=stream, mode="r|") as tar:
+            for member in tar:
+                if (member.isreg() or member.islnk()) and (not patterns or any(fnmatch.fnmatch(member.name, pattern) for pattern in patterns)):
+                    tar.extract(member, out_dir)
+                    print(f"Extracted\t{os.path.join(out_dir, member.name)}")
+        return
+    points=manifest["index"]["points"]; data=dict(manifest["index"]["data"])
+    starts=[u for u, c in points]
+    archive_size=os.path.getsize(archive)
+    with open(archive, "rb") as fh:
+        for name, source, size, crc in wanted:
+            header=data[source]-tarfile.BLOCKSIZE
+            if points:
+                i=bisect.bisect_right(starts, header)-1
+                j=bisect.bisect_left(starts, data[source]+size)
+                (u, c), end=points[i], points[j][1] if j<len(points) else archive_size
+            else:
+                u=c=header; end=data[source]+size  # store: the .tar itself
+            fh.seek(c)
+            target=os.path.join(out_dir, name)
+            os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+            with codec.reader(RangeReader(fh, end-c)) as stream:
+                read_exactly(stream, header-u)
+                info=tarfile.TarInfo.frombuf(stream.read(tarfile.BLOCKSIZE), tarfile.ENCODING, "surrogateescape")
+                with open(target, "wb") as out:
+                    content=ChecksumReader(stream)
+                    read_exactly(content, size, out)
+            os.chmod(target, info.mode); os.utime(target, (info.mtime, info.mtime))
+            if content.crc!=crc:
+                print(f"CRC mismatch\t{target}")
+            else:
+                print(f"Extracted\t{target}")
+
+@phases.timed("deletion")
 def delete_files(file_to_delete, outlog):
+    if dry_run:
+        if tree_index.exists(file_to_delete):
+            tree_index.remove(file_to_delete)
+            write_logs(f"Delete_{outlog}\t{file_to_delete}")
+        return
     try:
         if os.path.islink(file_to_delete):
             write_logs(f"NotDeleted_SymLink_{outlog}\t{file_to_delete}")
         if os.path.isfile(file_to_delete):
             os.remove(file_to_delete)
+            phases.count("deletion", files=1)
+            tree_index.remove(file_to_delete)
             write_logs(f"Deleted_{outlog}\t{file_to_delete}")
-        elif os.path.isdir(file_to_delete):
-            shutil.rmtree(file_to_delete)
-            write_logs(f"Deleted_{outlog}\t{file_to_delete}")
+        elif os.path.isdir(file_to_delete) and not os.path.islink(file_to_delete):
+            delete_tree(file_to_delete, outlog)
     except FileNotFoundError:
+        tree_index.remove(file_to_delete)
         write_logs(f"NotDeleted_NotFound_{outlog}\t{file_to_delete}")
 
+def call_each(function, paths):
+    results=[]
+    for path in paths:
+        try:
+            ops_throttle.call(function, path)
+            results.append((path, None))
+        except OSError as e:
+            results.append((path, e))
+    return results
+
+def run_bounded(function, paths, threads=None, batch=32):
+    ## function(path) for every path from a thread pool; yields (path, error) as they complete. unlink/rmdir on a
+    ## parallel filesystem is one metadata round trip each, so throughput comes from the number of calls in flight
+    ## (one per thread), not from CPU. Calls are handed out in batches so the pool costs little next to a local
+    ## unlink, and at most two batches per thread are queued.
+    threads=threads or delete_threads
+    remaining=iter(paths)
+    batches=iter(lambda: list(itertools.islice(remaining, batch)), [])
+    if threads<=1:
+        for paths in batches:
+            yield from call_each(function, paths)
+        return
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        pending=set()
+        for paths in batches:
+            pending.add(pool.submit(call_each, function, paths))
+            if len(pending)>=2*threads:
+                done, pending=concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        for future in concurrent.futures.as_completed(pending):
+            yield from future.result()
+
+class DeleteCounts(object):
+    ## files and bytes deleted per directory, logged as one line per directory instead of one per file
+    def __init__(self, outlog):
+        self.outlog=outlog
+        self.dirs=collections.OrderedDict()
+
+    def add(self, path, size):
+        if log_deleted:
+            write_logs(f"Deleted_{self.outlog}\t{path}")
+        counts=self.dirs.setdefault(os.path.dirname(path), [0, 0])
+        counts[0]+=1; counts[1]+=size
+
+    def failed(self, path, error):
+        reason="NotFound" if isinstance(error, FileNotFoundError) else type(error).__name__
+        write_logs(f"NotDeleted_{reason}_{self.outlog}\t{path}\t{error.strerror or error}")
+
+    def write(self):
+        for directory, (files, size) in self.dirs.items():
+            write_logs(f"DeletedFiles_{self.outlog}\t{directory}\t{files}\t{convert_bytes(size)}")
+
+def delete_tree(path, outlog):
+    ## shutil.rmtree with the types taken from the index instead of a stat per entry: the non-directories are
+    ## unlinked in parallel, then the directories are removed deepest first, one level at a time
+    path=os.path.normpath(str(path))
+    if tree_index.get(path) is None:
+        tree_index.add(path)
+    files=[]; levels=collections.defaultdict(list)
+    for root, dirs, names in tree_index.walk(path):
+        levels[root.count(os.sep)].append(root)
+        for name in names+[d for d in dirs if tree_index.get(os.path.join(root, d)).children is None]:
+            entry=tree_index.get(os.path.join(root, name))
+            files.append((os.path.join(root, name), entry.size if not entry.is_link else 0))
+    sizes=dict(files)
+    counts=DeleteCounts(outlog); failures=0
+    for child, error in run_bounded(os.unlink, (child for child, size in files)):
+        if error is None or isinstance(error, FileNotFoundError):
+            counts.add(child, sizes[child])
+        else:
+            counts.failed(child, error); failures+=1
+    for depth in sorted(levels, reverse=True):
+        for directory, error in run_bounded(os.rmdir, levels[depth]):
+            if error is not None and error.errno==errno.ENOTEMPTY and not failures:
+                ## something was written into the directory after the scan
+                try:
+                    shutil.rmtree(directory)
+                    error=None
+                except OSError as e:
+                    error=e
+            if error is not None and not isinstance(error, FileNotFoundError):
+                counts.failed(directory, error); failures+=1
+    phases.count("deletion", files=len(files)+sum(len(dirs) for dirs in levels.values()))
+    tree_index.remove(path)
+    if os.path.lexists(path):
+        tree_index.add(path)
+    counts.write()
+    deleted=[sum(column) for column in zip(*counts.dirs.values())] or [0, 0]
+    write_logs(f"Deleted_{outlog}\t{path}\t{deleted[0]}\t{convert_bytes(deleted[1])}")
+
+@phases.timed("deletion")
+def delete_paths(paths, outlog):
+    ## delete_files for a stream of paths: regular files are unlinked in parallel and logged per directory,
+    ## directories and symlinks go through delete_files one by one. paths is consumed lazily, at most the batches
+    ## queued by run_bounded ahead of the unlinks, so a generator of matches is never held as a whole.
+    ## Returns the number of paths
+    handed=0
+    if dry_run:
+        for path in paths:
+            delete_files(path, outlog); handed+=1
+        return handed
+    sizes={}
+    def files():
+        nonlocal handed
+        for path in paths:
+            handed+=1
+            entry=tree_index.get(path)
+            if entry is not None and entry.is_file and not entry.is_link:
+                path=os.path.normpath(str(path))
+                sizes[path]=entry.size
+                phases.count("deletion", files=1)
+                yield path
+            else:
+                delete_files(path, outlog)
+    counts=DeleteCounts(outlog)
+    for path, error in run_bounded(os.unlink, files()):
+        if error is None:
+            counts.add(path, sizes.pop(path))
+        else:
+            sizes.pop(path, None)
+            counts.failed(path, error)
+        if error is None or isinstance(error, FileNotFoundError):
+            tree_index.remove(path)
+    counts.write()
+    return handed
+
+def index_glob(path, suffix):
+    ## equivalent of glob.glob(path + '/*' + suffix) answered from the index
+    return [p for p in tree_index.listdir(path) if not os.path.basename(p).startswith('.') and p.endswith(suffix)]
+
+@phases.timed("traversal")
 def find_empty_files(path):
-    empty_files=[]
-    for root, dirs, files in os.walk(path):
+    ## yields the empty files as the walk finds them; the run's own log files, empty until their first flush, are
+    ## not among them (--watch indexes them once they appear in --dir)
+    own={os.path.normpath(str(logfile)) for logfile in list(loggers)}
+    for root, dirs, files in tree_index.walk(path, True):
         for filename in files:
             filepath = os.path.join(root, filename)
-            if os.path.isfile(filepath):
-                # Get the metadata of the file using os.stat()
-                stat_info = os.stat(filepath)
-                if stat_info.st_size == 0:
-                    empty_files.append(filepath)
-    return empty_files
+            entry=tree_index.get(filepath)
+            # size was taken from the scandir stat when the index was built
+            if entry.is_file and entry.size == 0 and filepath not in own:
+                # or from the snapshot of the last run, for a file that was written to since
+                if tree_index.loaded_from_snapshot:
+                    try:
+                        if os.lstat(filepath).st_size:
+                            continue
+                    except OSError:
+                        continue
+                yield filepath
+
+def sample_content(path, sample_bytes=4<<20, block=64<<10):
+    ## a bounded, reproducible random sample of the bytes under path: (total bytes, tar members, sampled blocks)
+    files=[]
+    entry=tree_index.get(path)
+    if entry is not None and entry.is_file:
+        files.append((str(path), entry.size))
+    members=1
+    for root, dirs, names in tree_index.walk(path):
+        members+=len(dirs)+len(names)
+        for name in names:
+            child=tree_index.get(os.path.join(root, name))
+            if child.is_file and not child.is_link and child.size>0:
+                files.append((os.path.join(root, name), child.size))
+    total=sum(size for p, size in files)
+    if total==0:
+        return total, members, []
+    starts=list(itertools.accumulate(size for p, size in files))
+    if total<=sample_bytes:
+        picks=[(i, 0, size) for i, (p, size) in enumerate(files)]
+    else:
+        rng=random.Random(str(path))
+        picks=[]
+        for _ in range(sample_bytes//block):
+            offset=rng.randrange(total)
+            i=bisect.bisect_right(starts, offset)
+            within=offset-(starts[i]-files[i][1])
+            picks.append((i, within, min(block, files[i][1]-within)))
+    blocks=[]
+    for i, offset, length in picks:
+        try:
+            with open(files[i][0], "rb") as fh:
+                fh.seek(offset)
+                blocks.append(fh.read(length))
+        except OSError:
+            continue
+    return total, members, blocks
+
+def estimate_compressed_size(path, codec, sample_bytes=4<<20, block=64<<10):
+    ## compress a sample of the bytes under path and scale its ratio to the total;
+    ## tar headers are counted at a small compressed cost per member
+    total, members, blocks=sample_content(path, sample_bytes, block)
+    raw=sum(len(data) for data in blocks)
+    ratio=codec.sample_size(blocks)/raw if raw else 1.0
+    return int(total*ratio)+64*members+64
+
+def plan_compress(path, outlog):
+    ## --plan: what compress_validate_delete would do, applied to the index only
+    entry=tree_index.get(path)
+    if entry is None or entry.is_link:
+        write_logs(f"NotCompressed_{outlog}\t{path}")
+        return None
+    compressed_path=validated_archive(path, entry.is_dir, codec_for(outlog), tree_index.exists)
+    codec=codec_of(compressed_path) if compressed_path else choose_codec(path, outlog)[0]
+    compressed_path=compressed_path or archive_path(path, entry.is_dir, codec)
+    if compressed_path is None:
+        write_logs(f"NotCompressed_{codec.name}_{outlog}\t{path}")
+        return None
+    if not tree_index.exists(f"{compressed_path}.validated"):
+        estimate=estimate_compressed_size(path, codec)
+        tree_index.add_virtual(compressed_path, estimate)
+        tree_index.add_virtual(f"{compressed_path}.validated", 256+64*count_source_members(path))
+        write_logs(f"Compress_{outlog}\t{compressed_path}\t{convert_bytes(entry.tsize)}\t{convert_bytes(estimate)}")
+    delete_files(path, outlog)
+    return compressed_path
+
+def parse_size(text):
+    ## "500", "20M", "1.5G" -> bytes
+    match=re.fullmatch(r"\s*([0-9]+(?:\.[0-9]+)?)\s*([KMGT]?)B?\s*", text.upper())
+    if match is None:
+        raise argparse.ArgumentTypeError(f"invalid size {text}")
+    return int(float(match.group(1))*1024**" KMGT".index(match.group(2) or " "))
+
+def free_space(path):
+    ## bytes that can still be written on the filesystem of path (statvfs; a user quota is not visible here)
+    st=os.statvfs(path)
+    return st.f_bavail*st.f_frsize
+
+def chunk_limit(path, outlog):
+    ## source bytes per part when a directory has to be archived in parts: with --chunk_size when it is larger,
+    ## and with --headroom when even an incompressible archive of it might not fit in the free space; 0 when the
+    ## space above --min_free does not even hold a part of 1 MiB
+    entry=tree_index.get(path)
+    if entry is None or not entry.is_dir or entry.is_link or validated_archive(path, True, codec_for(outlog), tree_index.exists):
+        return None
+    if chunk_size and entry.tsize>chunk_size:
+        return chunk_size
+    if headroom:
+        free=free_space(path)-min_free
+        if entry.tsize>free:
+            return free//2 if free//2>=1<<20 else 0
+    return None
+
+def chunk_groups(path, limit):
+    ## the entries of path in groups of about limit source bytes; an entry larger than limit is a group of its own
+    groups=[]; size=limit
+    for child in sorted(tree_index.listdir(path)):
+        child_size=tree_index.get(child).tsize
+        if size+child_size>limit:
+            groups.append([]); size=0
+        groups[-1].append(child); size+=child_size
+    return groups
+
+def compress_in_parts(path, outlog, limit):
+    ## low-headroom mode: path.part001.tar.gz, path.part002.tar.gz, ... each of about limit source bytes; the
+    ## sources of a part are deleted as soon as the part is validated, so only one part is ever extra on disk.
+    ## Extracting every part restores the directory. Parts validated by an interrupted run are kept.
+    codec, prediction=choose_codec(path, outlog)
+    name=os.path.basename(os.path.normpath(str(path)))
+    done=re.compile(re.escape(name)+r"\.part\d{3,}\.tar[.a-z]*\.validated$")
+    archives=sorted(p[:-len(".validated")] for p in tree_index.listdir(os.path.dirname(os.path.normpath(str(path))))
+                    if done.match(os.path.basename(p)))
+    for group in chunk_groups(path, limit):
+        number=len(archives)+1
+        archive=f"{path}.part{number:03d}.tar{codec.suffix}"
+        start=time.monotonic()
+        manifest=write_tar_archive(archive, path, codec, outlog, group, with_root=(number==1))
+        write_codec_choice(outlog, archive, codec, prediction, manifest, time.monotonic()-start)
+        expected=sum(count_source_members(child) for child in group)+(number==1)
+        if not validate_compress_files(archive, outlog, manifest, expected=expected):
+            write_logs(f"NotDeleting_{outlog}")
+            return archives or None
+        journal_state(archive, path, "validated")
+        delete_paths(group, outlog)
+        journal_state(archive, path, "deleted")
+        archives.append(archive)
+    delete_files(path, outlog)
+    write_logs(f"Parts_{outlog}\t{path}\t{len(archives)}")
+    return archives
 
 def compress_validate_delete(path, outlog):
-    compressed_path=compress_files(path, outlog)
+    if bundling is not None:
+        ## reduce_bundle archives it with the other units
+        bundling.append(path)
+        return None
+    if dry_run:
+        return plan_compress(path, outlog)
+    limit=chunk_limit(path, outlog)
+    if limit==0:
+        write_logs(f"NoSpace_{outlog}\t{path}\t{convert_bytes(max(0, free_space(path)-min_free))} free above --min_free")
+        return None
+    if limit is not None:
+        return compress_in_parts(path, outlog, limit)
+    compressed_path, manifest=compress_files(path, outlog)
     if compressed_path:
-        validation_result=validate_compress_files(compressed_path, outlog)
+        validation_result=validate_compress_files(compressed_path, outlog, manifest, path)
     else:
         return 
     if  validation_result:
+        journal_state(compressed_path, path, "validated")
         delete_files(path, outlog)
+        journal_state(compressed_path, path, "deleted")
         return compressed_path
     else:
         write_logs(f"NotDeleting_{outlog}")
 
 def reduce_errandout(path, outlog):
-    for root, directories, files in os.walk(path):
-        for filename in files:
-            delete_files(os.path.join(root, filename), outlog)
     delete_files(path, outlog)
 
 def reduce_cobg_dir(path, outlog):
@@ -253,79 +2369,153 @@ def reduce_cobg_dir(path, outlog):
     pattern_to_compress=['.bg.bim','.bgs.bim']
     ##
     for pattern in pattern_to_delete:
-        matching_files=glob.glob(path + '/*' + pattern)
-        for match_file in matching_files:
-            delete_files(match_file, outlog)
+        delete_paths(index_glob(path, pattern), outlog)
     ##
     for pattern in pattern_to_compress:
-        matching_files=glob.glob(path + '/*' + pattern)
+        matching_files=index_glob(path, pattern)
         for match_file in matching_files:
             compress_path=compress_validate_delete(match_file, outlog)
 
 def reduce_tmp_report(path, outlog):
     pattern_to_delete=['.fam','.bim','.bed'] 
     for pattern in pattern_to_delete:
-        matching_files=glob.glob(path + '/*' + pattern)
-        for match_file in matching_files:
-            delete_files(match_file, outlog)
-    compress_path=compress_validate_delete(path, outlog)
-    return get_size(compress_path), 1
+        delete_paths(index_glob(path, pattern), outlog)
+    return compress_validate_delete(path, outlog)
 
 def reduce_pcaer_sub(path, outlog):
-    files_to_delete= find_files_or_dirs(path, r".*.menv.assomds.*qassoc$")+\
-            find_files_or_dirs(path, r".*.menv.mds.asso.pdf$")+ \
-            find_files_or_dirs(path, r".*.menv.mds.asso-nup.pdf.gz$")
+    files_to_delete= itertools.chain(find_files_or_dirs(path, r".*.menv.assomds.*qassoc$"),
+            find_files_or_dirs(path, r".*.menv.mds.asso.pdf$"),
+            find_files_or_dirs(path, r".*.menv.mds.asso-nup.pdf.gz$"))
 
-    for file in files_to_delete:
-        delete_files(file, outlog)
-    compress_path=compress_validate_delete(path, outlog)
-    return get_size(compress_path), 1
+    delete_paths(files_to_delete, outlog)
+    return compress_validate_delete(path, outlog)
 
 def reduce_dameta(path, outlog):
     files_to_delete= find_files_or_dirs(path, r".*metadaner.gz$")
-    for file in files_to_delete:
-        delete_files(file, outlog)
-    compress_path=compress_validate_delete(path, outlog)
-    return get_size(compress_path), 1
+    delete_paths(files_to_delete, outlog)
+    return compress_validate_delete(path, outlog)
 
 def reduce_report_sub(path , outlog):
-    files_to_delete= find_files_or_dirs(path, r"^daner.*meta.gz$")+\
-            find_files_or_dirs(path, r"^daner.*het.gz$")
-    for file in files_to_delete:
-        delete_files(file, outlog)
-    compress_path=compress_validate_delete(path, outlog)
-    return get_size(compress_path), 1
+    files_to_delete= itertools.chain(find_files_or_dirs(path, r"^daner.*meta.gz$"),
+            find_files_or_dirs(path, r"^daner.*het.gz$"))
+    delete_paths(files_to_delete, outlog)
+    return compress_validate_delete(path, outlog)
+
+def reduce_daner_sub(path, outlog):
+    files_to_delete= find_files_or_dirs(path, r"^dan_.*assoc.dosage.ngt.gz$")
+    delete_paths(files_to_delete, outlog)
+    return compress_validate_delete(path, outlog)
 
 def remove_zero_files(path, outlog):
-    empty_files=find_empty_files(path)
-    nfiles=len(empty_files)
-    if nfiles > 0:
-        for empty_file in empty_files:
-            delete_files(empty_file, outlog)
-    return nfiles
+    ## the empty files are deleted while the walk goes on
+    return delete_paths(find_empty_files(path), outlog)
+
+def bundle_members(name, parent):
+    ## the units of action name right inside parent that go into a bundle: directories under --bundle_under
+    ## without an archive of their own
+    if not bundle_limit:
+        return []
+    members=[]
+    for p in ACTION_BY_NAME[name].find(parent):
+        entry=tree_index.get(p)
+        if os.path.dirname(os.path.normpath(str(p)))==parent and entry is not None and entry.is_dir and not entry.is_link and \
+           entry.tsize<bundle_limit and not validated_archive(p, True, codec_for(name), tree_index.exists):
+            members.append(os.path.normpath(str(p)))
+    return sorted(set(members))
+
+def bundle_units(units):
+    ## --bundle_under: the small units of an action in one directory become one NAME-bundle unit on that directory,
+    ## in the place of the first of them; a unit alone in its directory is archived as usual
+    groups={}
+    for name, p in units:
+        if name in BUNDLE_ACTIONS and bundle_limit:
+            groups.setdefault((name, os.path.dirname(os.path.normpath(str(p)))), []).append(p)
+    bundled={}
+    for (name, parent), paths in groups.items():
+        members=set(bundle_members(name, parent))
+        if len(members & set(os.path.normpath(str(p)) for p in paths))>1:
+            bundled.update(((name, os.path.normpath(str(p))), parent) for p in paths if os.path.normpath(str(p)) in members)
+    kept=[]; seen=set()
+    for name, p in units:
+        parent=bundled.get((name, os.path.normpath(str(p))))
+        if parent is None:
+            kept.append((name, p))
+        elif (name, parent) not in seen:
+            seen.add((name, parent))
+            kept.append((BUNDLE_ACTIONS[name].name, parent))
+    return kept
+
+def reduce_bundle(parent, outlog):
+    ## each member is reduced by its action up to the archive, then all of them go into parent/ACTION.bundleNNN.tar.gz
+    ## in one sequential write, are validated in one pass against its manifest and deleted; the manifest maps every
+    ## unit to its members so one unit can be listed or extracted alone
+    global bundling
+    name=ACTION_BY_NAME[outlog].bundle_of
+    members=bundle_members(name, parent)
+    done=re.compile(re.escape(name)+r"\.bundle(\d{3,})\.tar")
+    if not members:
+        ## an interrupted run already deleted them
+        archives=[a for a in (journal.archives_of(parent) if journal is not None else []) if done.match(os.path.basename(a))]
+        return archives[0] if len(archives)==1 else archives or None
+    inodes=sum(count_source_members(p) for p in members); size=sum(get_size(p) for p in members)
+    bundling=[]
+    try:
+        for p in members:
+            ACTION_BY_NAME[name].reduce(p, name)
+        members=[p for p in bundling if tree_index.isdir(p)]
+    finally:
+        bundling=None
+    if not members:
+        return None
+    numbers=[int(m.group(1)) for m in (done.match(os.path.basename(p)) for p in tree_index.listdir(parent)) if m]
+    codec, prediction=choose_codec(max(members, key=get_size), name)
+    archive=os.path.join(parent, f"{name}.bundle{max(numbers, default=0)+1:03d}.tar{codec.suffix}")
+    if dry_run:
+        estimate=sum(estimate_compressed_size(p, codec) for p in members)
+        tree_index.add_virtual(archive, estimate)
+        tree_index.add_virtual(f"{archive}.validated", 256+64*inodes)
+        write_logs(f"Compress_{name}\t{archive}\t{convert_bytes(sum(get_size(p) for p in members))}\t{convert_bytes(estimate)}")
+        delete_paths(members, name)
+    else:
+        start=time.monotonic()
+        manifest=write_tar_archive(archive, parent, codec, name, members, with_root=False)
+        write_codec_choice(name, archive, codec, prediction, manifest, time.monotonic()-start)
+        base=os.path.basename(parent)
+        manifest["units"]={os.path.basename(p): [os.path.join(base, os.path.basename(p)), count_source_members(p), get_size(p)] for p in members}
+        if not validate_compress_files(archive, name, manifest, expected=sum(count_source_members(p) for p in members)):
+            write_logs(f"NotDeleting_{name}")
+            return archive
+        journal_state(archive, parent, "validated")
+        delete_paths(members, name)
+        journal_state(archive, parent, "deleted")
+    after=get_size(archive)
+    ## the archive and its .validated manifest are all that is left of them
+    write_logs(f"##Bundled_{name}\t{archive}\t{len(members)}\t{inodes}\t2\t{inodes-2}\t{convert_bytes(size)}\t{convert_bytes(after)}", "_",
+               fields={"event": f"Bundled_{name}", "archive": archive, "units": len(members), "inodes_before": inodes, "inodes_after": 2,
+                       "inodes_freed": inodes-2, "bytes_before": size, "bytes_after": after})
+    return archive
 
 def reduce_dasuqc1(path, outlog):
     status=0
-    if os.path.isdir(path):
+    if tree_index.isdir(path):
         ##
         for sub_dir in ['bg', 'bgs', 'bgn']:
             sub_dir_path = os.path.join(path, sub_dir)
-            if os.path.isdir(sub_dir_path):
+            if tree_index.isdir(sub_dir_path):
                 delete_files(sub_dir_path, f"{outlog}/{sub_dir}")
                 status+=1
         ##
         sub_dir_qc1f=os.path.join(path, "qc1f")
         patterns=[".ngt"] # not to delete 
-        if os.path.isdir(sub_dir_qc1f):
-            files_to_delete = [file for file in glob.glob(os.path.join(sub_dir_qc1f, '*')) if not any(pattern in file for pattern in patterns)]
-            for file in files_to_delete:
-                delete_files(file, f"{outlog}/qc1f")
-                status+=1
+        if tree_index.isdir(sub_dir_qc1f):
+            files_to_delete = [file for file in index_glob(sub_dir_qc1f, '') if not any(pattern in file for pattern in patterns)]
+            delete_paths(files_to_delete, f"{outlog}/qc1f")
+            status+=len(files_to_delete)
             compress_validate_delete(sub_dir_qc1f, f"{outlog}/qc1f")
             status+=1
         ##
         sub_dir_info=os.path.join(path, "info")
-        if os.path.isdir(sub_dir_info):
+        if tree_index.isdir(sub_dir_info):
             compress_validate_delete(sub_dir_info, f"{outlog}/info")
             status+=1
     if status==0:
@@ -333,10 +2523,712 @@ def reduce_dasuqc1(path, outlog):
     else:
         return True 
 
+def find_matches(pattern, only_dirs=False):
+    def find(root):
+        paths=find_files_or_dirs(root, pattern, True)
+        return (p for p in paths if tree_index.isdir(p)) if only_dirs else paths
+    return find
+
+def find_grandparents(pattern):
+    ## pcaer_*/daner_* directories are found through the result files two levels below them
+    def find(root):
+        ## only the grandparents already yielded are remembered, not the matched files
+        seen=set()
+        for p in find_files_or_dirs(root, pattern, True):
+            grandparent=os.path.dirname(os.path.dirname(p))
+            if grandparent not in seen:
+                seen.add(grandparent)
+                yield grandparent
+    return find
+
+class Action(object):
+    ## report: "always" logs every unit, "changed" only units whose size/count changed (cobg-dir),
+    ## "status" only units the reducer acted on (dasuqc1), "count" one line with the number of deleted files (size-zero)
+    ## compresses: False for actions that only delete, which need no headroom
+    ## bundles: its units are directories that end in compress_validate_delete, which --bundle_under can archive
+    ## together (in a unit of the NAME-bundle action bundle_of=NAME)
+    def __init__(self, name, option, label, total, find, reduce, report="always", compresses=True, bundles=False, bundle_of=None):
+        self.name=name; self.option=option
+        self.label=label; self.total=total
+        self.find=find; self.reduce=reduce; self.report=report; self.compresses=compresses
+        self.bundles=bundles; self.bundle_of=bundle_of
+
+ACTIONS=[
+    Action("size-zero",  "gen_clean",  "Deleted_size-0",    None,               lambda root: [root],                                     remove_zero_files, "count", compresses=False),
+    Action("errandout",  "gen_clean",  "Deleted_errandout", "Total_errandout",  find_matches("^errandout$"),                             reduce_errandout, compresses=False),
+    Action("tmp-report", "qc1_clean",  "dCVD_tmp-report",   "Total_tmp-report", find_matches(r"^tmp_report_.*\d$"),                      reduce_tmp_report, bundles=True),
+    Action("cobg-dir",   "imp_clean",  "Reduced_cobg-dir",  "Total_cobg-dir",   find_matches("^cobg_dir_genome_wide.*$"),                reduce_cobg_dir, "changed"),
+    Action("dasuqc1",    "imp_clean",  "Reduce_dasuqc1",    "Total_dasuqc1",    find_matches(r"^dasuqc1_.*", True),                       reduce_dasuqc1, "status"),
+    Action("pcaer-sub",  "pca_clean",  "dCVD_pacer-sub",    "Total_pcaer-sub",  find_grandparents(r".*.menv.assomds.*qassoc$"),           reduce_pcaer_sub, bundles=True),
+    Action("resdaner",   "post_clean", "CVD_resdaner",      "Total_resdaner",   find_matches("^resdaner$"),                              compress_validate_delete, bundles=True),
+    Action("danscore",   "post_clean", "CVD_danscore",      "Total_danscore",   find_matches(r"^danscore_.*(?<!tar\.gz)$", True),        compress_validate_delete, bundles=True),
+    Action("report-sub", "post_clean", "CVD_report-sub",    "Total_report-sub", find_matches(r"^report_.*(?<!tar\.gz)$", True),          reduce_report_sub, bundles=True),
+    Action("dameta",     "post_clean", "dCVD_dameta",       "Total_dameta-sub", find_matches(r"^dameta_.*(?<!tar\.gz)$", True),          reduce_dameta, bundles=True),
+    Action("daner-sub",  "post_clean", "dCVD_daner-sub",    "Total_daner-sub",  find_grandparents(r"^dan_.*assoc.dosage.ngt.gz$"),        reduce_daner_sub, bundles=True),
+]
+## base action name -> the action of its bundles
+BUNDLE_ACTIONS={action.name: Action(f"{action.name}-bundle", action.option, f"Bundled_{action.name}", f"Total_{action.name}-bundle",
+                                    lambda root: [], reduce_bundle, bundle_of=action.name) for action in ACTIONS if action.bundles}
+ACTION_BY_NAME={action.name: action for action in ACTIONS+list(BUNDLE_ACTIONS.values())}
+
+def selected_actions(args):
+    return [action for action in ACTIONS if args.all_actions or getattr(args, action.option)]
+
+@phases.timed("traversal")
+def plan_units(root, actions):
+    ## every (action, path) unit of the run, in the order the actions run
+    units=[]
+    for action in actions:
+        try:
+            units.extend((action.name, p) for p in action.find(root))
+        except Exception as e:
+            write_logs(f"ERROR_{action.name}_{e}")
+    return units
+
+def unit_dependencies(units):
+    ## a unit waits for every earlier unit on the same path, an ancestor or a descendant of it
+    ## (e.g. dasuqc1_*/qc1f inside a daner_* directory); disjoint subtrees can run at the same time
+    exact={}; below={}; deps=[]
+    for i, (name, path) in enumerate(units):
+        ancestors=[]
+        p=os.path.normpath(str(path))
+        while True:
+            ancestors.append(p)
+            parent=os.path.dirname(p)
+            if parent==p:
+                break
+            p=parent
+        unit_deps=set(below.get(ancestors[0], ()))
+        for a in ancestors:
+            unit_deps.update(exact.get(a, ()))
+        deps.append(unit_deps)
+        exact.setdefault(ancestors[0], []).append(i)
+        for a in ancestors:
+            below.setdefault(a, []).append(i)
+    return deps
+
+def shard_units(units, weights, shards):
+    ## the unit indexes of every shard, in plan order, with about equal weight (estimated bytes) per shard.
+    ## Overlapping units (an errandout inside a tmp_report_*, a dasuqc1_*/qc1f inside a daner_*) are kept in one
+    ## shard so two tasks never work on the same subtree. The size-zero unit covers the whole tree: each shard runs
+    ## it on its own subtrees and --merge_shards on the rest.
+    sharded=[i for i, (name, p) in enumerate(units) if ACTION_BY_NAME[name].report!="count"]
+    group=list(range(len(sharded)))
+    def find(i):
+        while group[i]!=i:
+            group[i]=group[group[i]]; i=group[i]
+        return i
+    for i, unit_deps in enumerate(unit_dependencies([units[i] for i in sharded])):
+        for d in unit_deps:
+            group[find(i)]=find(d)
+    components={}
+    for i in range(len(sharded)):
+        components.setdefault(find(i), []).append(sharded[i])
+    ## largest first onto the lightest shard
+    loads=[0]*shards; members=[[] for _ in range(shards)]
+    for component in sorted(components.values(), key=lambda c: (-sum(weights[i] for i in c), c[0])):
+        k=min(range(shards), key=lambda k: (loads[k], k))
+        loads[k]+=sum(weights[i] for i in component)
+        members[k].extend(component)
+    return [sorted(m) for m in members]
+
+def snapshot_path():
+    return f'{global_path}/reduce_size.snapshot.gz'
+
+def shard_result_path(index, shards):
+    return f'{global_path}/reduce_size_{filestamp}.shard{index}of{shards}.json'
+
+def init_worker():
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_unit(name, path, changes=None):
+    ## executed in a worker process: replay the changes made by earlier overlapping units, run the reducer,
+    ## and hand the log lines and index changes back to the main process
+    global log_capture, profiler
+    log_capture=[]
+    tree_index.apply(changes or [])
+    tree_index.changes=[]
+    phases.take_unit()
+    if profile_mode and (profiler is None or profiler.pid!=os.getpid()):
+        profiler=start_profiler()
+    if profile_mode:
+        profiler.enable()
+    try:
+        result=ACTION_BY_NAME[name].reduce(path, name)
+    except Exception as e:
+        write_logs(f"ERROR_{name}_{e}")
+        result=None
+    if profile_mode:
+        profiler.disable()
+        profiler.dump_stats(f"{profile_path()}.{os.getpid()}")
+    write_throttle_stats(name, path)
+    return result, log_capture, tree_index.changes, phases.take_unit()
+
+class RunTotals(object):
+    def __init__(self):
+        self.each={}  # action name -> [size, count, alloc, rsize, rcount, ralloc, reported]
+        self.active=[0, 0, 0, 0, 0, 0]
+        self.rows=[]  # (action, path, before, after, result) of every unit, for the --plan file and --resume totals
+
+    def add(self, action, path, before, after, result):
+        size, count, alloc=before; rsize, rcount, ralloc=after
+        self.rows.append((action.name, str(path), before, after, result))
+        if action.report=="count":
+            if result:
+                ## a streamed run or a shard counts each of its directories on its own line
+                write_summary(action.label, (0, result, 0), (0, 0, 0), "NA" if tree_index is None or os.path.normpath(str(path))==tree_index.root else path)
+            self.active[1]+=result or 0
+            return
+        report=(action.report=="always") or \
+               (action.report=="changed" and (convert_bytes(size)!=convert_bytes(rsize) or count!=rcount)) or \
+               (action.report=="status" and bool(result))
+        if report:
+            write_summary(action.label, before, after, path)
+        totals=self.each.setdefault(action.name, [0, 0, 0, 0, 0, 0, False])
+        for i, value in enumerate((size, count, alloc, rsize, rcount, ralloc)):
+            totals[i]+=value; self.active[i]+=value
+        totals[6]|=report
+
+    def write(self, path):
+        for action in [a for action in ACTIONS for a in (action, BUNDLE_ACTIONS.get(action.name)) if a is not None]:
+            totals=self.each.get(action.name)
+            if totals is None or not totals[6]:
+                continue
+            ts, tc, ta, rts, rtc, rta, _=totals
+            if action.report=="changed" and convert_bytes(ts)==convert_bytes(rts) and tc==rtc:
+                continue
+            write_summary(action.total, (ts, tc, ta), (rts, rtc, rta), "NA")
+        size, count, alloc, rsize, rcount, ralloc=self.active
+        write_summary("Total_active", (size, count, alloc), (rsize, rcount, ralloc), path)
+
+def topmost_paths(paths):
+    ## drop every path that lies inside another one of the list
+    kept=[]
+    for p in sorted(set(os.path.normpath(str(p)) for p in paths)):
+        if not kept or not p.startswith(os.path.join(kept[-1], "")):
+            kept.append(p)
+    return kept
+
+def tree_index_root_needed(paths, root):
+    return any(os.path.normpath(str(p))==os.path.normpath(str(root)) for p in paths)
+
+def unit_archives(path, result):
+    ## the archives a unit wrote next to its path: one, or the parts of a low-headroom run
+    archives=[result] if isinstance(result, str) else result if isinstance(result, list) else []
+    return [a for a in archives if not a.startswith(os.path.join(str(path), ""))]
+
+def unit_stats(name, path):
+    ## a bundle unit is its members, not the rest of their directory
+    bundle_of=ACTION_BY_NAME[name].bundle_of
+    if bundle_of is None:
+        return get_stats(path)
+    return tuple(sum(values) for values in zip((0, 0, 0), *(get_stats(p) for p in bundle_members(bundle_of, path))))
+
+def estimate_unit(name, path, sample_bytes=1<<20):
+    ## --headroom: the archive size of a unit (of a bundle unit: of its members)
+    action=ACTION_BY_NAME[name]
+    if not action.compresses or not tree_index.exists(path):
+        return 0
+    if action.bundle_of is None:
+        return estimate_compressed_size(path, codec_for(name), sample_bytes=sample_bytes)
+    return sum(estimate_compressed_size(p, codec_for(action.bundle_of), sample_bytes=sample_bytes) for p in bundle_members(action.bundle_of, path))
+
+@phases.timed("accounting")
+def unit_after_stats(name, path, result):
+    ## what is left of the unit: its own path plus the archives written next to it (of a bundle unit: what is left
+    ## of its members plus the bundle)
+    after=list(unit_stats(name, path))
+    if ACTION_BY_NAME[name].bundle_of:
+        archives=[result] if isinstance(result, str) else result or []
+    else:
+        archives=unit_archives(path, result)
+    for archive in archives:
+        after=[a+b for a, b in zip(after, get_stats(archive))]
+    return tuple(after)
+
+def execute_units(units, totals, jobs=1, resumed=None, needs=None, first=0):
+    ## resumed: {seq: (state, before, after, result)} from the journal of an interrupted run; finished units are
+    ## only replayed into the totals, units that were running keep the "before" numbers measured the first time.
+    ## needs: --headroom estimate of the extra space each unit takes; units then start smallest first (an
+    ## overlapping earlier unit still goes first) and a worker is only given a unit that fits in the free space.
+    ## first: journal seq of units[0] (a streamed run journals the units of each directory after the earlier ones)
+    resumed=resumed or {}
+    deps=unit_dependencies(units)
+    order=needs or range(len(units))
+    befores=[None]*len(units)
+    for i, (state, before, after, result) in resumed.items():
+        befores[i]=tuple(before) if before else None
+
+    def start(i):
+        name, path=units[i]
+        if i in resumed and resumed[i][0] in ("done", "skipped"):
+            return False
+        if ACTION_BY_NAME[name].report!="count" and not tree_index.exists(path):
+            if befores[i] is not None and journal is not None and journal.archives_of(path):
+                return True  # interrupted after its source was deleted: only the accounting is left
+            if journal is not None:
+                journal.unit_state(first+i, "skipped")
+            return False  # removed by an earlier unit, e.g. an errandout inside tmp_report_*
+        if befores[i] is None:
+            befores[i]=unit_stats(name, path)
+        if journal is not None:
+            journal.unit_state(first+i, "running", before=befores[i])
+        return True
+
+    def reduce(i):
+        name, path=units[i]
+        if not tree_index.exists(path) and ACTION_BY_NAME[name].report!="count":
+            archives=journal.archives_of(path) if journal is not None else []
+            for archive in archives:
+                tree_index.add(archive)
+            return archives[0] if len(archives)==1 else archives
+        return ACTION_BY_NAME[name].reduce(path, name)
+
+    def finish(i, result, after=None, spent=None):
+        ## after: the unit's numbers measured when it completed, before later units changed its subtree;
+        ## spent: the phases of a unit that ran in a worker process
+        name, path=units[i]
+        try:
+            if i in resumed and resumed[i][0]=="done":
+                state, before, after, result=resumed[i]
+                totals.add(ACTION_BY_NAME[name], path, tuple(before), tuple(after), result)
+                return
+            if after is None:
+                after=unit_after_stats(name, path, result)
+            if spent is None:
+                spent=phases.take_unit()
+            else:
+                phases.merge(spent)
+            write_unit_phases(name, path, spent)
+            totals.add(ACTION_BY_NAME[name], path, befores[i], after, result)
+            if journal is not None:
+                journal.unit_state(first+i, "done", after=after, result=result)
+        except Exception as e:
+            write_logs(f"ERROR_{name}_{e}")
+
+    dependents=[[] for _ in units]
+    waiting=[len(d) for d in deps]
+    for i, unit_deps in enumerate(deps):
+        for d in unit_deps:
+            dependents[d].append(i)
+    ready=[(order[i], i) for i in range(len(units)) if waiting[i]==0]
+    heapq.heapify(ready)
+
+    def release(i):
+        for d in dependents[i]:
+            waiting[d]-=1
+            if waiting[d]==0:
+                heapq.heappush(ready, (order[d], d))
+
+    if jobs<=1:
+        while ready:
+            _, i=heapq.heappop(ready)
+            name, path=units[i]
+            phases.take_unit()
+            if not start(i):
+                if i in resumed and resumed[i][0]=="done":
+                    finish(i, None)
+                release(i)
+                continue
+            try:
+                result=reduce(i)
+            except Exception as e:
+                write_logs(f"ERROR_{name}_{e}")
+                result=None
+            finish(i, result)
+            write_throttle_stats(name, path)
+            release(i)
+        return
+
+    ## scheduling over a fork-based process pool: a unit is submitted once all overlapping earlier units have
+    ## finished; results are written back in plan order so the logs are deterministic
+    changes=[[] for _ in units]
+    done={}; next_to_write=0; running={}
+
+    def complete(i, outcome):
+        release(i)
+        done[i]=outcome
+
+    def fits(i):
+        ## the running units may still write up to their own estimate
+        return not running or needs[i]<=free_space(tree_index.root)-min_free-sum(needs[r] for r in running.values())
+
+    pool=concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork"), initializer=init_worker)
+    try:
+        while ready or running:
+            while ready and len(running)<jobs:
+                if needs is not None and not fits(ready[0][1]):
+                    break
+                _, i=heapq.heappop(ready)
+                if not start(i):
+                    complete(i, (None, [], None, None) if i in resumed and resumed[i][0]=="done" else None)
+                    continue
+                name, path=units[i]
+                if not tree_index.exists(path) and ACTION_BY_NAME[name].report!="count":
+                    result=reduce(i)
+                    complete(i, (result, [], unit_after_stats(name, path, result), {}))
+                    continue
+                prefix=os.path.join(os.path.normpath(str(path)), "")
+                replay=[c for d in sorted(deps[i]) for c in changes[d] if (c[1]+os.sep).startswith(prefix)]
+                running[pool.submit(run_unit, name, str(path), replay)]=i
+            if running:
+                finished, _=concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    i=running.pop(future)
+                    try:
+                        result, logs, unit_changes, spent=future.result()
+                    except Exception as e:
+                        result, logs, unit_changes, spent=None, [(log_path("all"), Logger.format(f"ERROR_{units[i][0]}_{e}"))], [], {}
+                    tree_index.apply(unit_changes)
+                    changes[i]=unit_changes
+                    complete(i, (result, logs, unit_after_stats(*units[i], result), spent))
+            while next_to_write in done:
+                outcome=done.pop(next_to_write)
+                if outcome is not None:
+                    result, logs, after, spent=outcome
+                    for logfile, text in logs:
+                        get_logger(logfile).write(text)
+                    finish(next_to_write, result, after, spent)
+                next_to_write+=1
+    except BaseException:
+        ## SIGTERM/Ctrl-C: do not leave workers compressing behind a dead main process
+        for process in list(getattr(pool, "_processes", {}).values()):
+            process.terminate()
+        pool.shutdown(wait=True, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+def plan_top(top, actions):
+    ## the units of one top-level directory of a streamed run: the matchers walk only --dir's own listing and top.
+    ## Returns them, with the units found on --dir itself (a grandparent match), which wait for the last step
+    top=os.path.normpath(str(top)); root=tree_index.root
+    tree_index.skip={p for p in tree_index.listdir(root) if tree_index.isdir(p) and p!=top}
+    units=[]; on_root=[]
+    try:
+        for name, p in plan_units(root, actions):
+            p=os.path.normpath(str(p))
+            if ACTION_BY_NAME[name].report=="count":
+                units.append((name, top))
+            elif p==top or p.startswith(os.path.join(top, "")):
+                units.append((name, p))
+            elif p==root:
+                on_root.append((name, p))
+    finally:
+        tree_index.skip=set()
+    return bundle_units(units), on_root
+
+def plan_root_level(actions, on_root):
+    ## the last step of a streamed run: the units right in --dir (and on --dir itself) and its own empty files; the
+    ## top-level directories stay in tree_index.skip while they run
+    root=tree_index.root
+    tree_index.skip={p for p in tree_index.listdir(root) if tree_index.isdir(p)}
+    units=[(name, root if ACTION_BY_NAME[name].report=="count" else p) for name, p in plan_units(root, actions)
+           if ACTION_BY_NAME[name].report=="count" or (os.path.dirname(os.path.normpath(str(p)))==root and os.path.normpath(str(p)) not in tree_index.skip)]
+    return list(dict.fromkeys(units+on_root))
+
+def stream_units(tops, actions, totals, jobs, before, evict=False):
+    ## a run without a snapshot: the top-level directories of --dir are scanned, planned and run one at a time, so the
+    ## first units start once the first directory is scanned and only one directory's units are queued at a time.
+    ## before: (size, files, alloc) of --dir so far, to which each scanned directory is added. evict (--low_memory):
+    ## a finished directory is dropped from the index except for its totals. Returns the units that ran
+    units=[]; on_root=[]
+    for k, top in enumerate(tops):
+        if tree_index.add(top) is None:
+            continue
+        before[:]=[a+b for a, b in zip(before, get_stats(top))]
+        step, root_units=plan_top(top, actions)
+        on_root.extend(root_units)
+        if journal is not None:
+            journal.plan(step, len(units))
+            journal.set("unscanned", tops[k+1:]+[tree_index.root]); journal.set("total_before", before)
+        write_logs(f"Streamed\t{top}\t{len(step)} units\t{k+1} of {len(tops)} directories")
+        execute_units(step, totals, jobs, first=len(units))
+        units.extend(step)
+        if evict:
+            tree_index.collapse(top)
+        flush_logs()
+    final=plan_root_level(actions, on_root)
+    if journal is not None:
+        journal.plan(final, len(units)); journal.set("unscanned", [])
+    try:
+        execute_units(final, totals, jobs, first=len(units))
+    finally:
+        tree_index.skip=set()
+    return units+final
+
+class InotifyWatcher(object):
+    ## directories changed under --dir, from Linux inotify through ctypes: one watch per directory, added for new
+    ## directories as they appear. Only changes made by this machine are reported.
+    IN_MODIFY=0x2; IN_ATTRIB=0x4; IN_CLOSE_WRITE=0x8; IN_MOVED_FROM=0x40; IN_MOVED_TO=0x80; IN_CREATE=0x100
+    IN_DELETE=0x200; IN_DELETE_SELF=0x400; IN_MOVE_SELF=0x800; IN_Q_OVERFLOW=0x4000; IN_IGNORED=0x8000; IN_ONLYDIR=0x1000000
+    def __init__(self, dirs):
+        self.libc=ctypes.CDLL(None, use_errno=True)
+        self.fd=self.libc.inotify_init1(os.O_NONBLOCK|os.O_CLOEXEC)
+        if self.fd<0:
+            raise OSError(ctypes.get_errno(), f"inotify_init1: {os.strerror(ctypes.get_errno())}")
+        self.mask=self.IN_MODIFY|self.IN_ATTRIB|self.IN_CLOSE_WRITE|self.IN_MOVED_FROM|self.IN_MOVED_TO|self.IN_CREATE| \
+                  self.IN_DELETE|self.IN_DELETE_SELF|self.IN_MOVE_SELF|self.IN_ONLYDIR
+        self.paths={}  # watch descriptor -> directory
+        self.watched=set()
+        for path in dirs:
+            self.watch(path)
+
+    def watch(self, path):
+        wd=self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd<0:
+            error=ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return
+            ## ENOSPC: more directories than fs.inotify.max_user_watches
+            raise OSError(error, f"inotify_add_watch {path}: {os.strerror(error)}")
+        self.paths[wd]=path; self.watched.add(path)
+
+    def changes(self, timeout):
+        ## the directories with an event within timeout seconds; None when the kernel queue overflowed
+        changed=set(); overflow=False
+        ready, _, _=select.select([self.fd], [], [], max(0, timeout))
+        while ready:
+            try:
+                data=os.read(self.fd, 1<<16)
+            except BlockingIOError:
+                break
+            offset=0
+            while offset+16<=len(data):
+                wd, mask, cookie, length=struct.unpack_from("iIII", data, offset)
+                offset+=16+length
+                overflow=overflow or bool(mask&self.IN_Q_OVERFLOW)
+                path=self.paths.get(wd)
+                if path is not None:
+                    changed.add(path)
+                if mask&self.IN_IGNORED:
+                    self.paths.pop(wd, None); self.watched.discard(path)
+        return None if overflow else changed
+
+    def close(self):
+        os.close(self.fd)
+
+## written from compute nodes: inotify on this machine would not see those changes
+SHARED_FILESYSTEMS=("gpfs", "lustre", "nfs", "nfs4", "cifs", "smb3", "beegfs", "panfs", "ceph", "fuse.glusterfs", "fuse.sshfs")
+
+def filesystem_type(path):
+    ## type of the mount holding path, from /proc/mounts ("" when it cannot be told)
+    path=os.path.realpath(path); mount, kind="", ""
+    try:
+        with open("/proc/mounts") as fh:
+            for line in fh:
+                fields=line.split()
+                if len(fields)<3:
+                    continue
+                point=fields[1].replace("\\040", " ")
+                if (path==point or path.startswith(os.path.join(point, ""))) and len(point)>=len(mount):
+                    mount, kind=point, fields[2]
+    except OSError:
+        pass
+    return kind
+
+def newest_change(path):
+    ## latest mtime or ctime of path and everything below it, stat'ed on disk (the index does not see a file grow
+    ## in place); None when path is gone. --watch only does this for a unit that is about to run
+    if not os.path.lexists(path):
+        return None
+    newest=0
+    for p in itertools.chain([path], (os.path.join(root, name) for root, dirs, files in tree_index.walk(path) for name in dirs+files)):
+        try:
+            st=os.lstat(p)
+        except OSError:
+            continue
+        newest=max(newest, st.st_mtime, st.st_ctime)
+    return newest
+
+def indexed_change(path):
+    ## latest mtime of path and everything below it, as the index has it
+    newest=tree_index.get(path).mtime
+    for root, dirs, files in tree_index.walk(path):
+        newest=max([newest]+[tree_index.get(os.path.join(root, name)).mtime for name in dirs+files])
+    return newest
+
+def watch_top(path):
+    ## where the matchers look again after path changed: two levels up, not above --dir
+    for _ in range(2):
+        if path==tree_index.root or not path.startswith(os.path.join(tree_index.root, "")):
+            break
+        path=os.path.dirname(path)
+    return path if path.startswith(tree_index.root) else tree_index.root
+
+def watch_units(actions, totals, jobs, quiet, interval, mode="auto"):
+    ## --watch: keep the index up to date (inotify, or a stat of every directory) and every interval run the units
+    ## whose subtree has not changed for quiet seconds; a unit is only run again once something in it changed.
+    ## A unit's last change comes from the directories inotify or the stat pass reported, not from a stat of all of
+    ## its files each interval. Empty files are deleted in the units as they run and, as in a normal run, everywhere
+    ## else once a directory and everything below it has been quiet. Runs until SIGTERM/Ctrl-C and
+    ## returns the units still waiting, for the snapshot
+    if mode=="auto":
+        mode="poll" if filesystem_type(tree_index.root) in SHARED_FILESYSTEMS else "inotify"
+    watcher=None
+    polled=set()  # with inotify: directories it could not watch, polled with everything below them
+    if mode=="inotify":
+        try:
+            watcher=InotifyWatcher([])
+        except OSError as e:
+            write_logs(f"Watch_polling\t{e}")
+
+    def watch(path):
+        parent=path
+        while parent not in polled:
+            if parent==tree_index.root or parent==os.path.dirname(parent):
+                break
+            parent=os.path.dirname(parent)
+        if parent in polled:
+            return
+        try:
+            watcher.watch(path)
+        except OSError as e:
+            ## ENOSPC: more directories than fs.inotify.max_user_watches
+            if not polled:
+                write_logs(f"Watch_polling\t{path}\t{e}")
+            polled.add(path)
+
+    if watcher is not None:
+        for root, dirs, files in tree_index.walk(tree_index.root):
+            watch(root)
+    write_logs(f"Watching\t{tree_index.root}\t{'inotify' if watcher is not None else 'poll'}\tquiet {quiet:g}s\tinterval {interval:g}s"
+               +(f"\t{len(polled)} directories polled" if polled else ""))
+
+    def refresh(wait):
+        ## the directories changed within wait seconds (0: the ones changed so far)
+        if watcher is None:
+            time.sleep(wait)
+            return tree_index._refresh()
+        deadline=time.monotonic()+wait; dirs=set()
+        while True:
+            changed=watcher.changes(deadline-time.monotonic())
+            dirs=None if changed is None else dirs|changed
+            if dirs is None or time.monotonic()>=deadline:
+                break
+        changed=tree_index._refresh() if dirs is None else tree_index._refresh(sorted(dirs)) if dirs else []
+        for path in changed:
+            for root, subdirs, files in tree_index.walk(path):
+                if root not in watcher.watched:
+                    watch(root)
+        if polled:
+            changed+=tree_index._refresh(below=sorted(polled))
+        return changed
+
+    changed_at={}  # directory -> time its last change was seen, also set for the directories above it
+    def note(paths, when):
+        for path in paths:
+            while changed_at.get(path, 0)<when:
+                changed_at[path]=when
+                if path==tree_index.root or not path.startswith(tree_index.root):
+                    break
+                path=os.path.dirname(path)
+
+    found={}  # path -> its indexed_change when a matcher first found it
+    def last_change(path):
+        entry=tree_index.get(path)
+        if entry is None:
+            return None
+        if path not in found:
+            found[path]=indexed_change(path)
+        return max(found[path], changed_at.get(path if entry.children is not None else os.path.dirname(path), 0))
+
+    order={action.name: i for i, action in enumerate(actions)}
+    counted=[action.name for action in actions if action.report=="count"]
+    finders=[action for action in actions if action.report!="count"]
+    pending={}  # (action, path) -> None, found and not run yet
+    processed={}  # (action, path) -> last change when it ran
+    ## directories whose empty files the size-zero action has not looked at since they last changed
+    unswept=dict.fromkeys(root for root, dirs, files in tree_index.walk(tree_index.root)) if counted else {}
+    tops=[tree_index.root]
+    try:
+        while True:
+            for top in tops:
+                for action in finders:
+                    try:
+                        pending.update(((action.name, p), None) for p in action.find(top))
+                    except Exception as e:
+                        write_logs(f"ERROR_{action.name}_{e}")
+            now=time.time(); ready=[]
+            for name, p in list(pending):
+                newest=last_change(p)
+                if newest is None or processed.get((name, p))==newest:
+                    del pending[(name, p)]
+                elif now-newest>=quiet:
+                    ready.append((name, p))
+            ## only the units about to run are stat'ed on disk: a file written in place does not change its
+            ## directory, so polling does not see it
+            for name, p in list(ready):
+                newest=newest_change(p)
+                if newest is not None and now-newest<quiet:
+                    note([p if tree_index.isdir(p) else os.path.dirname(p)], newest)
+                    ready.remove((name, p))
+            if bundle_limit:
+                ## the small units of a directory are bundled once all of them are quiet
+                quiet_units=set(ready)
+                busy={(name, os.path.dirname(p)) for name, p in pending if name in BUNDLE_ACTIONS and (name, p) not in quiet_units and
+                      tree_index.exists(p) and tree_index.get(p).tsize<bundle_limit}
+                ready=[(name, p) for name, p in ready if (name, os.path.dirname(p)) not in busy]
+            ready.sort(key=lambda unit: order[unit[0]])
+            ## the topmost directories whose whole subtree is quiet: their empty files go, as --dir's do in a normal run
+            swept=set()
+            for d in list(unswept):
+                newest=last_change(d)
+                if newest is None:
+                    del unswept[d]
+                elif now-newest>=quiet:
+                    swept.add(d)
+            swept=set(topmost_paths(swept))
+            ours=[]
+            if ready or swept:
+                execute_units([(count, p) for name, p in ready for count in counted]+bundle_units(ready)+
+                              [(count, d) for d in sorted(swept) for count in counted], totals, jobs)
+                for d in list(unswept):
+                    parent=d
+                    while parent not in swept and parent!=tree_index.root and parent.startswith(tree_index.root):
+                        parent=os.path.dirname(parent)
+                    if parent in swept:
+                        del unswept[d]
+                ## what the units changed themselves is not a change to wait for
+                ours=refresh(0)
+                for unit in ready:
+                    processed[unit]=last_change(unit[1])
+                    del pending[unit]
+                flush_logs()
+            ## wait for changes; the matchers then run again two levels above every changed directory
+            ## (find_grandparents matches files two levels below a unit)
+            changed=refresh(interval)
+            note(changed, time.time())
+            if counted:
+                unswept.update((p, None) for p in changed if tree_index.isdir(p))
+            tops=topmost_paths(watch_top(p) for p in changed+ours)
+    except (KeyboardInterrupt, SystemExit):
+        write_logs(f"Watch_stopped\t{len(pending)} units waiting")
+    finally:
+        if watcher is not None:
+            watcher.close()
+    return list(pending)
+
 if __name__ == '__main__':
     start_time = time.time()
     args=parser.parse_args()
+    if args.ls or args.extract:
+        if args.ls:
+            list_archive(args.ls, args.member)
+        else:
+            extract_members(args.extract, args.member, args.out)
+        exit()
+    if args.dir is None:
+        parser.error("the following arguments are required: --dir")
     global_path=path=Path(args.dir)
+    log_json=args.log_json
+    profile_mode=args.profile
+    if profile_mode:
+        profiler=start_profiler()
+        profiler.enable()
+    ## a scheduler walltime kill (SIGTERM) still leaves complete log files behind
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128+signum))
+    threading.Thread(target=flush_logs_periodically, daemon=True).start()
     
     try:
         if os.path.islink(path):
@@ -348,247 +3240,267 @@ if __name__ == '__main__':
             exit()
 
         elif os.path.isdir(path):
-            single_size =0; single_count =0; rsingle_size=0; rsingle_count=0
-            total_each=[]
-            ##
-            if (args.all_actions) | (args.gen_clean) |  (args.qc1_clean) | (args.pca_clean) | (args.imp_clean) | (args.post_clean):
-                write_logs("Script-started", '0')
-                write_logs(f"##Version: {__version__}\n##ACTIONs\tSIZE_before\tnFILES_before\tSIZE_after\tnFILES_after\tPATH", "_")
-                total_size =convert_bytes(get_size(global_path)); total_files=count_files(global_path)
+            ## before the index is built: its Snapshot and Throttled lines already go to the --plan logs
+            dry_run=args.plan
+            if dry_run:
+                log_tag=".plan"
+            try:
+                read_limit=parse_size(args.read_limit) if args.read_limit else None
+                write_limit=parse_size(args.write_limit) if args.write_limit else None
+            except argparse.ArgumentTypeError as e:
+                parser.error(str(e))
+            ## --jobs worker processes each get an equal part of the limits
+            share=1 if args.plan else max(1, args.jobs)
+            read_throttle=Throttle("read", read_limit and read_limit/share, args.fair_share, "B", floor=1<<20)
+            write_throttle=Throttle("write", write_limit and write_limit/share, args.fair_share, "B", floor=1<<20)
+            ops_throttle=Throttle("ops", args.ops_limit and args.ops_limit/share, args.fair_share, floor=10)
+            if args.watch and (args.plan or args.from_plan or args.resume or args.shards>1 or args.merge_shards):
+                parser.error("--watch runs on its own: not with --plan, --from_plan, --resume, --shards or --merge_shards")
+            if args.low_memory and (args.plan or args.from_plan or args.resume or args.shards>1 or args.merge_shards or args.watch
+                                    or args.headroom or args.time_budget is not None):
+                parser.error("--low_memory runs the directories one at a time: not with --plan, --from_plan, --resume, --shards, --merge_shards, --watch, --headroom or --time_budget")
+            resumed={}
+            saved_plan=None
+            if args.from_plan:
+                with open(args.from_plan) as plan_fh:
+                    saved_plan=json.load(plan_fh)
+                if os.path.normpath(saved_plan["dir"])!=os.path.normpath(str(global_path)):
+                    print(f"Exiting: {args.from_plan} was planned for {saved_plan['dir']}.")
+                    exit()
+            shard=None; shard_of=None; tops=None
+            if args.shards>1 or args.merge_shards:
+                if saved_plan is None or args.plan:
+                    parser.error("--shards and --merge_shards run the units of a --from_plan plan")
+                ## every task works from the same plan; its time names the logs of all shards and of the merge
+                filestamp=saved_plan["created"]
+                weights=[before[0] for name, p, before, after in saved_plan["estimates"]]
+                shard_of=shard_units(saved_plan["units"], weights, args.shards)
+                if not args.merge_shards:
+                    shard=args.shard_index
+                    if shard is None and "SLURM_ARRAY_TASK_ID" in os.environ:
+                        shard=int(os.environ["SLURM_ARRAY_TASK_ID"])-int(os.environ.get("SLURM_ARRAY_TASK_MIN", 0))
+                    if shard is None or not 0<=shard<args.shards:
+                        parser.error(f"--shard_index must be 0 to {args.shards-1} (or set by SLURM_ARRAY_TASK_ID)")
+                    log_tag=f".shard{shard}of{args.shards}"
+            if not args.plan and not args.watch:
+                journal=Journal(args.journal or f'{global_path}/reduce_size{log_tag}.journal.sqlite')
+                ## an archive the previous run was still writing (or had not yet validated) is incomplete
+                for partial in (journal.partial_archives() if os.path.exists(journal.path) else []):
+                    if os.path.exists(partial):
+                        os.remove(partial)
+                    journal.archive_state(partial, "", "removed")
+                    print(f"Removed partial archive {partial}")
+                if args.resume and os.path.exists(journal.path) and journal.get("status")=="running":
+                    resumed={seq: (state, before, after, result) for seq, name, p, state, before, after, result in journal.units()}
+                elif args.resume:
+                    ## before the index is built or a log or journal file is created
+                    print(f"Nothing to resume in {global_path}.")
+                    exit()
+            if resumed:
+                ## only the subtrees of unfinished units are scanned again
+                saved=journal.units()
+                todo=[p for seq, name, p, state, before, after, result in saved if state not in ("done", "skipped")]
+                if tree_index_root_needed(todo, global_path) or journal.get("unscanned"):
+                    tree_index=TreeIndex(global_path)
+                else:
+                    tree_index=TreeIndex(global_path, topmost_paths(p for p in todo if os.path.lexists(p)))
+            elif shard is not None:
+                ## a shard only scans the subtrees of its own units
+                tree_index=TreeIndex(global_path, topmost_paths(p for name, p in (saved_plan["units"][i] for i in shard_of[shard]) if os.path.lexists(p)))
             else:
-                pass
+                ## the snapshot of the last finished run, when there is one, instead of a full scan; without one a plain
+                ## run is streamed: only the entries right in --dir now, each top-level directory when its turn comes
+                tree_index=None if args.full_scan or args.low_memory else TreeIndex.from_snapshot(global_path, snapshot_path())
+                if tree_index is None and (args.low_memory or not (args.plan or args.from_plan or args.shards>1 or args.merge_shards
+                                                                   or args.watch or args.headroom or args.time_budget is not None)):
+                    tree_index=TreeIndex(global_path, [])
+                    tops=tree_index.top_level()
+                tree_index=tree_index or TreeIndex(global_path)
+            write_throttle_stats("scan", global_path)
+            validate_mode=args.validate
+            recompress=args.recompress
+            headroom=args.headroom
+            try:
+                chunk_size=parse_size(args.chunk_size) if args.chunk_size else None
+                min_free=parse_size(args.min_free)
+            except argparse.ArgumentTypeError as e:
+                parser.error(str(e))
+            delete_threads=args.delete_threads
+            log_deleted=args.log_deleted
+            compress_threads=args.threads or max(1, (os.cpu_count() or 1)//max(1, args.jobs))
+            if resumed:
+                actions=[ACTION_BY_NAME[name] for name in journal.get("actions")]
+            elif args.from_plan:
+                actions=[ACTION_BY_NAME[name] for name in saved_plan["actions"]]
+            else:
+                actions=selected_actions(args)
+            if not {action.name for action in actions}<=tree_index.snapshot_actions:
+                ## the last run did not look for these: a settled directory may still hold their units
+                tree_index.skip=set()
+            ## codecs from the command line, otherwise the ones the interrupted run or the plan used
+            saved_codecs=(journal.get("codecs") if resumed else saved_plan.get("codecs") if args.from_plan else None) or {}
+            try:
+                default_codec=parse_codec(args.codec or saved_codecs.get("codec", "gzip"))
+                action_codecs=dict(parse_action_codec(spec) for spec in args.action_codec or saved_codecs.get("action_codec", []))
+                time_budget=args.time_budget if args.time_budget is not None else saved_codecs.get("time_budget")
+                bundle_limit=parse_size(args.bundle_under) if args.bundle_under else saved_codecs.get("bundle_under")
+            except argparse.ArgumentTypeError as e:
+                parser.error(str(e))
+            for codec in [default_codec]+list(action_codecs.values()):
+                if not codec.available():
+                    print(f"Exiting: the {codec.name} codec needs the {codec.name} command or Python module.")
+                    exit()
             ##
-            if (args.all_actions) | (args.gen_clean):
-                ##deleting all files with size 0
-                try:
-                    count=remove_zero_files(path, "size-zero")
-                    if count>0:
-                        write_logs(f"Deleted_size-0\t0B\t{count}\t0B\t0\tNA", "_")
-                    single_size +=0; single_count+=count
-                    rsingle_size+=0; rsingle_count+=0
-                except Exception as e:
-                    write_logs(f"ERROR_size-zero_{e}")
-                
-                ##removing all errandout directories
-                try:
-                    errandout_path=find_files_or_dirs(path, "^errandout$")
-                    ts=0; tc=0
-                    if len(errandout_path)>0:
-                        for p in errandout_path:
-                            size=get_size(p); count=count_files(p)
-                            ts+=size; tc+=count
-                            reduce_errandout(p, "errandout")
-                            write_logs(f"Deleted_errandout\t{convert_bytes(size)}\t{count}\t0B\t0\t{p}", "_")
-                        single_size +=ts; single_count+=tc
-                        rsingle_size+=0; rsingle_count+=0
-                        ts=convert_bytes(ts)
-                        total_each.append((f"Total_errandout\t{ts}\t{tc}\t0B\t0\tNA"))
-                except Exception as e:
-                    write_logs(f"ERROR_errandout_{e}")
-
-            if (args.all_actions) | (args.qc1_clean):
-                ##reducing tmp_report directories
-                try:
-                    tmp_path=find_files_or_dirs(path, r"^tmp_report_.*\d$")
-                    ts=0; tc=0; rts=0; rtc=0
-                    if len(tmp_path)>0:
-                        for p in tmp_path:
-                            size=get_size(p); count=count_files(p)
-                            ts+=size; tc+=count
-                            rsize, rcount=reduce_tmp_report(p, "tmp-report")
-                            rts+=rsize; rtc+=rcount
-                            write_logs(f"dCVD_tmp-report\t{convert_bytes(size)}\t{count}\t{convert_bytes(rsize)}\t{rcount}\t{p}", "_")
-                        single_size +=ts;     single_count+=tc
-                        rsingle_size+=rts;    rsingle_count+=rtc
-                        ts=convert_bytes(ts); rts=convert_bytes(rts)
-                        total_each.append((f"Total_tmp-report\t{ts}\t{tc}\t{rts}\t{rtc}\tNA"))
-                except Exception as e:
-                    write_logs(f"ERROR_tmp-report_{e}")
-
-            if (args.all_actions) | (args.imp_clean):
-               ##reducing cobg_dir  
-                try:
-                    cobg_path=find_files_or_dirs(path, "^cobg_dir_genome_wide.*$")
-                    ts=0; tc=0; rts=0; rtc=0
-                    if len(cobg_path)>0:
-                        for p in cobg_path:
-                            size=get_size(p); count=count_files(p)
-                            ts+=size; tc+=count
-                            reduce_cobg_dir(p,"cobg-dir")
-                            rsize=get_size(p); rcount=count_files(p)
-                            rts+=rsize; rtc+=rcount
-                            if (size!=rsize) | (count!=rcount):
-                                write_logs(f"Reduced_cobg-dir\t{convert_bytes(size)}\t{count}\t{convert_bytes(rsize)}\t{rcount}\t{p}", "_")
-                        single_size +=ts;     single_count+=tc
-                        rsingle_size+=rts;    rsingle_count+=rtc
-                        ts=convert_bytes(ts); rts=convert_bytes(rts)
-                        if (ts!=rts) | (tc!=rtc):
-                            total_each.append((f"Total_cobg-dir\t{ts}\t{tc}\t{rts}\t{rtc}\tNA"))
-                except Exception as e:
-                    write_logs(f"ERROR_cobg-dir_{e}")
-
-                ## CVD dasuqc1
-                try:
-                    dasuqc1_path=find_files_or_dirs(path, r"^dasuqc1_.*")
-                    ts=0; tc=0; rts=0; rtc=0;
-                    if len(dasuqc1_path)>0:
-                        status=False
-                        for p in dasuqc1_path:
-                            if os.path.isdir(p):
-                                size=get_size(p); count=count_files(p)
-                                ts+=size; tc+=count
-                                status=reduce_dasuqc1(p, "dasuqc1")
-                                rsize=get_size(p); rcount=count_files(p)
-                                rts+=rsize; rtc+=rcount
-                                if status:
-                                    write_logs(f"Reduce_dasuqc1\t{convert_bytes(size)}\t{count}\t{convert_bytes(rsize)}\t{rcount}\t{p}", "_")
-                        single_size +=ts;     single_count+=tc
-                        rsingle_size+=rts;    rsingle_count+=rtc
-                        ts=convert_bytes(ts); rts=convert_bytes(rts)
-                        if status:
-                            total_each.append((f"Total_dasuqc1\t{ts}\t{tc}\t{rts}\t{rtc}\tNA"))
-                except Exception as e:
-                    write_logs(f"ERROR_dasuqc1_{e}")
-            
-            if (args.all_actions) | (args.pca_clean):
-                ## reduce pcaer_sub
-                try:
-                    pca_qassoc_path= find_files_or_dirs(path, r".*.menv.assomds.*qassoc$")
-                    pca_assopdf_path=find_files_or_dirs(path, r".*.menv.mds.asso.pdf$")
-                    ts=0; tc=0; rts=0; rtc=0
-                    if (len(pca_qassoc_path)>0) | len(pca_assopdf_path)>0:
-                        pcaer_sub_path = list(set([os.path.dirname(os.path.dirname(p)) for p in pca_qassoc_path]))
-                        for p in pcaer_sub_path:
-                            size=get_size(p); count=count_files(p)
-                            ts+=size; tc+=count
-                            rsize, rcount=reduce_pcaer_sub(p, "pcaer-sub")
-                            rts+=rsize; rtc+=rcount
-                            write_logs(f"dCVD_pacer-sub\t{convert_bytes(size)}\t{count}\t{convert_bytes(rsize)}\t{rcount}\t{p}", "_")
-                        single_size +=ts;     single_count+=tc
-                        rsingle_size+=rts;    rsingle_count+=rtc
-                        ts=convert_bytes(ts); rts=convert_bytes(rts)
-                        total_each.append((f"Total_pcaer-sub\t{ts}\t{tc}\t{rts}\t{rtc}\tNA"))
-                except Exception as e:
-                    write_logs(f"ERROR_pcaer-sub_{e}")
-
-            if (args.all_actions) | (args.post_clean):
-                ###CVD resdaner
-                try:
-                    resdaner_path=find_files_or_dirs(path, "^resdaner$")
-                    ts=0; tc=0; rts=0; rtc=0
-                    if len(resdaner_path)>0:
-                        for p in resdaner_path:
-                            size=get_size(p); count=count_files(p)
-                            ts+=size; tc+=count
-                            compress_path=compress_validate_delete(p, "resdaner")
-                            rsize=get_size(compress_path); rcount=1
-                            rts+=rsize; rtc+=rcount
-                            write_logs(f"CVD_resdaner\t{convert_bytes(size)}\t{count}\t{convert_bytes(rsize)}\t{rcount}\t{p}", "_")
-                        single_size +=ts;     single_count+=tc
-                        rsingle_size+=rts;    rsingle_count+=rtc
-                        ts=convert_bytes(ts); rts=convert_bytes(rts)
-                        total_each.append((f"Total_resdaner\t{ts}\t{tc}\t{rts}\t{rtc}\tNA"))
-                except Exception as e:
-                     write_logs(f"ERROR_resdaner_{e}")
-
-                ### CVD danscore
-                try:
-                    danscore_path=find_files_or_dirs(path, r"^danscore_.*(?<!tar\.gz)$")
-                    ts=0; tc=0; rts=0; rtc=0
-                    if len(danscore_path)>0:
-                        for p in danscore_path:
-                            if os.path.isdir(p):
-                                size=get_size(p); count=count_files(p)
-                                ts+=size; tc+=count
-                                compress_path=compress_validate_delete(p, "danscore")
-                                rsize=get_size(compress_path); rcount=1
-                                rts+=rsize; rtc+=rcount
-                                write_logs(f"CVD_danscore\t{convert_bytes(size)}\t{count}\t{convert_bytes(rsize)}\t{rcount}\t{p}", "_")
-                        single_size +=ts;     single_count+=tc
-                        rsingle_size+=rts;    rsingle_count+=rtc
-                        ts=convert_bytes(ts); rts=convert_bytes(rts)
-                        total_each.append((f"Total_danscore\t{ts}\t{tc}\t{rts}\t{rtc}\tNA"))
-                except Exception as e:
-                    write_logs(f"ERROR_danscore_{e}")
-
-                #### CVD report 
-                try: 
-                    report_path=find_files_or_dirs(path, r"^report_.*(?<!tar\.gz)$")
-                    ts=0; tc=0; rts=0; rtc=0
-                    if len(report_path)>0:
-                        for p in report_path:
-                            if os.path.isdir(p):
-                                size=get_size(p); count=count_files(p)
-                                ts+=size; tc+=count
-                                rsize, rcount=reduce_report_sub(p, "report-sub")
-                                rts+=rsize; rtc+=rcount
-                                write_logs(f"CVD_report-sub\t{convert_bytes(size)}\t{count}\t{convert_bytes(rsize)}\t{rcount}\t{p}", "_")
-                        single_size +=ts;     single_count+=tc
-                        rsingle_size+=rts;    rsingle_count+=rtc
-                        ts=convert_bytes(ts); rts=convert_bytes(rts)
-                        total_each.append((f"Total_report-sub\t{ts}\t{tc}\t{rts}\t{rtc}\tNA"))
-                except Exception as e:
-                    write_logs(f"ERROR_report-sub_{e}")
-
-                #### Reduce dameta 
-                try:
-                    dameta_path=find_files_or_dirs(path, r"^dameta_.*(?<!tar\.gz)$")
-                    ts=0; tc=0; rts=0; rtc=0
-                    if len(dameta_path)>0:
-                        for p in dameta_path:
-                            if os.path.isdir(p):
-                                size=get_size(p); count=count_files(p)
-                                ts+=size; tc+=count
-                                rsize, rcount=reduce_dameta(p, "dameta")
-                                rts+=rsize; rtc+=rcount
-                                write_logs(f"dCVD_dameta\t{convert_bytes(size)}\t{count}\t{convert_bytes(rsize)}\t{rcount}\t{p}", "_")
-                        single_size +=ts;     single_count+=tc
-                        rsingle_size+=rts;    rsingle_count+=rtc
-                        ts=convert_bytes(ts); rts=convert_bytes(rts)
-                        total_each.append((f"Total_dameta-sub\t{ts}\t{tc}\t{rts}\t{rtc}\tNA"))
-                except Exception as e:
-                    write_logs(f"ERROR_dameta_{e}")
-
-                #### reduce daner_sub
-                try:
-                    assoc_dos_path=find_files_or_dirs(path, r"^dan_.*assoc.dosage.ngt.gz$")
-                    ts=0; tc=0; rts=0; rtc=0
-                    if len(assoc_dos_path)>0: 
-                        daner_paths = list(set([os.path.dirname(os.path.dirname(p)) for p in assoc_dos_path]))
-                        for p in daner_paths:
-                            size=get_size(p); count=count_files(p)
-                            ts+=size; tc+=count
-                            assoc_paths=  find_files_or_dirs(p, r"^dan_.*assoc.dosage.ngt.gz$")
-                            for assoc_path in assoc_paths:
-                                delete_files(assoc_path, "daner-sub")
-                            compress_path=compress_validate_delete(p, "daner-sub")
-                            rsize=get_size(compress_path); rcount=1
-                            rts+=rsize; rtc+=rcount
-                            write_logs(f"dCVD_daner-sub\t{convert_bytes(size)}\t{count}\t{convert_bytes(rsize)}\t{rcount}\t{p}", "_")
-                        single_size +=ts;     single_count+=tc
-                        rsingle_size+=rts;    rsingle_count+=rtc
-                        ts=convert_bytes(ts); rts=convert_bytes(rts)
-                        total_each.append((f"Total_daner-sub\t{ts}\t{tc}\t{rts}\t{rtc}\tNA"))
-                except Exception as e:
-                        write_logs(f"ERROR_daner-sub_{e}")
-
-            if not (args.all_actions) | (args.gen_clean) |  (args.qc1_clean) | (args.pca_clean) | (args.imp_clean) | (args.post_clean):
-                total_size =convert_bytes(get_size(global_path)); total_files=count_files(global_path)
-                print(f"\nNo action selected for the directroy: {global_path}.\n\ttotal disk size {total_size}\n\ttotal files {total_files}")
-            
-            if (args.all_actions) | (args.gen_clean) |  (args.qc1_clean) | (args.pca_clean) | (args.imp_clean) | (args.post_clean):
-                for unit in total_each:
-                    write_logs(unit, "_")
-                write_logs(f"Total_active\t{convert_bytes(single_size)}\t{single_count}\t{convert_bytes(rsingle_size)}\t{rsingle_count}\t{path}", "_")
-                rtotal_size =convert_bytes(get_size(global_path)); rtotal_files=count_files(global_path)
-                write_logs(f"Total_directroy\t{total_size}\t{total_files}\t{rtotal_size}\t{rtotal_files}\t{path}", "_")
+            if actions:
+                write_logs("Script-started", '0')
+                ## one line per call: the --log_json record of a line is split on tabs, not on newlines
+                write_logs(f"##Version: {__version__}", "_", {"event": "Version", "version": __version__})
+                write_logs("##ACTIONs\tSIZE_before\tnFILES_before\tSIZE_after\tnFILES_after\tPATH\tALLOC_before\tALLOC_after", "_")
+                if time_budget is not None and not dry_run:
+                    write_logs("##CODEC\tARCHIVE\tCHOSEN\tPREDICTED_RATIO\tRATIO\tPREDICTED_TIME\tTIME\tBUDGET", "_")
+                if bundle_limit and not dry_run:
+                    write_logs("##BUNDLE\tARCHIVE\tUNITS\tINODES_before\tINODES_after\tINODES_freed\tSIZE_before\tSIZE_after", "_")
+                ## plan every unit first, then run them (in --jobs worker processes when asked)
+                if resumed:
+                    total_size, total_files, total_alloc=journal.get("total_before")
+                    units=[(name, p) for seq, name, p, state, before, after, result in journal.units()]
+                    unscanned=journal.get("unscanned") or []
+                    if unscanned:
+                        ## a streamed run stopped before it planned these top-level directories (and --dir's own level)
+                        planned=set(units); root=tree_index.root
+                        def pending(p):
+                            p=os.path.normpath(str(p))
+                            if root in unscanned and (p==root or os.path.dirname(p)==root):
+                                return True
+                            return any(p==top or p.startswith(os.path.join(top, "")) for top in unscanned if top!=root)
+                        new=[(name, p) for name, p in bundle_units(plan_units(root, actions)) if (name, p) not in planned and pending(p)]
+                        for top in unscanned:
+                            if top!=tree_index.root:
+                                total_size, total_files, total_alloc=[a+b for a, b in zip((total_size, total_files, total_alloc), get_stats(top))]
+                        journal.plan(new, len(units)); journal.set("unscanned", [])
+                        journal.set("total_before", [total_size, total_files, total_alloc])
+                        units+=new
+                    write_logs(f"Resumed\t{sum(1 for r in resumed.values() if r[0]=='done')} of {len(units)} units already done")
+                else:
+                    total_size, total_files, total_alloc=get_stats(global_path)
+                    if shard is not None:
+                        ## empty files are still deleted before a directory is archived: in the shard's own subtrees
+                        ## here, everywhere else by --merge_shards
+                        units=[tuple(saved_plan["units"][i]) for i in shard_of[shard]]
+                        units=[(name, p) for name in dict.fromkeys(name for name, p in saved_plan["units"] if ACTION_BY_NAME[name].report=="count")
+                               for p in topmost_paths(p for n, p in units)]+units
+                    elif args.merge_shards or args.watch or tops is not None:
+                        ## --watch finds the units itself, as they settle; a streamed run plans each directory in turn
+                        units=[]
+                    elif args.from_plan:
+                        units=[(name, p) for name, p in saved_plan["units"]]
+                    else:
+                        units=bundle_units(plan_units(tree_index.root, actions))
+                    if journal is not None:
+                        journal.reset()
+                        journal.set("dir", tree_index.root); journal.set("actions", [action.name for action in actions])
+                        journal.set("total_before", [total_size, total_files, total_alloc]); journal.set("status", "running")
+                        journal.set("codecs", codec_settings())
+                        journal.plan(units)
+                        if tops is not None:
+                            journal.set("unscanned", tops+[tree_index.root])
+                totals=RunTotals()
+                needs=None
+                if headroom and not dry_run:
+                    needs=[estimate_unit(name, p) for name, p in units]
+                    write_logs(f"Headroom\t{convert_bytes(free_space(global_path))} free\t{convert_bytes(sum(needs))} estimated archives")
+                if time_budget is not None:
+                    ## the budget is shared by the bytes of the units that compress, --jobs of them at a time
+                    compressing=sum(unit_stats(name, p)[0] for name, p in units if ACTION_BY_NAME[name].compresses and tree_index.exists(p))
+                    time_per_byte=time_budget*(1 if dry_run else args.jobs)/max(1, compressing)
+                    write_logs(f"TimeBudget\t{time_budget:g}s\t{convert_bytes(compressing)}")
+                execute_units(units, totals, 1 if dry_run else args.jobs, resumed, needs)
+                if tops is not None:
+                    before=[total_size, total_files, total_alloc]
+                    units=stream_units(tops, actions, totals, args.jobs, before, args.low_memory)
+                    total_size, total_files, total_alloc=before
+                if args.watch:
+                    units=watch_units(actions, totals, args.jobs, args.quiet_period, args.watch_interval, args.watch)
+                if args.merge_shards:
+                    ## the units of every shard, in plan order, after the size-zero unit just run
+                    rows={}; counts=collections.Counter()
+                    for k in range(args.shards):
+                        try:
+                            with open(shard_result_path(k, args.shards)) as shard_fh:
+                                shard_result=json.load(shard_fh)
+                        except OSError:
+                            print(f"Exiting: shard {k} of {args.shards} has not finished ({shard_result_path(k, args.shards)} is missing).")
+                            exit()
+                        phases.merge(shard_result["phases"])
+                        for name, p, before, after, result in shard_result["rows"]:
+                            if ACTION_BY_NAME[name].report=="count":
+                                counts[name]+=result or 0
+                            else:
+                                rows[(name, p)]=(before, after, result)
+                        write_logs(f"Merged_shard\t{k}\t{len(shard_result['rows'])} units\t{shard_result['elapsed']}")
+                    for name, p in saved_plan["units"]:
+                        if ACTION_BY_NAME[name].report=="count":
+                            ## what is left after the shards, e.g. empty files outside every unit
+                            result=ACTION_BY_NAME[name].reduce(p, name)
+                            totals.add(ACTION_BY_NAME[name], p, (0, 0, 0), (0, 0, 0), (result or 0)+counts[name])
+                        elif (name, p) in rows:
+                            before, after, result=rows[(name, p)]
+                            totals.add(ACTION_BY_NAME[name], p, tuple(before), tuple(after), result)
+                    total_size, total_files, total_alloc=saved_plan.get("total_before") or (total_size, total_files, total_alloc)
+                totals.write(path)
+                if resumed:
+                    ## the resumed index only covers unfinished subtrees: carry the recorded per-unit changes over,
+                    ## plus the .validated manifests written next to archives (not part of a unit's own numbers)
+                    rtotal=[total_size, total_files, total_alloc]
+                    for name, p, before, after, result in totals.rows:
+                        extra=[0, 0, 0]
+                        for archive in unit_archives(p, result):
+                            if os.path.exists(f"{archive}.validated"):
+                                st=os.stat(f"{archive}.validated"); extra=[extra[0]+st.st_size, extra[1]+1, extra[2]+st.st_blocks*512]
+                        rtotal=[t+a-b+x for t, a, b, x in zip(rtotal, after, before, extra)]
+                    rtotal_size, rtotal_files, rtotal_alloc=rtotal
+                else:
+                    ## the index already holds the effect of every deletion and archive, so no second walk of --dir
+                    rtotal_size, rtotal_files, rtotal_alloc=get_stats(global_path)
+                if args.merge_shards and not saved_plan.get("total_before"):
+                    ## a plan written before it recorded total_before: work back from the changes of the units
+                    total_size, total_files, total_alloc=[t-sum(after[k]-before[k] for name, p, before, after, result in totals.rows)
+                                                          for k, t in enumerate((rtotal_size, rtotal_files, rtotal_alloc))]
+                if journal is not None:
+                    journal.set("status", "finished")
+                if shard is None and not resumed and not dry_run and not args.low_memory:
+                    tree_index.write_snapshot(snapshot_path(), [action.name for action in actions], saved_plan["units"] if args.merge_shards else units)
+                if shard is None:
+                    write_summary("Total_directroy", (total_size, total_files, total_alloc), (rtotal_size, rtotal_files, rtotal_alloc), path)
+                write_phase_summary()
+                if profiler is not None:
+                    write_profile_report()
                 end_time = time.time()
                 elapsed_time = end_time - start_time
                 hours = int(elapsed_time // 3600); minutes = int((elapsed_time % 3600) // 60); seconds = int(elapsed_time % 60)
                 formatted_time = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
                 write_logs(f"Total-time-elapsed:\t{formatted_time}",'1')
+                if shard is not None:
+                    ## no Total_directroy here: a shard only scanned its own units; --merge_shards adds the shards up
+                    with open(shard_result_path(shard, args.shards), 'w') as shard_fh:
+                        json.dump({"version": __version__, "shard": shard, "shards": args.shards, "elapsed": formatted_time,
+                                   "rows": totals.rows, "phases": phases.total}, shard_fh)
+                if dry_run:
+                    plan_file=f'{global_path}/reduce_size_{filestamp}.plan.json'
+                    with open(plan_file, 'w') as plan_fh:
+                        json.dump({"version": __version__, "dir": tree_index.root, "created": filestamp, "total_before": [total_size, total_files, total_alloc],
+                                   "actions": [action.name for action in actions], "codecs": codec_settings(),
+                                   "units": [[name, p] for name, p, before, after, result in totals.rows],
+                                   "estimates": [[name, p, before, after] for name, p, before, after, result in totals.rows]}, plan_fh)
+                    flush_logs()
+                    with open(log_path("summary")) as summary_fh:
+                        print(summary_fh.read(), end='')
+                    print(f"\nPlan written to {plan_file}")
             else:
-                pass
+                for top in tops or []:
+                    tree_index.add(top)
+                total_size =convert_bytes(get_size(global_path)); total_files=count_files(global_path)
+                print(f"\nNo action selected for the directroy: {global_path}.\n\ttotal disk size {total_size}\n\ttotal files {total_files}")
 
         else:
             print("Exiting: UnKnown FileType.")
@@ -0,0 +1,313 @@
+## run with: python -m pytest -q tests
+import glob
+import importlib.util
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import time
+
+import pytest
+
+SCRIPT=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "reduce_size.v1.py")
+
+@pytest.fixture(scope="module")
+def reduce_size():
+    ## the script has a dot in its name, so it is loaded from its path
+    spec=importlib.util.spec_from_file_location("reduce_size", SCRIPT)
+    module=importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def make_tree(root):
+    ## a small RICOPILI-like directory: units that are archived, deleted or left in place
+    for study in ("study0", "study1"):
+        for path, names in ((f"{study}/qc/tmp_report_qc0", ("a.txt", "b.log")), (f"{study}/qc/errandout", ("1.log", "2.log")),
+                            (f"{study}/post/resdaner", ("r.txt",)), (f"{study}/imp/cobg_dir_genome_wide", ("x.bg.bim", "x.bg.bed"))):
+            os.makedirs(os.path.join(root, path))
+            for name in names:
+                with open(os.path.join(root, path, name), "w") as fh:
+                    fh.write(f"{path}/{name}\n"*2000)
+        open(os.path.join(root, study, "empty.txt"), "w").close()
+
+def run(root, *args):
+    subprocess.check_call([sys.executable, SCRIPT, "--dir", str(root), "--all_actions", *args], cwd=str(root),
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+@pytest.fixture
+def indexed(reduce_size, monkeypatch):
+    ## the module state a run sets up in __main__, for calling the reducers in this process
+    def index(root, codec="gzip"):
+        monkeypatch.setattr(reduce_size, "global_path", root, raising=False)
+        monkeypatch.setattr(reduce_size, "tree_index", reduce_size.TreeIndex(root))
+        monkeypatch.setattr(reduce_size, "default_codec", reduce_size.parse_codec(codec))
+    return index
+
+def write_files(directory, files):
+    os.makedirs(directory, exist_ok=True)
+    for name, data in files.items():
+        with open(os.path.join(directory, name), "wb") as fh:
+            fh.write(data)
+
+def test_immediate_rerun_finds_no_changed_directories(tmp_path):
+    ## the snapshot holds the directory stamps as the run left them, so nothing is listed again
+    make_tree(tmp_path)
+    run(tmp_path)
+    ## the logs are named after the second the run started
+    time.sleep(1.1)
+    run(tmp_path)
+    first, second=sorted(glob.glob(str(tmp_path/"reduce_size_*.all.logs")))
+    with open(second) as fh:
+        lines=[line for line in fh if "\tSnapshot\t" in line]
+    assert len(lines)==1 and "\t0 changed directories\t" in lines[0]
+
+def tree_listing(root):
+    return sorted(os.path.relpath(os.path.join(d, name), root) for d, dirs, files in os.walk(root) for name in dirs+files
+                  if not name.startswith("reduce_size"))
+
+@pytest.mark.parametrize("low_memory", [False, True])
+def test_streamed_run_matches_run_from_snapshot(tmp_path, low_memory):
+    ## a first run streams the top-level directories; the same tree run from a full index ends up the same
+    make_tree(tmp_path/"streamed"); make_tree(tmp_path/"indexed")
+    open(tmp_path/"streamed"/"empty.txt", "w").close(); open(tmp_path/"indexed"/"empty.txt", "w").close()
+    run(tmp_path/"streamed", *(["--low_memory"] if low_memory else []))
+    run(tmp_path/"indexed", "--headroom")
+    assert tree_listing(tmp_path/"streamed")==tree_listing(tmp_path/"indexed")
+    assert "empty.txt" not in tree_listing(tmp_path/"streamed")
+    (logs,)=glob.glob(str(tmp_path/"streamed"/"reduce_size_*.all.logs"))
+    with open(logs) as fh:
+        assert sum("\tStreamed\t" in line for line in fh)==2
+    assert os.path.exists(tmp_path/"streamed"/"reduce_size.snapshot.gz")!=low_memory
+
+def test_json_log_has_one_record_per_line(tmp_path):
+    make_tree(tmp_path)
+    run(tmp_path, "--log_json")
+    (summary,)=glob.glob(str(tmp_path/"reduce_size_*.summary.jsonl"))
+    with open(summary) as fh:
+        records=[json.loads(line) for line in fh]
+    assert records[0]["event"]=="Version" and records[1]["event"]=="ACTIONs"
+    assert not any("\n" in str(value) for record in records for value in record.values())
+
+def test_headroom_leaves_directories_below_min_free(tmp_path):
+    ## no room above --min_free: the directory units are logged and left in place instead of archived in tiny parts
+    make_tree(tmp_path)
+    run(tmp_path, "--headroom", "--min_free", "1000000T")
+    assert os.path.isdir(tmp_path/"study0"/"post"/"resdaner")
+    assert not glob.glob(str(tmp_path/"study0"/"post"/"resdaner*.tar*"))
+    (logs,)=glob.glob(str(tmp_path/"reduce_size_*.all.logs"))
+    with open(logs) as fh:
+        assert any(line.split("\t")[1:3]==["NoSpace_resdaner", str(tmp_path/"study0"/"post"/"resdaner")] for line in fh)
+
+def test_resume_without_journal_leaves_no_files(tmp_path):
+    make_tree(tmp_path)
+    output=subprocess.run([sys.executable, SCRIPT, "--dir", str(tmp_path), "--resume"], cwd=str(tmp_path),
+                          stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    assert "Nothing to resume" in output
+    assert not glob.glob(str(tmp_path/"reduce_size*"))
+
+def test_plan_writes_only_plan_logs(tmp_path):
+    ## --plan from the snapshot of a finished run: every log file of the plan is a .plan one
+    make_tree(tmp_path)
+    run(tmp_path)
+    before=set(glob.glob(str(tmp_path/"reduce_size_*")))
+    time.sleep(1.1)
+    run(tmp_path, "--plan")
+    written=set(glob.glob(str(tmp_path/"reduce_size_*")))-before
+    assert written and all(".plan." in os.path.basename(p) for p in written)
+
+@pytest.mark.parametrize("codec", ["gzip", "zstd", "xz"])
+def test_manifest_check_decodes_the_last_frame(reduce_size, tmp_path, codec):
+    ## a well-sized archive with the recorded trailer but a corrupt last frame is rejected without --validate full
+    make_tree(tmp_path)
+    run(tmp_path, "--codec", codec)
+    archive=glob.glob(str(tmp_path/"study0"/"post"/"resdaner.tar.*[!d]"))[0]
+    with open(f"{archive}.validated") as fh:
+        manifest=json.load(fh)
+    assert reduce_size.verify_manifest(archive, manifest)
+    offset=manifest["index"]["points"][-1][1]
+    with open(archive, "r+b") as fh:
+        fh.seek((offset+manifest["size"]-8)//2)
+        byte=fh.read(1); fh.seek(-1, 1); fh.write(bytes([byte[0]^0xff]))
+    assert not reduce_size.verify_manifest(archive, manifest)
+
+@pytest.mark.parametrize("damage", ["truncate", "flip"])
+def test_damaged_archive_keeps_its_sources(reduce_size, indexed, monkeypatch, tmp_path, damage):
+    ## an archive that is cut short or corrupt after it was written fails the manifest check: no .validated, and the
+    ## directory it was made from is not deleted
+    source=tmp_path/"post"/"resdaner"
+    write_files(source, {f"r{i}.txt": f"chr{i}\t{i*7}\n".encode()*20000 for i in range(3)})
+    indexed(tmp_path)
+    compress_files=reduce_size.compress_files
+    def damaged(path, outlog):
+        archive, manifest=compress_files(path, outlog)
+        with open(archive, "r+b") as fh:
+            if damage=="truncate":
+                fh.truncate(manifest["size"]//2)
+            else:
+                fh.seek(manifest["size"]-64)
+                byte=fh.read(1); fh.seek(-1, 1); fh.write(bytes([byte[0]^0xff]))
+        return archive, manifest
+    monkeypatch.setattr(reduce_size, "compress_files", damaged)
+    reduce_size.compress_validate_delete(str(source), "resdaner")
+    assert sorted(os.listdir(source))==["r0.txt", "r1.txt", "r2.txt"]
+    assert not glob.glob(str(tmp_path/"post"/"*.validated"))
+
+@pytest.mark.parametrize("codec,test", [("gzip", ["gzip", "-t"]), ("zstd", ["zstd", "-t", "-q"]), ("xz", ["xz", "-t"])])
+def test_stored_frames_decode_with_the_codec_command(tmp_path, codec, test):
+    ## an already compressed member goes out as a hand-built stored frame; the whole archive must still be a
+    ## standard stream for gzip/zstd/xz and hold the member unchanged
+    if shutil.which(test[0]) is None:
+        pytest.skip(f"{test[0]} is not installed")
+    packed=random.Random(1).randbytes(600<<10)
+    text=b"rs1\t1\t100\tA\tG\n"*20000
+    write_files(tmp_path/"post"/"resdaner", {"scores.txt": text, "scores.gz": packed})
+    run(tmp_path, "--codec", codec)
+    archive=str(tmp_path/"post"/f"resdaner.tar{'.gz' if codec=='gzip' else '.zst' if codec=='zstd' else '.xz'}")
+    with open(f"{archive}.validated") as fh:
+        assert json.load(fh)["stored_members"]==1
+    subprocess.check_call(test+[archive])
+    tar_bytes=subprocess.run([test[0], "-d", "-c", archive], stdout=subprocess.PIPE, check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(tar_bytes)) as tar:
+        assert tar.extractfile("resdaner/scores.gz").read()==packed
+        assert tar.extractfile("resdaner/scores.txt").read()==text
+
+@pytest.mark.parametrize("codec", ["gzip", "zstd", "xz"])
+def test_ls_and_extract_across_segments(reduce_size, indexed, monkeypatch, capsys, tmp_path, codec):
+    ## segments of 64 KiB instead of 64 MiB: members spread over many independently compressed segments are
+    ## listed from the manifest and extracted from their own segments only
+    if not reduce_size.parse_codec(codec).available():
+        pytest.skip(f"no {codec}")
+    rng=random.Random(2)
+    files={f"chr{i}.txt": "".join(f"rs{rng.randrange(10**6)}\t{rng.random():.4f}\n" for _ in range(4000)).encode() for i in range(6)}
+    source=tmp_path/"post"/"resdaner"
+    write_files(source, files)
+    indexed(tmp_path, codec)
+    init=reduce_size.SegmentedWriter.__init__
+    monkeypatch.setattr(reduce_size.SegmentedWriter, "__init__", lambda self, *args, **kwargs: init(self, *args, **dict(kwargs, segment_size=64<<10)))
+    archive=reduce_size.compress_validate_delete(str(source), "resdaner")
+    assert archive and not os.path.exists(source)
+    manifest=reduce_size.archive_manifest(archive)
+    assert len({c for u, c in manifest["index"]["points"]})>=len(files)
+    capsys.readouterr()
+    reduce_size.list_archive(archive, ["resdaner/chr4.txt"])
+    assert capsys.readouterr().out==f"f\t{len(files['chr4.txt'])}\tresdaner/chr4.txt\n"
+    reduce_size.extract_members(archive, ["resdaner/chr1.txt", "resdaner/chr5.txt"], str(tmp_path/"out"))
+    assert capsys.readouterr().out.count("Extracted\t")==2
+    assert sorted(os.listdir(tmp_path/"out"/"resdaner"))==["chr1.txt", "chr5.txt"]
+    for name in ("chr1.txt", "chr5.txt"):
+        with open(tmp_path/"out"/"resdaner"/name, "rb") as fh:
+            assert fh.read()==files[name]
+
+def test_duplicates_round_trip_as_hard_links(reduce_size, tmp_path, capsys):
+    ## identical files (one shorter than the hash head, one longer) become tar hard links and come back as copies
+    small=b"A\tC\t0.1\n"*400; large=random.Random(3).randbytes(200<<10)
+    write_files(tmp_path/"post"/"resdaner", {"a.txt": small, "b.txt": small, "c.bin": large, "d.bin": large, "e.txt": small[:-1]+b"x"})
+    run(tmp_path)
+    archive=str(tmp_path/"post"/"resdaner.tar.gz")
+    with tarfile.open(archive) as tar:
+        links={member.name: member.linkname for member in tar if member.type==tarfile.LNKTYPE}
+    assert links=={"resdaner/b.txt": "resdaner/a.txt", "resdaner/d.bin": "resdaner/c.bin"}
+    with tarfile.open(archive) as tar:
+        tar.extractall(tmp_path/"tar")
+    reduce_size.extract_members(archive, [], str(tmp_path/"extract"))
+    for out in ("tar", "extract"):
+        for name, data in (("b.txt", small), ("d.bin", large), ("e.txt", small[:-1]+b"x")):
+            with open(tmp_path/out/"resdaner"/name, "rb") as fh:
+                assert fh.read()==data
+
+def test_bundle_under_packs_small_units_and_extracts_one_by_name(tmp_path):
+    ## four small danscore_* directories in one directory become one bundle; --ls lists them as units and --extract
+    ## of a unit's name restores that directory only, under the name of the directory the bundle is in
+    scores={f"danscore_sc{i}": {f"s{j}.profile": f"FID IID SCORE{i}{j}\n".encode()*3000 for j in range(3)} for i in range(4)}
+    for unit, files in scores.items():
+        write_files(tmp_path/"post"/unit, files)
+    run(tmp_path, "--bundle_under", "10M")
+    post=tmp_path/"post"
+    assert sorted(os.listdir(post))==["danscore.bundle001.tar.gz", "danscore.bundle001.tar.gz.validated"]
+    bundle=str(post/"danscore.bundle001.tar.gz")
+    listing=subprocess.run([sys.executable, SCRIPT, "--ls", bundle], stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    assert sorted(line.split("\t")[-1] for line in listing.splitlines() if line.startswith("unit\t"))==sorted(scores)
+    subprocess.run([sys.executable, SCRIPT, "--extract", bundle, "--member", "danscore_sc2", "--out", str(tmp_path/"out")],
+                   stdout=subprocess.DEVNULL, check=True)
+    assert tree_listing(tmp_path/"out")==["post", "post/danscore_sc2"]+[f"post/danscore_sc2/s{j}.profile" for j in range(3)]
+    for name, data in scores["danscore_sc2"].items():
+        with open(tmp_path/"out"/"post"/"danscore_sc2"/name, "rb") as fh:
+            assert fh.read()==data
+
+def test_bad_size_is_an_argument_error(reduce_size, tmp_path):
+    assert reduce_size.parse_size("1.5G")==3<<29
+    for text in ("1.2.3", ".", "5X"):
+        with pytest.raises(reduce_size.argparse.ArgumentTypeError):
+            reduce_size.parse_size(text)
+    process=subprocess.run([sys.executable, SCRIPT, "--dir", str(tmp_path), "--all_actions", "--read_limit", "1.2.3"],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    assert process.returncode==2 and "invalid size 1.2.3" in process.stderr
+
+def test_watch_deletes_quiet_empty_files_outside_units(tmp_path):
+    ## as in a normal run, empty files outside every unit go too, once their directory has been quiet
+    make_tree(tmp_path)
+    process=subprocess.Popen([sys.executable, SCRIPT, "--dir", str(tmp_path), "--all_actions", "--watch", "poll",
+                              "--quiet_period", "1", "--watch_interval", "0.5"], cwd=str(tmp_path), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(3)
+        os.makedirs(tmp_path/"study1"/"notes")
+        open(tmp_path/"study1"/"notes"/"later.txt", "w").close()
+        time.sleep(4)
+    finally:
+        process.terminate(); process.wait()
+    assert not os.path.exists(tmp_path/"study0"/"empty.txt")
+    assert os.listdir(tmp_path/"study1"/"notes")==[]
+    (logs,)=glob.glob(str(tmp_path/"reduce_size_*.all.logs"))
+    assert os.path.getsize(logs)>0
+
+class FakeClock(object):
+    ## time.monotonic and time.sleep of a simulated run: sleeping moves the clock on
+    def __init__(self):
+        self.now=1000.0
+    def monotonic(self):
+        return self.now
+    def sleep(self, seconds):
+        self.now+=seconds
+
+@pytest.fixture
+def clock(reduce_size, monkeypatch):
+    clock=FakeClock()
+    monkeypatch.setattr(reduce_size.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(reduce_size.time, "sleep", clock.sleep)
+    return clock
+
+def run_ops(throttle, clock, seconds, unlink_latency):
+    ## for seconds of simulated time, every 10 ms: a directory of 50 entries scanned in 250 us, 100 unlinks, then
+    ## the rest of the 10 ms idle (once the throttle lets them through)
+    end=clock.now+seconds
+    while clock.now<end:
+        start=clock.now
+        throttle.charge(50, 250e-6, "scandir"); clock.now+=250e-6
+        for _ in range(100):
+            throttle.charge(1, unlink_latency, "unlink"); clock.now+=unlink_latency
+        clock.now=max(clock.now, start+0.01)
+
+def test_steady_latency_never_backs_off(reduce_size, clock):
+    throttle=reduce_size.Throttle("ops", None, True, floor=10)
+    run_ops(throttle, clock, 30, 60e-6)
+    assert throttle.take_stats()[1]==0 and throttle.rate is None
+
+def test_rising_latency_backs_off(reduce_size, clock):
+    ## the same unlinks getting ten times slower (a loaded server): the rate is capped, and freed again once the
+    ## latency is back to normal
+    throttle=reduce_size.Throttle("ops", None, True, floor=10)
+    run_ops(throttle, clock, 5, 60e-6)
+    run_ops(throttle, clock, 3, 600e-6)
+    assert throttle.take_stats()[1]>0 and throttle.rate is not None
+    run_ops(throttle, clock, 60, 60e-6)
+    assert throttle.rate is None
+
+def test_segments_give_every_thread_a_block(reduce_size):
+    ## each segment starts a new compressor process: at least 64 MiB, more with many threads or big codec blocks
+    assert reduce_size.SegmentedWriter(None, reduce_size.GzipCodec(), 1).segment_size==64<<20
+    assert reduce_size.SegmentedWriter(None, reduce_size.GzipCodec(), 128).segment_size==128<<20
+    assert reduce_size.SegmentedWriter(None, reduce_size.XzCodec(9), 8).segment_size==8*3*(64<<20)